@@ -15,11 +15,49 @@ view_distance = 57 # in centimeters, 57cm = 1 deg of visual angle per cm of scre
 #########################################
 tms_serial_port = '/dev/ttyUSB0' # Usually 'COM1' on Windows
 labjack_port = 'FIO' # Either FIO, EIO, or CIO
+trigger_backend = None # 'labjack', 'parallel', 'serial', 'virtual', or None (fastest of labjack/parallel)
+parallel_port = None # e.g. '/dev/parport0' to use a parallel port for triggers (Linux only)
+serial_trigger_port = None # serial port to use for RTS/DTR TMS triggers (requires trigger_backend = 'serial')
+device_discovery_timeout = 10.0 # seconds
+device_worker = False # run the trigger port and TMS in a separate process
+tms_heartbeat = False # keep the stimulator armed in the background between pulses
+tms_heartbeat_interval = 5.0 # seconds
 trigger_codes = {
     'trial_start': 2,
     'fire_tms': 17, # EMG marker 1 + fire TMS on pin 5
 }
 
+#########################################
+# EMG Recording
+#########################################
+emg_enabled = False
+emg_channels = [8] # LabJack analog inputs (e.g. AIN8 = EIO0) to record EMG from, not on labjack_port
+emg_virtual = False # simulate EMG if no LabJack is available (testing only)
+emg_sample_rate = 5000 # Hz per channel
+emg_buffer_secs = 10.0 # size of the acquisition ring buffer (in seconds)
+mep_window = (0.015, 0.06) # MEP response window (in seconds after the pulse)
+mep_max_rms = None # max pre-pulse EMG RMS (in volts) for accepting an MEP
+
+#########################################
+# RMT Estimation
+#########################################
+rmt_auto = False # estimate the RMT adaptively from MEPs (requires emg_enabled)
+rmt_max_pulses = 30
+rmt_max_sd = 1.5 # stop once the posterior sd of the RMT is below this (in % power)
+rmt_pulse_interval = 5.0 # minimum seconds between pulses
+rmt_max_power = 80 # highest power level (in %) to pulse at during estimation
+rmt_simulated = 45 # RMT (in % power) of the simulated participant (virtual EMG only)
+
+#########################################
+# Display Latency Calibration
+#########################################
+display_calibration = False # measure the display latency with a photodiode at startup
+photodiode_channel = 9 # LabJack AIN number (analog) or FIO/EIO/CIO number (digital), not on labjack_port
+photodiode_digital = False
+photodiode_threshold = 0.5 # volts (analog photodiodes only)
+photodiode_patch_size = 2.0 # size of the flashed test patch (in degrees)
+calibration_flashes = 50
+
 #########################################
 # Environment Aesthetic Defaults
 #########################################
@@ -73,4 +111,19 @@ break_interval = 36  # trials
 fixation_duration = 3.5 # seconds
 hand_size_deg = 8.0 # height of hand stimuli (in degrees)
 tms_pulse_delays = [250, 500, 750] # milliseconds
+interleave_pulse_delays = False # use every pulse delay in each block instead of one per block
+pulse_proportion = 0.5 # proportion of trials with a TMS pulse in each block
+pulse_max_gap = 8 # max trials in a row without a pulse, so the stimulator doesn't disarm
+pulse_balance = ['hand', 'angle', 'rotation'] # factors to balance pulse trials across
 greyscale_hands = True
+realtime_mode = False # raise priority and pause garbage collection during trials
+realtime_cores = None # e.g. [2, 3] to pin the task to specific CPU cores
+profile_session = False # write a Chrome trace of task phases and device calls
+clock_rate = 1.0 # speed of the experiment clock relative to real time (testing only)
+record_session = False # record input and device events for replay
+replay_file = None # path of a session recording to replay with virtual devices
+replay_rt_tolerance = 5.0 # ms
+replay_onset_tolerance = 5.0 # ms
+telemetry_enabled = False # serve a live session dashboard on localhost
+telemetry_port = 8765
+backup_dir = None # folder (e.g. on a second disk) to mirror the database to during sessions
@@ -69,3 +69,28 @@ CREATE TABLE trials (
     tms_fired boolean not null,
     rmt float not null
 );
+
+CREATE TABLE meps (
+    id integer primary key autoincrement not null,
+    participant_id integer not null references participants(id),
+    session_num integer not null,
+    block_num integer not null,
+    trial_num integer not null,
+    channel integer not null,
+    amplitude float,
+    latency float,
+    pre_rms float,
+    rejected boolean not null
+);
+
+CREATE TABLE rmt_pulses (
+    id integer primary key autoincrement not null,
+    participant_id integer not null references participants(id),
+    session_num integer not null,
+    pulse_num integer not null,
+    power integer not null,
+    amplitude float not null,
+    mep boolean not null,
+    estimate float not null,
+    posterior_sd float not null
+);
@@ -0,0 +1,223 @@
+import os
+import sqlite3
+import tempfile
+import threading
+
+# Background mirroring of the project database to a second disk or folder
+# during a session, so that a failure of the stimulus PC's disk can't lose
+# more than a block's worth of data.
+#
+# Each pass first takes a consistent snapshot of the database into a local
+# staging file using SQLite's online backup API, a few pages at a time. Each
+# step only holds a read lock for as long as it takes to copy those pages, and
+# the backup restarts automatically if the database is written to mid-pass.
+# The staging file is then compared page by page with the older of two mirror
+# generations (the '.next' file next to the mirror), only pages that differ
+# are written to it, and once it has been synced it is renamed over the
+# mirror, with the previous mirror becoming the next pass's '.next' file. The
+# mirror is never written in place, so a crash mid-pass can't leave it torn:
+# the mirror (or, if the crash happened between renames, the '.old' file) is
+# always a complete copy from the last finished pass. Like the snapshot, the
+# page comparison pauses between steps while replication is paused.
+#
+# Note that the database file itself is never opened directly: on POSIX
+# systems, closing any handle to an SQLite file drops all of the process's
+# locks on it, including those of the experiment's own connection.
+
+
+class DatabaseReplicator(object):
+    """Mirrors an SQLite database to another location in the background.
+
+    Passes only run when requested (e.g. at block boundaries and breaks), and
+    can be paused between steps during time-critical parts of the task.
+
+    Args:
+        path (str): The path of the database to mirror.
+        mirror_dir (str): The folder to write the mirror to. The mirror has
+            the same file name as the database.
+        step_pages (int, optional): The number of pages to snapshot per step.
+            Defaults to 64.
+        step_sleep (float, optional): The time (in seconds) to wait between
+            steps, or before retrying a step if the database is busy.
+            Defaults to 5 ms.
+
+    """
+    def __init__(self, path, mirror_dir, step_pages=64, step_sleep=0.005):
+        self.path = path
+        self.mirror = os.path.join(mirror_dir, os.path.basename(path))
+        self._next = self.mirror + ".next"
+        self._old = self.mirror + ".old"
+        self.step_pages = step_pages
+        self.step_sleep = step_sleep
+        self.passes = 0
+        self.pages_written = 0
+        self.error = None
+        staging = "{0}.{1}.staging".format(os.path.basename(path), os.getpid())
+        self._staging = os.path.join(tempfile.gettempdir(), staging)
+        self._cond = threading.Condition()
+        self._requested = 0
+        self._completed = 0
+        self._stopping = False
+        self._unpaused = threading.Event()
+        self._unpaused.set()
+        self._thread = None
+
+    def start(self):
+        """Starts the replication thread.
+
+        """
+        mirror_dir = os.path.dirname(self.mirror)
+        if mirror_dir and not os.path.isdir(mirror_dir):
+            os.makedirs(mirror_dir)
+        self._thread = threading.Thread(target=self._run, name="DBReplicator")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def request(self):
+        """Requests a replication pass without waiting for it.
+
+        Requests made while a pass is already pending are merged into it.
+
+        """
+        with self._cond:
+            self._requested += 1
+            self._cond.notify_all()
+
+    def pause(self):
+        """Pauses any pass in progress after its current step.
+
+        """
+        self._unpaused.clear()
+
+    def resume(self):
+        """Resumes replication after a call to :meth:`pause`.
+
+        """
+        self._unpaused.set()
+
+    def sync(self, timeout=None):
+        """Requests a replication pass and waits for it to finish.
+
+        Args:
+            timeout (float, optional): The maximum time (in seconds) to wait.
+                Defaults to no timeout.
+
+        Returns:
+            bool: True if the pass finished within the timeout.
+
+        """
+        self.resume()
+        with self._cond:
+            self._requested += 1
+            target = self._requested
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._completed >= target, timeout)
+
+    def close(self):
+        """Stops the replication thread and removes the staging file.
+
+        Any pass in progress is finished first.
+
+        """
+        if self._thread:
+            with self._cond:
+                self._stopping = True
+                self._cond.notify_all()
+            self.resume()
+            self._thread.join()
+            self._thread = None
+        if os.path.exists(self._staging):
+            os.remove(self._staging)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._requested > self._completed or self._stopping)
+                if self._requested <= self._completed:
+                    break
+                target = self._requested
+            try:
+                self._replicate()
+                self.passes += 1
+            except Exception as e:
+                self.error = e
+                print("Warning: database backup failed ({0})".format(e))
+            with self._cond:
+                self._completed = target
+                self._cond.notify_all()
+
+    def _progress(self, status, remaining, total):
+        # Called by SQLite between backup steps, when no locks are held
+        self._unpaused.wait()
+
+    def _replicate(self):
+        # Take a consistent snapshot of the database in small steps
+        src = sqlite3.connect(self.path, timeout=self.step_sleep)
+        dst = sqlite3.connect(self._staging)
+        try:
+            src.backup(
+                dst, pages=self.step_pages, progress=self._progress,
+                sleep=self.step_sleep
+            )
+        finally:
+            dst.close()
+            src.close()
+
+        # Bring the older mirror generation up to date, then swap it in
+        self.pages_written += _copy_changed_pages(
+            self._staging, self._next, self.step_pages, self._unpaused.wait
+        )
+        self._unpaused.wait()
+        if os.path.exists(self.mirror):
+            os.replace(self.mirror, self._old)
+        os.replace(self._next, self.mirror)
+        if os.path.exists(self._old):
+            os.replace(self._old, self._next)
+        _fsync_dir(os.path.dirname(self.mirror))
+
+
+
+def _fsync_dir(path):
+    # Makes renames within a folder durable (not possible or needed on Windows)
+    if os.name == 'nt':
+        return
+    fd = os.open(path or ".", os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _copy_changed_pages(src_path, dst_path, step_pages=64, wait=None):
+    # Updates a copy of an SQLite database file, only writing the pages that
+    # differ between the two and calling wait() (if given) every step_pages
+    # pages and before syncing. Returns the number of pages written.
+    with open(src_path, 'rb') as src:
+        header = src.read(100)
+        page_size = int.from_bytes(header[16:18], 'big')
+        if page_size == 1:
+            page_size = 65536
+        size = os.path.getsize(src_path)
+        written = 0
+        mode = 'r+b' if os.path.exists(dst_path) else 'w+b'
+        with open(dst_path, mode) as dst:
+            src.seek(0)
+            pages = 0
+            while True:
+                if wait and pages % step_pages == 0:
+                    wait()
+                pages += 1
+                page = src.read(page_size)
+                if not page:
+                    break
+                old = dst.read(page_size)
+                if page != old:
+                    dst.seek(-len(old), os.SEEK_CUR)
+                    dst.write(page)
+                    written += 1
+            dst.truncate(size)
+            dst.flush()
+            if wait:
+                wait()
+            os.fsync(dst.fileno())
+    return written
@@ -0,0 +1,279 @@
+import time
+import threading
+
+from klibs.KLTime import precise_time
+
+# A pluggable clock for the experiment, so that all timing (countdowns, device
+# waits, response timestamps) goes through a single source that can be swapped
+# out for an accelerated virtual clock during testing and benchmarking.
+
+
+_clock = None
+
+
+def get_clock():
+    """Retrieves the clock currently used for timing the experiment.
+
+    If no clock has been set, a :class:`RealTimeClock` is created and used.
+
+    Returns:
+        :obj:`Clock`: The active clock object.
+
+    """
+    global _clock
+    if _clock is None:
+        _clock = RealTimeClock()
+    return _clock
+
+
+def set_clock(clock):
+    """Sets the clock to use for timing the experiment.
+
+    Should be called before any devices or listeners are initialized, since
+    timestamps from different clocks are not comparable.
+
+    Args:
+        clock (:obj:`Clock`): The clock object to use for all timing.
+
+    """
+    global _clock
+    if not isinstance(clock, Clock):
+        raise TypeError("clock must be a Clock object (got {0})".format(type(clock)))
+    _clock = clock
+
+
+def init_clock(rate=None):
+    """Initializes the experiment clock for a given rate of time.
+
+    Args:
+        rate (float, optional): The speed of the clock relative to real time.
+            If None or 1.0, a :class:`RealTimeClock` is used. Otherwise, a
+            :class:`VirtualClock` running at the given rate is used.
+
+    Returns:
+        :obj:`Clock`: The newly-initialized clock object.
+
+    """
+    if rate is None or rate == 1.0:
+        clock = RealTimeClock()
+    else:
+        clock = VirtualClock(rate)
+        print("\nNOTE: Using virtual clock at {0}x real time...\n".format(rate))
+    set_clock(clock)
+    return clock
+
+
+
+class Clock(object):
+    """A base class for experiment clocks.
+
+    All times are in seconds unless stated otherwise, and are only meaningful
+    relative to other times from the same clock.
+
+    """
+    def time(self):
+        """Gets the current time of the clock.
+
+        Returns:
+            float: The current clock time (in seconds).
+
+        """
+        e = "Clocks must have a defined 'time' method"
+        raise NotImplementedError(e)
+
+    def sleep(self, secs):
+        """Waits for a given duration on the clock.
+
+        Args:
+            secs (float): The duration (in seconds) to wait.
+
+        """
+        e = "Clocks must have a defined 'sleep' method"
+        raise NotImplementedError(e)
+
+    def ticks(self):
+        """Gets the current time of the clock in milliseconds.
+
+        Used for response timing, where times need to be comparable to the
+        timestamps of input events (see :meth:`event_ticks`).
+
+        Returns:
+            float: The current clock time (in milliseconds).
+
+        """
+        return self.time() * 1000
+
+    def event_ticks(self, timestamp):
+        """Converts the timestamp of an SDL input event to clock ticks.
+
+        Args:
+            timestamp (int): The SDL timestamp (in milliseconds) of the event.
+
+        Returns:
+            float: The time of the event on the clock (in milliseconds).
+
+        """
+        return timestamp
+
+    def countdown(self, duration):
+        """Creates a countdown timer that runs on this clock.
+
+        Args:
+            duration (float): The duration (in seconds) of the countdown.
+
+        Returns:
+            :obj:`CountDown`: A countdown timer for the given duration.
+
+        """
+        return CountDown(duration, clock=self)
+
+
+class RealTimeClock(Clock):
+    """A clock that runs in real (wall-clock) time.
+
+    """
+    def time(self):
+        return precise_time()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def ticks(self):
+        # Since keypress events have SDL timestamps, use SDL_GetTicks for the
+        # millisecond clock so that response times are consistent.
+        import sdl2
+        return sdl2.SDL_GetTicks()
+
+
+class VirtualClock(Clock):
+    """A clock that runs faster than real time.
+
+    Time on a virtual clock passes at a fixed multiple of real time, and any
+    calls to :meth:`sleep` return immediately after skipping the clock ahead
+    by the requested duration. This allows whole sessions to run in a fraction
+    of the time while keeping all timing logic the same.
+
+    Only the thread driving the task (by default, the main thread) skips the
+    clock ahead when sleeping. Sleeps on any other thread (e.g. device or
+    acquisition threads) wait for the clock to reach the requested time
+    without moving it, so background work can't make the task's time run
+    any faster.
+
+    Args:
+        rate (float, optional): The speed of the clock relative to real time.
+            Defaults to 100.
+        start (float, optional): The initial time (in seconds) of the clock.
+            Defaults to 0.
+        driver (:obj:`threading.Thread`, optional): The thread whose sleeps
+            skip the clock ahead. Defaults to the main thread.
+
+    """
+    def __init__(self, rate=100.0, start=0.0, driver=None):
+        if rate <= 0:
+            raise ValueError("Clock rate must be greater than 0 (got {0})".format(rate))
+        self.rate = float(rate)
+        self.driver = driver if driver else threading.main_thread()
+        self._cond = threading.Condition()
+        self._real_start = precise_time()
+        self._start = start
+        self._skipped = 0.0
+
+    def _real_to_virtual(self, real):
+        return self._start + (real - self._real_start) * self.rate + self._skipped
+
+    def time(self):
+        return self._real_to_virtual(precise_time())
+
+    def advance(self, secs):
+        """Skips the clock ahead by a given duration.
+
+        Args:
+            secs (float): The duration (in seconds) to skip ahead.
+
+        """
+        with self._cond:
+            self._skipped += max(0.0, secs)
+            self._cond.notify_all()
+
+    def advance_to(self, t):
+        """Skips the clock ahead to a given time, if not already past it.
+
+        Args:
+            t (float): The clock time (in seconds) to skip ahead to.
+
+        """
+        with self._cond:
+            self._skipped += max(0.0, t - self.time())
+            self._cond.notify_all()
+
+    def sleep(self, secs):
+        wake = self.time() + secs
+        if threading.current_thread() is self.driver:
+            self.advance_to(wake)
+            return
+        # Wait in real time for the clock to catch up, waking early if the
+        # driving thread skips it ahead
+        with self._cond:
+            remaining = wake - self.time()
+            while remaining > 0:
+                self._cond.wait(remaining / self.rate)
+                remaining = wake - self.time()
+
+    def event_ticks(self, timestamp):
+        # Input events have real SDL timestamps, so convert them to clock time
+        import sdl2
+        real = precise_time() - (sdl2.SDL_GetTicks() - timestamp) / 1000.0
+        return self._real_to_virtual(real) * 1000
+
+
+class CountDown(object):
+    """A countdown timer that runs on a given experiment clock.
+
+    Works like :class:`klibs.KLTime.CountDown`, but uses an experiment clock
+    instead of real time.
+
+    Args:
+        duration (float): The duration (in seconds) of the countdown.
+        clock (:obj:`Clock`, optional): The clock to use for the countdown.
+            Defaults to the current experiment clock.
+
+    """
+    def __init__(self, duration, clock=None):
+        if duration < 0:
+            raise ValueError("Countdown duration must be positive (got {0})".format(duration))
+        self.duration = float(duration)
+        self._clock = clock if clock else get_clock()
+        self.reset()
+
+    def reset(self):
+        """Restarts the countdown from its full duration.
+
+        """
+        self._started = self._clock.time()
+
+    def elapsed(self):
+        """Gets the time elapsed since the countdown was started.
+
+        Returns:
+            float: The elapsed time (in seconds).
+
+        """
+        return self._clock.time() - self._started
+
+    def remaining(self):
+        """Gets the time remaining in the countdown.
+
+        Returns:
+            float: The remaining time (in seconds), or 0 if finished.
+
+        """
+        return max(0.0, self.duration - self.elapsed())
+
+    def counting(self):
+        """Checks whether the countdown is still running.
+
+        Returns:
+            bool: True if time remains in the countdown, otherwise False.
+
+        """
+        return self.elapsed() < self.duration
@@ -1,8 +1,18 @@
-import time
+import os
+import sys
+import struct
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from klibs import P
+from klibs.KLTime import precise_time
 from klibs.KLInternal import package_available
 
+from clock import get_clock
+from profiling import traced
+
 
 
 LABJACK_REGISTERS = {
@@ -11,6 +21,27 @@ LABJACK_REGISTERS = {
     'CIO': 6702, # Note: 4 pins, only supports values 0-15
 }
 
+# The I/O numbers of the pins on each LabJack U3 port (FIO0-7 and EIO0-7 can
+# also be used as the analog inputs with the same numbers, e.g. EIO0 = AIN8)
+LABJACK_PINS = {
+    'FIO': range(0, 8),
+    'EIO': range(8, 16),
+    'CIO': range(16, 20),
+}
+
+# ioctl request codes for the Linux ppdev driver (from linux/ppdev.h)
+PPCLAIM = 0x708B
+PPRELEASE = 0x708C
+PPWDATA = 0x40017086
+PPDATADIR = 0x40047090
+
+# Supported trigger backends, in order of preference
+TRIGGER_BACKENDS = ['labjack', 'parallel', 'serial', 'virtual']
+
+# Backends that can be chosen automatically when no backend is requested (the
+# serial backend can only send pulses, so it must be requested explicitly)
+AUTO_BACKENDS = ['labjack', 'parallel']
+
 
 def _raise_err(task, msg=None):
     e = "Error encountered {0}".format(task)
@@ -19,61 +50,155 @@ def _raise_err(task, msg=None):
     raise RuntimeError(e)
 
 
-def _check_labjack_driver():
+def _locked(func):
+    # Serializes calls to a device across threads (e.g. heartbeat and main)
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def _count_labjack_devices():
     # LabJackPython requires a driver to work and errors out if not installed,
     # so check to make sure it exists (fall back to virtual if not)
     import u3
-    has_driver = False
     try:
-        u3.deviceCount(devType=3)
-        has_driver = True
+        return u3.deviceCount(devType=3)
     except AttributeError:
-        pass
-    return has_driver
+        return 0
+
 
+def _serial_port_available(port):
+    # On POSIX systems serial ports are device files, so we can avoid the slow
+    # enumeration of all ports on the system
+    if os.name != 'nt':
+        return os.path.exists(port)
+    from serial.tools.list_ports import comports
+    return port in [p.device for p in comports()]
 
+
+@traced('discovery')
 def get_trigger_port():
     """Retrieves a TriggerPort object for writing digital trigger codes.
 
-    If a supported hardware trigger port is available, it will be
-    initialized and configured for sending trigger codes. If no digital
-    trigger hardware is available, a virtual trigger port will be returned.
+    If ``P.trigger_backend`` is set, the requested backend is initialized and
+    used. Otherwise, a LabJack is used if one is connected, along with a
+    parallel port if one is configured with ``P.parallel_port``. If both are
+    available, the LabJack is used whenever EMG recording or display
+    calibration needs its inputs, and otherwise both are benchmarked (see
+    :func:`benchmark_port`) and the one with the lowest worst-case write
+    latency is used. If no digital trigger hardware is available, a virtual
+    trigger port will be returned.
+
+    Raises:
+        RuntimeError: If the backend requested by ``P.trigger_backend`` is
+            unknown or unavailable.
 
     """
-    # Try loading the LabLack U3 as a trigger port
-    if package_available('u3'):
-        import u3
-        has_driver = _check_labjack_driver()
-        if has_driver and u3.deviceCount(devType=3) > 0:
-            dev = u3.U3()
-            return U3Port(dev)
+    backend = P.trigger_backend
+    if backend:
+        if backend not in TRIGGER_BACKENDS:
+            e = "Unknown trigger backend '{0}' (must be one of {1})"
+            raise RuntimeError(e.format(backend, ", ".join(TRIGGER_BACKENDS)))
+        port = _open_trigger_port(backend)
+        if port is None:
+            _raise_err("initializing trigger port", "'{0}' not available".format(backend))
+        return port
+
+    # Open all available hardware trigger ports, skipping any that fail
+    ports = {}
+    for backend in AUTO_BACKENDS:
+        try:
+            port = _open_trigger_port(backend)
+        except (OSError, IOError) as e:
+            print("\nNOTE: Unable to open '{0}' trigger port ({1})".format(backend, e))
+            port = None
+        if port:
+            ports[backend] = port
 
     # If no physical trigger port available, return a virtual one
-    return VirtualPort(device=None)
-
-
-def _poke_magstim(port, timeout=1.0):
-    # Workaround for a MagPy bug on Linux until magneto is done: without
-    # this, MagPy hangs indefinitely the first time it tris to connect.
-    import serial
-    com = serial.Serial(
-        port,
-        baudrate=9600,
-        bytesize=serial.EIGHTBITS,
-        stopbits=serial.STOPBITS_ONE,
-        parity=serial.PARITY_NONE,
-    )
-    com.write_timeout = 0.5
-    # Write a 'get parameters' command to the Magstim and wait for a response
-    com.write(b"J@u")
-    wait_start = time.time()
-    while not com.in_waiting:
-        if (time.time() - wait_start) > timeout:
-            raise RuntimeError("Connection with Magstim timed out.")
-        time.sleep(0.1)
-    return com.read(com.in_waiting)
+    if not ports:
+        return _open_trigger_port('virtual')
+    elif len(ports) == 1:
+        return list(ports.values())[0]
+
+    # If EMG or the photodiode need the LabJack's inputs, always use it
+    if 'labjack' in ports and (P.emg_enabled or P.display_calibration):
+        for backend, port in ports.items():
+            if backend != 'labjack':
+                port.close()
+        return ports['labjack']
+
+    # If multiple ports available, use the one with the lowest latency
+    print("\nBenchmarking trigger ports...")
+    results = {}
+    for backend, port in ports.items():
+        results[backend] = benchmark_port(port)
+        txt = " - {0}: median {1:.3f} ms, 99% {2:.3f} ms, jitter {3:.3f} ms"
+        r = results[backend]
+        print(txt.format(backend, r['median'], r['p99'], r['jitter']))
+    best = min(results.keys(), key=lambda b: results[b]['p99'])
+    print("Using '{0}' for triggers.\n".format(best))
+    for backend, port in ports.items():
+        if backend != best:
+            port.close()
+    return ports[best]
+
+
+def _open_trigger_port(backend):
+    # Initializes a given trigger backend, returning None if its hardware
+    # (or required package) isn't available
+    if backend == 'labjack':
+        # Try loading the LabLack U3 as a trigger port
+        if package_available('u3') and _count_labjack_devices() > 0:
+            import u3
+            return U3Port(u3.U3())
+
+    elif backend == 'parallel':
+        # ppdev is Linux-only, so skip on other platforms
+        port = P.parallel_port
+        if port and sys.platform.startswith('linux') and os.path.exists(port):
+            return ParallelPort(port)
+
+    elif backend == 'serial':
+        port = P.serial_trigger_port
+        if port and package_available('serial') and _serial_port_available(port):
+            return SerialTTLPort(port)
+
+    elif backend == 'virtual':
+        return VirtualPort(device=None)
+
+    return None
+
+
+def benchmark_port(port, writes=100):
+    """Measures the latency and jitter of writing to a trigger port.
+
+    Writes a code of 0 (i.e. all pins low) to the port repeatedly and times
+    each write, so benchmarking never sends a trigger.
+
+    Args:
+        port (:obj:`TriggerPort`): The trigger port to benchmark.
+        writes (int, optional): The number of writes to time. Defaults to 100.
 
+    Returns:
+        dict: The median and 99th percentile write latency, along with the
+        jitter (the difference between the two), all in milliseconds.
 
+    """
+    times = []
+    for i in range(writes):
+        start = precise_time()
+        port._write_trigger(0)
+        times.append((precise_time() - start) * 1000)
+    times.sort()
+    median = times[len(times) // 2]
+    p99 = times[min(int(len(times) * 0.99), len(times) - 1)]
+    return {'median': median, 'p99': p99, 'jitter': p99 - median}
+
+
+@traced('discovery')
 def get_tms_controller():
     """Retrieves a TMSController object for controlling a TMS system.
 
@@ -83,27 +208,186 @@ def get_tms_controller():
 
     """
     if package_available('serial'):
-        from serial.tools.list_ports import comports
-        available_ports = [p.device for p in comports()]
-        if P.tms_serial_port in available_ports:
-
-            _poke_magstim(P.tms_serial_port)
+        if _serial_port_available(P.tms_serial_port):
+
+            # Workaround for a MagPy bug on Linux until magneto is done: without
+            # this, MagPy hangs indefinitely the first time it tries to connect.
+            # Write a 'get parameters' command and wait for a response, keeping
+            # the port open for as long as the controller exists.
+            conn = SerialConnection(P.tms_serial_port)
+            try:
+                conn.query(b"J@u")
+            except Exception:
+                conn.close()
+                raise
 
             if package_available('magneto'):
                 from magneto import Magstim
                 dev = Magstim(P.tms_serial_port)
-                return MagnetoController(dev)
+                return MagnetoController(dev, conn)
 
             elif package_available('magpy'):
                 # NOTE: Currently no way of autodetecting Magstim model
                 from magpy.magstim import BiStim
                 dev = BiStim(P.tms_serial_port)
-                return MagPyController(dev)
+                return MagPyController(dev, conn)
+
+            conn.close()
     
     # If no hardware stimulator available, return a virtual one
     return VirtualTMSController(None)
 
 
+class DeviceDiscovery(object):
+    """Initializes the trigger port and TMS controller in the background.
+
+    Since probing for hardware can take a second or more per device, both
+    devices are discovered concurrently on worker threads so that other
+    startup work (e.g. stimulus preprocessing) can happen at the same time.
+    Discovery starts as soon as the object is created.
+
+    Args:
+        timeout (float, optional): The maximum time (in seconds) to wait for
+            device discovery to finish, measured from when discovery started.
+            Defaults to no timeout.
+        virtual (bool, optional): If True, virtual devices will be used even if
+            hardware is available. Defaults to False.
+
+    """
+    def __init__(self, timeout=None, virtual=False):
+        self.timeout = timeout
+        self.timings = {}
+        self._lock = threading.Lock()
+        self._start = precise_time()
+        get_trigger = get_trigger_port
+        get_tms = get_tms_controller
+        if virtual:
+            get_trigger = lambda: VirtualPort(None)
+            get_tms = lambda: VirtualTMSController(None)
+        self._pool = ThreadPoolExecutor(max_workers=2)
+        self._trigger = self._pool.submit(self._timed, 'trigger', get_trigger)
+        self._tms = self._pool.submit(self._timed, 'tms', get_tms)
+        self._pool.shutdown(wait=False)
+
+    def _timed(self, name, func):
+        start = precise_time()
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.timings[name] = precise_time() - start
+
+    def _result(self, future, name):
+        remaining = None
+        if self.timeout is not None:
+            remaining = max(0, self.timeout - (precise_time() - self._start))
+        try:
+            return future.result(timeout=remaining)
+        except FutureTimeoutError:
+            e = "Initializing the {0} device timed out ({1} seconds)"
+            raise RuntimeError(e.format(name, self.timeout))
+
+    def wait(self):
+        """Waits for device discovery to finish.
+
+        Any errors encountered while initializing either device are re-raised
+        here.
+
+        Returns:
+            tuple: The initialized (:obj:`TriggerPort`, :obj:`TMSController`).
+
+        Raises:
+            RuntimeError: If discovery did not finish within the timeout.
+
+        """
+        trigger = self._result(self._trigger, "trigger")
+        tms = self._result(self._tms, "TMS")
+        return (trigger, tms)
+
+
+
+class SerialConnection(object):
+    """A managed serial connection to a TMS stimulator.
+
+    Uses blocking reads with timeouts for queries, rather than polling the
+    port for input.
+
+    Since neither MagPy nor Magneto can use an existing serial handle, the
+    backends open the port separately. The connection used to wake up the
+    stimulator is kept open alongside them (as required by the MagPy
+    workaround) and is owned by the :obj:`TMSController`, which closes it
+    when the controller is closed.
+
+    Args:
+        port (str): The name of the serial port for the stimulator (e.g.
+            '/dev/ttyUSB0' or 'COM1').
+        baudrate (int, optional): The baud rate of the connection. Defaults
+            to 9600, the rate used by all Magstim stimulators.
+
+    """
+    def __init__(self, port, baudrate=9600):
+        import serial
+        self.port = port
+        self._com = serial.Serial(
+            port,
+            baudrate=baudrate,
+            bytesize=serial.EIGHTBITS,
+            stopbits=serial.STOPBITS_ONE,
+            parity=serial.PARITY_NONE,
+            write_timeout=0.5,
+        )
+
+    @property
+    def is_open(self):
+        """bool: True if the connection currently holds the port open.
+        """
+        return self._com is not None and self._com.is_open
+
+    @traced('serial')
+    def query(self, cmd, timeout=1.0, max_bytes=64):
+        """Writes a command to the serial port and reads the response.
+
+        The read blocks until the first byte of the response arrives or the
+        timeout is reached, and then returns as soon as the device stops
+        sending data.
+
+        Args:
+            cmd (bytes): The raw command to write to the port.
+            timeout (float, optional): The maximum time (in seconds) to wait
+                for a response. Defaults to 1 second.
+            max_bytes (int, optional): The maximum response length (in bytes)
+                to read. Defaults to 64.
+
+        Returns:
+            bytes: The raw response from the device.
+
+        Raises:
+            RuntimeError: If the connection is closed or the device does not
+                respond within the timeout.
+
+        """
+        if not self.is_open:
+            raise RuntimeError("Serial connection to {0} is closed.".format(self.port))
+        self._com.reset_input_buffer()
+        self._com.write(cmd)
+        # At 9600 baud each byte takes ~1 ms, so a 20 ms gap means the
+        # device has finished responding
+        self._com.timeout = timeout
+        self._com.inter_byte_timeout = 0.02
+        resp = self._com.read(max_bytes)
+        if not len(resp):
+            raise RuntimeError("Connection with Magstim timed out.")
+        return resp
+
+    def close(self):
+        """Closes the serial connection, if open.
+
+        """
+        if self._com is not None:
+            self._com.close()
+            self._com = None
+
+
 
 class TriggerPort(object):
     """A class for sending digital trigger codes to external hardware.
@@ -159,6 +443,7 @@ class TriggerPort(object):
         for name, value in mapping.items():
             self.add_code(name, value)
 
+    @traced('trigger')
     def send(self, name, duration=4):
         """Sends a given trigger code to the trigger port.
 
@@ -176,7 +461,7 @@ class TriggerPort(object):
         
         """
         self._write_trigger(self.codes[name])
-        time.sleep(duration / 1000.0)
+        get_clock().sleep(duration / 1000.0)
         self._write_trigger(0)
 
     def close(self):
@@ -197,9 +482,23 @@ class TriggerPort(object):
 class U3Port(TriggerPort):
     """A TriggerPort implementation for LabJack U3 devices.
 
+    All pins on the port given by ``P.labjack_port`` are used as trigger
+    outputs. Pins on the other ports can be used as inputs (e.g. for EMG or a
+    photodiode) once configured with :meth:`configure_inputs`.
+
+    Since the device handle is shared with any input streams, configuration
+    calls (e.g. ``configIO`` or starting and stopping a stream), trigger
+    writes, and closing the device all hold the port's ``_lock``. Reading
+    stream data doesn't, so that trigger writes never wait behind a read.
+
     """
+    @traced('usb')
     def _hardware_init(self):
+        self._lock = threading.Lock()
         self._write_reg = LABJACK_REGISTERS[P.labjack_port]
+        self._trigger_pins = set(LABJACK_PINS[P.labjack_port])
+        self._inputs = set()
+        self._analog = set()
         self._device.getCalibrationData()
         # Configure all IO pins to be digital outputs set to 0
         self._device.configU3(
@@ -208,14 +507,131 @@ class U3Port(TriggerPort):
             CIODirection=255, CIOState=0,
         )
 
+    def configure_inputs(self, channels, analog=True):
+        """Configures pins of the U3 to be used as inputs.
+
+        Args:
+            channels (list): The I/O numbers of the pins to use as inputs
+                (e.g. 8 for EIO0/AIN8).
+            analog (bool, optional): If True, the pins are configured as analog
+                inputs. Otherwise, they are left as digital pins. Defaults to
+                True.
+
+        Raises:
+            ValueError: If any of the pins are used for trigger outputs, are
+                already in use as other inputs, or can't be used as analog
+                inputs.
+
+        """
+        channels = set(channels)
+        for ch in sorted(channels):
+            if ch in self._trigger_pins:
+                e = "LabJack pin {0} is a trigger output on the {1} port."
+                raise ValueError(e.format(ch, P.labjack_port))
+            if ch in self._inputs:
+                raise ValueError("LabJack pin {0} is already in use as an input.".format(ch))
+            if analog and not 0 <= ch < 16:
+                raise ValueError("LabJack pin {0} can't be an analog input.".format(ch))
+            if not 0 <= ch < 20:
+                raise ValueError("LabJack pin {0} does not exist.".format(ch))
+        self._inputs |= channels
+        if analog:
+            self._analog |= channels
+            fio = sum(1 << ch for ch in self._analog if ch < 8)
+            eio = sum(1 << (ch - 8) for ch in self._analog if ch >= 8)
+            with self._lock:
+                self._device.configIO(FIOAnalog=fio, EIOAnalog=eio)
+
+    @traced('usb')
     def _write_trigger(self, value):
         # Fast method from Appelhoff & Stenner (2021), may be erratic on Windows
-        self._device.writeRegister(self._write_reg, 0xFF00 + (value & 0xFF))
+        with self._lock:
+            self._device.writeRegister(self._write_reg, 0xFF00 + (value & 0xFF))
 
+    @traced('usb')
     def close(self):
         # Needs to be called on Linux and macOS in order for the LabJack to be
         # able to be opened again reliably without reconnecting the cable.
-        self._device.close()
+        with self._lock:
+            self._device.close()
+
+
+class ParallelPort(TriggerPort):
+    """A TriggerPort implementation for parallel ports on Linux.
+
+    Writes trigger codes to the data pins of the port through the kernel's
+    ppdev interface, which only needs read/write access to the port's device
+    file (e.g. '/dev/parport0') rather than any extra drivers or packages.
+
+    Args:
+        device (str): The path of the parallel port device file.
+
+    """
+    def _hardware_init(self):
+        import fcntl
+        self._ioctl = fcntl.ioctl
+        self._fd = os.open(self._device, os.O_RDWR)
+        try:
+            self._ioctl(self._fd, PPCLAIM)
+        except OSError:
+            os.close(self._fd)
+            raise
+        try:
+            # Make sure the data pins are outputs (only needed on ports that
+            # support bidirectional mode)
+            self._ioctl(self._fd, PPDATADIR, struct.pack('i', 0))
+        except OSError:
+            pass
+        # Pre-pack all possible codes so writes don't need to allocate
+        self._values = [struct.pack('B', i) for i in range(256)]
+        self._write_trigger(0)
+
+    @traced('parallel')
+    def _write_trigger(self, value):
+        self._ioctl(self._fd, PPWDATA, self._values[value])
+
+    def close(self):
+        if self._fd is not None:
+            self._write_trigger(0)
+            self._ioctl(self._fd, PPRELEASE)
+            os.close(self._fd)
+            self._fd = None
+
+
+class SerialTTLPort(TriggerPort):
+    """A TriggerPort implementation using the control lines of a serial port.
+
+    Sets the RTS and DTR lines of the port high for the 'fire_tms' trigger
+    code (from ``P.trigger_codes``) and low for any other code. Since this
+    only gives a single on/off signal, the port can only be used for firing
+    the stimulator, and all other triggers (e.g. EMG markers) are ignored.
+    Note that true RS-232 ports use +/-12V signals, so a level shifter may be
+    needed for TTL inputs (most USB-TTL serial adapters don't need one).
+
+    Args:
+        device (str): The name of the serial port (e.g. '/dev/ttyUSB1').
+
+    """
+    def _hardware_init(self):
+        import serial
+        self._pulse_value = P.trigger_codes['fire_tms']
+        self._com = serial.Serial()
+        self._com.port = self._device
+        # Set the lines low before opening to avoid a pulse when opened
+        self._com.rts = False
+        self._com.dtr = False
+        self._com.open()
+
+    @traced('serial')
+    def _write_trigger(self, value):
+        state = value != 0 and value == self._pulse_value
+        self._com.rts = state
+        self._com.dtr = state
+
+    def close(self):
+        if self._com.is_open:
+            self._write_trigger(0)
+            self._com.close()
 
 
 class VirtualPort(TriggerPort):
@@ -231,12 +647,29 @@ class TMSController(object):
     Args:
         device: The object representing the stimulator for a given backend. Can
             be None.
+        connection (:obj:`SerialConnection`, optional): The managed serial
+            connection for the stimulator, if any. Will be closed when the
+            controller is closed.
 
     """
-    def __init__(self, device):
+    def __init__(self, device, connection=None):
         self._device = device
+        self._connection = connection
+        self._lock = threading.RLock()
+        self._keep_armed = False
+        self._armed_at = None
+        self._hb_thread = None
+        self._hb_stop = threading.Event()
+        self._hb_paused = False
+        self.heartbeat_rearms = 0
+        self.heartbeat_failures = 0
+        self.heartbeat_error = None
         self._hardware_init()
 
+    def _close(self):
+        # Actually closes the backend's connection to the stimulator
+        pass
+
     def _hardware_init(self):
         # Initialize the connection to the TMS system
         pass
@@ -249,6 +682,10 @@ class TMSController(object):
         # Actually arms the stimulator
         pass
 
+    def _disarm(self):
+        # Actually disarms the stimulator
+        pass
+
     def set_power(self, level):
         """Sets the power level for the primary coil of the stimulator.
 
@@ -285,7 +722,8 @@ class TMSController(object):
         to manually disarm between trials depending on the nature of your study.
 
         Once armed, the Magstim will disarm automatically if the stimulator has
-        not been fired for over 1 minute.
+        not been fired for over 1 minute. To keep it armed regardless, use
+        :meth:`start_heartbeat`.
  
         Args:
             wait (bool, optional): If True, this method will wait up to 2 seconds
@@ -293,13 +731,16 @@ class TMSController(object):
                 to False.
 
         """
+        self._keep_armed = True
         self._arm()
+        self._armed_at = precise_time()
         if wait:
             timeout = 2.0
-            start = time.time()
+            clock = get_clock()
+            start = clock.time()
             while not self.ready:
-                time.sleep(0.1)
-                if (time.time() - start) > timeout:
+                clock.sleep(0.1)
+                if (clock.time() - start) > timeout:
                     e = "Arming the stimulator timed out (2 seconds)"
                     raise RuntimeError(e)
 
@@ -307,7 +748,8 @@ class TMSController(object):
         """Disarms the stimulator.
         
         """
-        pass
+        self._keep_armed = False
+        self._disarm()
 
     def fire(self):
         """Commands the stimulator to fire.
@@ -321,6 +763,106 @@ class TMSController(object):
         """
         pass
 
+    def close(self):
+        """Closes the connection with the stimulator.
+
+        Should be called at the end of the experiment, when the stimulator is
+        no longer needed.
+
+        """
+        self.stop_heartbeat()
+        try:
+            self._close()
+        finally:
+            if self._connection:
+                self._connection.close()
+                self._connection = None
+
+    def start_heartbeat(self, interval=5.0, rearm_after=40.0):
+        """Starts a background heartbeat that keeps the stimulator armed.
+
+        The heartbeat periodically queries the stimulator's status without
+        firing, which keeps the remote control connection active. While the
+        stimulator is meant to be armed (i.e. it has been armed and not since
+        disarmed), it is re-armed in the background once ``rearm_after``
+        seconds have passed since it was last armed, so that it never reaches
+        the stimulator's 1 minute inactivity timeout. It is also re-armed
+        right away if it's found to no longer be armed.
+
+        A check that falls during a pause (see :meth:`pause_heartbeat`) is
+        held until the pause ends, so that re-arms happen between trials
+        instead of being skipped while trials are running.
+
+        Heartbeat failures do not stop the heartbeat, but are counted in the
+        ``heartbeat_failures`` attribute and printed as warnings, with the
+        most recent error stored in ``heartbeat_error``.
+
+        Note that the heartbeat interval is always in real time, regardless
+        of the experiment clock.
+
+        Args:
+            interval (float, optional): The time (in seconds) between heartbeat
+                checks. Defaults to 5 seconds.
+            rearm_after (float, optional): The time (in seconds) after arming
+                at which the stimulator is re-armed. Should leave room for the
+                check interval and any pauses before the 60 second timeout.
+                Defaults to 40 seconds.
+
+        """
+        if self._hb_thread:
+            return
+        self._hb_stop.clear()
+        self._hb_thread = threading.Thread(
+            target=self._heartbeat_loop, args=(interval, rearm_after),
+            name="TMSHeartbeat"
+        )
+        self._hb_thread.daemon = True
+        self._hb_thread.start()
+
+    def stop_heartbeat(self):
+        """Stops the background heartbeat, if running.
+
+        """
+        if self._hb_thread:
+            self._hb_stop.set()
+            self._hb_thread.join()
+            self._hb_thread = None
+
+    def pause_heartbeat(self):
+        """Pauses the heartbeat, e.g. during timing-critical parts of a trial.
+
+        A heartbeat check that is already in progress will still finish.
+
+        """
+        self._hb_paused = True
+
+    def resume_heartbeat(self):
+        """Resumes the heartbeat after a call to :meth:`pause_heartbeat`.
+
+        """
+        self._hb_paused = False
+
+    def _heartbeat_loop(self, interval, rearm_after):
+        while not self._hb_stop.wait(interval):
+            # Hold the check until any pause is over
+            while self._hb_paused:
+                if self._hb_stop.wait(0.05):
+                    return
+            try:
+                with self._lock:
+                    armed = self.armed
+                    if not self._keep_armed:
+                        continue
+                    due = precise_time() - self._armed_at >= rearm_after
+                    if due or not armed:
+                        self._arm()
+                        self._armed_at = precise_time()
+                        self.heartbeat_rearms += 1
+            except Exception as e:
+                self.heartbeat_failures += 1
+                self.heartbeat_error = e
+                print("Warning: TMS heartbeat failed ({0})".format(e))
+
     @property
     def armed(self):
         """bool: True if the stimulator has been armed, otherwise False.
@@ -356,10 +898,13 @@ class VirtualTMSController(TMSController):
     def arm(self, wait=False):
         if wait:
             # Simulate usual delay between arming and ready to fire
-            time.sleep(1.0)
+            get_clock().sleep(1.0)
+        super(VirtualTMSController, self).arm()
+
+    def _arm(self):
         self._info['armed'] = True
 
-    def disarm(self):
+    def _disarm(self):
         self._info['armed'] = False
 
     def fire(self):
@@ -381,6 +926,8 @@ class MagPyController(TMSController):
     Magstim Rapid stimulators should be usable with some extra work.
 
     """
+    @traced('serial')
+    @_locked
     def _hardware_init(self):
         self._device.connect()
         # If BiStim, configure to start in single-pulse mode
@@ -389,29 +936,46 @@ class MagPyController(TMSController):
             self._device.setPowerB(0)
             self._device.setPulseInterval(0)
 
+    @traced('serial')
+    @_locked
     def _set_power(self, level):
         err, msg = self._device.setPower(level, receipt=True)
         if err:
             _raise_err("setting power for the primary coil", msg)
 
+    @traced('serial')
+    @_locked
     def _arm(self):
         err, msg = self._device.arm(receipt=True)
         if err:
             _raise_err("arming the stimulator", msg)
 
+    @traced('serial')
+    @_locked
     def get_power(self):
         err, info = self._device.getParameters()
         if err:
             _raise_err("retrieving the current stimulator settings", info)
         return int(info['bistimParam']['powerA'])
 
-    def disarm(self):
+    @traced('serial')
+    @_locked
+    def _close(self):
+        self._device.disconnect()
+
+    @traced('serial')
+    @_locked
+    def _disarm(self):
         self._device.disarm()
 
+    @traced('serial')
+    @_locked
     def fire(self):
         self._device.fire()
 
     @property
+    @traced('serial')
+    @_locked
     def armed(self):
         err, params = self._device._queryCommand()
         status = params['instr']
@@ -421,6 +985,8 @@ class MagPyController(TMSController):
             return bool(status['ready']) or bool(status['armed'])
 
     @property
+    @traced('serial')
+    @_locked
     def ready(self):
         return self._device.isReadyToFire()
 
@@ -431,25 +997,44 @@ class MagnetoController(TMSController):
     Currently only Magstim 200 and BiStim stimulators are supported.
 
     """
+    @traced('serial')
+    @_locked
     def _hardware_init(self):
         self._device.connect()
 
+    @traced('serial')
+    @_locked
     def _set_power(self, level):
         self._device.set_power(level)
 
+    @traced('serial')
+    @_locked
     def _arm(self):
         self._device.arm()
 
+    @traced('serial')
+    @_locked
     def get_power(self):
         return self._device.get_power()
 
-    def disarm(self):
+    @traced('serial')
+    @_locked
+    def _close(self):
+        self._device.disconnect()
+
+    @traced('serial')
+    @_locked
+    def _disarm(self):
         self._device.disarm()
 
+    @traced('serial')
+    @_locked
     def fire(self):
         self._device.fire()
 
     @property
+    @traced('serial')
+    @_locked
     def armed(self):
         armed = self._device.armed
         # Work around bizarre bug where magstim reports not being armed or disarmed
@@ -458,5 +1043,7 @@ class MagnetoController(TMSController):
         return armed
 
     @property
+    @traced('serial')
+    @_locked
     def ready(self):
         return self._device.ready
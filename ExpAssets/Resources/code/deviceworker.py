@@ -0,0 +1,567 @@
+import os
+import sys
+import time
+import runpy
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from klibs import P
+from klibs.KLTime import precise_time
+
+from communication import (get_trigger_port, get_tms_controller, TriggerPort,
+    TMSController)
+from realtime import LoopTimer
+
+# An optional mode for running all device I/O in a separate worker process, so
+# that trigger writes and stimulator queries never compete with rendering and
+# event pumping for the GIL.
+#
+# The experiment and worker communicate through a single shared memory block:
+#
+#   header (2 x int64):  the command ring's head (written by the experiment)
+#                        and tail (written by the worker)
+#   commands (64 x 4 x float64):  a ring of command slots, each holding an
+#                        opcode, two arguments, and the time it was sent
+#   status (float64):    device status and counters, written by the worker
+#   error (256 bytes):   the most recent error message from the worker
+#
+# Since each side only ever writes its own end of the ring, no locking is
+# needed, and commands are never pickled. An Event wakes the worker when new
+# commands arrive. The worker acknowledges each command by advancing the tail,
+# so the experiment can wait for a command to finish when it needs a result.
+
+
+SLOTS = 64
+SLOT_WIDTH = 4
+ERROR_BYTES = 256
+
+STATUS_FIELDS = [
+    'state', 'armed', 'ready', 'power', 'heartbeat_rearms', 'heartbeat_failures',
+    'errors', 'trigger_latency', 'trigger_init', 'tms_init',
+]
+_STATUS = {name: i for i, name in enumerate(STATUS_FIELDS)}
+
+# Worker states
+STARTING = 0
+RUNNING = 1
+FAILED = -1
+
+# Command opcodes
+WRITE = 1
+TRIGGER = 2
+SET_POWER = 3
+ARM = 4
+DISARM = 5
+FIRE = 6
+QUERY_ARMED = 7
+QUERY_READY = 8
+QUERY_POWER = 9
+HEARTBEAT_START = 10
+HEARTBEAT_STOP = 11
+HEARTBEAT_PAUSE = 12
+HEARTBEAT_RESUME = 13
+CLOSE_TRIGGER = 14
+CLOSE_TMS = 15
+
+# Parameters needed by the worker to find and configure the devices
+WORKER_PARAMS = [
+    'tms_serial_port', 'labjack_port', 'trigger_backend', 'parallel_port',
+    'serial_trigger_port', 'trigger_codes', 'emg_enabled', 'display_calibration',
+]
+
+
+class _SharedState(object):
+    # Numpy views of the command ring and status block in shared memory
+
+    def __init__(self, shm):
+        buf = shm.buf
+        n_status = len(STATUS_FIELDS)
+        cmd_start = 16
+        status_start = cmd_start + SLOTS * SLOT_WIDTH * 8
+        error_start = status_start + n_status * 8
+        self.header = np.ndarray((2,), np.int64, buf, 0)
+        self.commands = np.ndarray((SLOTS, SLOT_WIDTH), np.float64, buf, cmd_start)
+        self.status = np.ndarray((n_status,), np.float64, buf, status_start)
+        self.error = np.ndarray((ERROR_BYTES,), np.uint8, buf, error_start)
+
+    @staticmethod
+    def size():
+        return 16 + SLOTS * SLOT_WIDTH * 8 + len(STATUS_FIELDS) * 8 + ERROR_BYTES
+
+    def set_error(self, msg):
+        raw = str(msg).encode('utf-8')[:ERROR_BYTES - 1]
+        self.error[:] = 0
+        self.error[:len(raw)] = np.frombuffer(raw, np.uint8)
+
+    def get_error(self):
+        raw = self.error.tobytes().split(b'\0', 1)[0]
+        return raw.decode('utf-8', 'replace') if raw else None
+
+    def release(self):
+        # Views must be dropped before the shared memory can be closed
+        self.header = self.commands = self.status = self.error = None
+
+
+
+class DeviceWorker(object):
+    """Runs the trigger port and TMS controller in a separate process.
+
+    Device discovery starts in the worker as soon as the object is created,
+    so this can be used in place of :class:`DeviceDiscovery`. The returned
+    devices have the same API as their in-process counterparts.
+
+    Note that only the worker process has access to the hardware, so devices
+    that need the trigger port's hardware directly (e.g. EMG streaming from
+    a LabJack) aren't available in this mode.
+
+    Args:
+        timeout (float, optional): The maximum time (in seconds) to wait for
+            device discovery to finish. Defaults to no timeout.
+
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.timings = {}
+        self._open = 0
+        self._shm = SharedMemory(create=True, size=_SharedState.size())
+        self._state = _SharedState(self._shm)
+        self._state.header[:] = 0
+        self._state.status[:] = 0
+        self._state.error[:] = 0
+        ctx = mp.get_context('spawn')
+        self._wake = ctx.Event()
+        params = {name: getattr(P, name, None) for name in WORKER_PARAMS}
+        self._proc = ctx.Process(
+            target=_worker_main, args=(self._shm.name, params, self._wake),
+            name="DeviceWorker"
+        )
+        self._proc.daemon = True
+        self._proc.start()
+
+    def wait(self):
+        """Waits for the worker to finish device discovery.
+
+        Returns:
+            tuple: The (:obj:`WorkerTriggerPort`, :obj:`WorkerTMSController`)
+            proxies for the devices in the worker.
+
+        Raises:
+            RuntimeError: If discovery failed or did not finish within the
+                timeout.
+
+        """
+        start = precise_time()
+        while self.status('state') == STARTING:
+            if not self._proc.is_alive():
+                break
+            if self.timeout is not None and precise_time() - start > self.timeout:
+                e = "Initializing devices in the worker process timed out ({0} seconds)"
+                raise RuntimeError(e.format(self.timeout))
+            time.sleep(0.005)
+        if self.status('state') != RUNNING:
+            e = "Error initializing devices in the worker process: {0}"
+            raise RuntimeError(e.format(self._state.get_error()))
+        self.timings['trigger'] = self.status('trigger_init')
+        self.timings['tms'] = self.status('tms_init')
+        self._open = 2
+        return (WorkerTriggerPort(self), WorkerTMSController(self))
+
+    def command(self, op, a=0.0, b=0.0):
+        """Sends a command to the worker without waiting for it to finish.
+
+        Args:
+            op (int): The opcode of the command.
+            a (float, optional): The first argument of the command.
+            b (float, optional): The second argument of the command.
+
+        Returns:
+            int: The sequence number of the command (see :meth:`wait_for`).
+
+        Raises:
+            RuntimeError: If the command ring stays full for over 1 second.
+
+        """
+        header = self._state.header
+        head = int(header[0])
+        if head - int(header[1]) >= SLOTS:
+            self.wait_for(head - SLOTS + 1, timeout=1.0)
+        self._state.commands[head % SLOTS] = (op, a, b, precise_time())
+        header[0] = head + 1
+        self._wake.set()
+        return head + 1
+
+    def wait_for(self, seq, timeout=2.0):
+        """Waits for the worker to finish a given command.
+
+        Args:
+            seq (int): The sequence number of the command.
+            timeout (float, optional): The maximum time (in seconds) to wait.
+                Defaults to 2 seconds.
+
+        Raises:
+            RuntimeError: If the command did not finish within the timeout.
+
+        """
+        header = self._state.header
+        if header[1] >= seq:
+            return
+        # Spin briefly for fast commands, then back off to short sleeps
+        start = precise_time()
+        while header[1] < seq:
+            elapsed = precise_time() - start
+            if elapsed > timeout:
+                raise RuntimeError("Device worker did not respond ({0} seconds)".format(timeout))
+            elif elapsed > 0.002:
+                time.sleep(0.0002)
+
+    def call(self, op, a=0.0, b=0.0, timeout=2.0):
+        """Sends a command to the worker and waits for it to finish.
+
+        Raises:
+            RuntimeError: If the command failed in the worker.
+
+        """
+        errors = self.status('errors')
+        self.wait_for(self.command(op, a, b), timeout)
+        if self.status('errors') > errors:
+            raise RuntimeError("Device worker error: {0}".format(self._state.get_error()))
+
+    def status(self, name):
+        """Gets a status value written by the worker.
+
+        Args:
+            name (str): The name of the status field (see ``STATUS_FIELDS``).
+
+        Returns:
+            float: The current value of the field.
+
+        """
+        return float(self._state.status[_STATUS[name]])
+
+    @property
+    def error(self):
+        """str: The most recent error in the worker, or None if no errors.
+        """
+        return self._state.get_error()
+
+    def _device_closed(self):
+        # Shuts down the worker once both devices have been closed
+        self._open -= 1
+        if self._open <= 0:
+            self._proc.join(timeout=2.0)
+            if self._proc.is_alive():
+                self._proc.terminate()
+            self._state.release()
+            self._shm.close()
+            self._shm.unlink()
+
+
+class WorkerTriggerPort(TriggerPort):
+    """A TriggerPort that sends codes through the device worker process.
+
+    Sending a trigger returns as soon as the command has been queued, with
+    the worker handling the hold duration and reset to 0.
+
+    Args:
+        worker (:obj:`DeviceWorker`): The device worker.
+
+    """
+    def send(self, name, duration=4):
+        self._device.command(TRIGGER, self.codes[name], duration / 1000.0)
+
+    def _write_trigger(self, value):
+        self._device.command(WRITE, value)
+
+    def close(self):
+        self._device.call(CLOSE_TRIGGER)
+        self._device._device_closed()
+
+
+class WorkerTMSController(TMSController):
+    """A TMSController for a stimulator run by the device worker process.
+
+    Commands return once queued, while status reads (``armed``, ``ready``,
+    and :meth:`get_power`) wait for the worker to query the stimulator. The
+    heartbeat runs in the worker process.
+
+    Args:
+        worker (:obj:`DeviceWorker`): The device worker.
+
+    """
+    def __init__(self, worker):
+        # The heartbeat and connection state all live in the worker, so none
+        # of the base class's setup is needed here
+        self._device = worker
+        self._connection = None
+
+    def _set_power(self, level):
+        self._device.command(SET_POWER, level)
+
+    def get_power(self):
+        self._device.call(QUERY_POWER)
+        return int(self._device.status('power'))
+
+    def arm(self, wait=False):
+        self._device.command(ARM)
+        if wait:
+            timeout = 2.0
+            start = precise_time()
+            while not self.ready:
+                time.sleep(0.1)
+                if (precise_time() - start) > timeout:
+                    raise RuntimeError("Arming the stimulator timed out (2 seconds)")
+
+    def disarm(self):
+        self._device.command(DISARM)
+
+    def fire(self):
+        self._device.command(FIRE)
+
+    def close(self):
+        self._device.call(CLOSE_TMS)
+        self._device._device_closed()
+
+    def start_heartbeat(self, interval=5.0):
+        self._device.command(HEARTBEAT_START, interval)
+
+    def stop_heartbeat(self):
+        # May need to wait for a heartbeat check in progress to finish
+        self._device.call(HEARTBEAT_STOP, timeout=5.0)
+
+    def pause_heartbeat(self):
+        self._device.command(HEARTBEAT_PAUSE)
+
+    def resume_heartbeat(self):
+        self._device.command(HEARTBEAT_RESUME)
+
+    @property
+    def heartbeat_rearms(self):
+        return int(self._device.status('heartbeat_rearms'))
+
+    @property
+    def heartbeat_failures(self):
+        return int(self._device.status('heartbeat_failures'))
+
+    @property
+    def heartbeat_error(self):
+        return self._device.error if self.heartbeat_failures else None
+
+    @property
+    def armed(self):
+        self._device.call(QUERY_ARMED)
+        return bool(self._device.status('armed'))
+
+    @property
+    def ready(self):
+        self._device.call(QUERY_READY)
+        return bool(self._device.status('ready'))
+
+
+
+def _worker_main(shm_name, params, wake):
+    # The main loop of the worker process: initializes the devices, then runs
+    # commands from the ring until both devices have been closed
+    for name, value in params.items():
+        setattr(P, name, value)
+    shm = SharedMemory(name=shm_name)
+    state = _SharedState(shm)
+    status = state.status
+    try:
+        start = precise_time()
+        trigger = get_trigger_port()
+        status[_STATUS['trigger_init']] = precise_time() - start
+        start = precise_time()
+        tms = get_tms_controller()
+        status[_STATUS['tms_init']] = precise_time() - start
+    except Exception as e:
+        state.set_error(e)
+        status[_STATUS['state']] = FAILED
+        state.release()
+        shm.close()
+        return
+    status[_STATUS['state']] = RUNNING
+
+    open_devices = 2
+    header = state.header
+    pulses = _PulseResets(trigger)
+    while open_devices:
+        wake.wait(pulses.timeout(0.05))
+        wake.clear()
+        pulses.poll()
+        while header[1] < header[0]:
+            op, a, b, sent = state.commands[int(header[1]) % SLOTS]
+            try:
+                open_devices -= _run_command(int(op), a, b, sent, pulses, tms, status)
+            except Exception as e:
+                state.set_error(e)
+                status[_STATUS['errors']] += 1
+            header[1] += 1
+            pulses.poll()
+        status[_STATUS['heartbeat_rearms']] = tms.heartbeat_rearms
+        status[_STATUS['heartbeat_failures']] = tms.heartbeat_failures
+        if tms.heartbeat_error:
+            state.set_error(tms.heartbeat_error)
+
+    state.release()
+    shm.close()
+
+
+class _PulseResets(object):
+    # Writes trigger codes in the worker, scheduling the reset to 0 at the end
+    # of each trigger's duration instead of sleeping through it, so that other
+    # commands can run while a trigger is held
+
+    def __init__(self, trigger):
+        self.trigger = trigger
+        self.due = None
+
+    def write(self, value, duration=None):
+        # Finish any trigger still being held first, so that back-to-back
+        # triggers stay separate
+        self.finish()
+        self.trigger._write_trigger(value)
+        if duration is not None:
+            self.due = precise_time() + duration
+
+    def poll(self):
+        if self.due is not None and precise_time() >= self.due:
+            self.trigger._write_trigger(0)
+            self.due = None
+
+    def finish(self):
+        if self.due is not None:
+            remaining = self.due - precise_time()
+            if remaining > 0:
+                time.sleep(remaining)
+            self.poll()
+
+    def timeout(self, default):
+        # The time to wait for new commands before the next reset is due
+        if self.due is None:
+            return default
+        return min(default, max(0.0, self.due - precise_time()))
+
+
+def _run_command(op, a, b, sent, pulses, tms, status):
+    # Runs a single command in the worker, returning the number of devices
+    # closed by the command
+    if op == WRITE or op == TRIGGER:
+        pulses.write(int(a), b if op == TRIGGER else None)
+        status[_STATUS['trigger_latency']] = precise_time() - sent
+    elif op == SET_POWER:
+        tms.set_power(int(a))
+    elif op == ARM:
+        tms.arm()
+    elif op == DISARM:
+        tms.disarm()
+    elif op == FIRE:
+        tms.fire()
+    elif op == QUERY_ARMED:
+        status[_STATUS['armed']] = bool(tms.armed)
+    elif op == QUERY_READY:
+        status[_STATUS['ready']] = bool(tms.ready)
+    elif op == QUERY_POWER:
+        status[_STATUS['power']] = tms.get_power()
+    elif op == HEARTBEAT_START:
+        tms.start_heartbeat(a)
+    elif op == HEARTBEAT_STOP:
+        tms.stop_heartbeat()
+    elif op == HEARTBEAT_PAUSE:
+        tms.pause_heartbeat()
+    elif op == HEARTBEAT_RESUME:
+        tms.resume_heartbeat()
+    elif op == CLOSE_TRIGGER:
+        pulses.finish()
+        pulses.trigger.close()
+        return 1
+    elif op == CLOSE_TMS:
+        tms.close()
+        return 1
+    return 0
+
+
+
+def benchmark(trigger, worker=None, writes=200, loop_secs=2.0):
+    """Measures trigger latency and response loop jitter for a trigger port.
+
+    Trigger latency is the time from requesting a write until it happens. For
+    an in-process port, this is the duration of the write call. For a worker
+    port, it is the time from queueing the command until the worker writes
+    it. Loop jitter is measured for a busy loop that sends a trigger every
+    100 ms, like the task's response loop. Only codes of 0 are ever written.
+
+    Args:
+        trigger (:obj:`TriggerPort`): The trigger port to benchmark.
+        worker (:obj:`DeviceWorker`, optional): The device worker, if the
+            port is a worker port.
+        writes (int, optional): The number of writes to time. Defaults to 200.
+        loop_secs (float, optional): The duration (in seconds) of the loop
+            jitter test. Defaults to 2 seconds.
+
+    Returns:
+        dict: The median and max trigger latency, and the median, 99th
+        percentile and max loop period, all in milliseconds.
+
+    """
+    latencies = np.zeros(writes)
+    for i in range(writes):
+        if worker:
+            worker.wait_for(worker.command(WRITE, 0))
+            latencies[i] = worker.status('trigger_latency')
+        else:
+            start = precise_time()
+            trigger._write_trigger(0)
+            latencies[i] = precise_time() - start
+
+    trigger.add_code('benchmark', 0)
+    timer = LoopTimer()
+    timer.start()
+    end = precise_time() + loop_secs
+    next_trigger = precise_time()
+    while precise_time() < end:
+        timer.tick()
+        if precise_time() >= next_trigger:
+            trigger.send('benchmark')
+            next_trigger += 0.1
+    timer.stop()
+    return {
+        'latency_median': np.median(latencies) * 1000,
+        'latency_max': latencies.max() * 1000,
+        'loop_median': timer.percentile(50) * 1000,
+        'loop_99': timer.percentile(99) * 1000,
+        'loop_max': timer.max_period * 1000,
+    }
+
+
+def main(args):
+    # Compares trigger latency and loop jitter between the in-process and
+    # worker process modes, using the devices configured in the task params
+    params = os.path.join(os.path.dirname(__file__), "..", "..", "Config", "HLJT_params.py")
+    for name, value in runpy.run_path(params).items():
+        if name in WORKER_PARAMS:
+            setattr(P, name, value)
+
+    txt = (
+        "{0}: trigger latency median {1:.3f} ms (max {2:.3f} ms), loop period "
+        "median {3:.3f} ms, 99% {4:.3f} ms, max {5:.3f} ms"
+    )
+    trigger = get_trigger_port()
+    r = benchmark(trigger)
+    trigger.close()
+    print(txt.format("In-process", r['latency_median'], r['latency_max'],
+        r['loop_median'], r['loop_99'], r['loop_max']))
+
+    worker = DeviceWorker(timeout=10.0)
+    trigger, tms = worker.wait()
+    r = benchmark(trigger, worker)
+    tms.close()
+    trigger.close()
+    print(txt.format("Worker process", r['latency_median'], r['latency_max'],
+        r['loop_median'], r['loop_99'], r['loop_max']))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,558 @@
+import os
+import threading
+from collections import deque
+
+import numpy as np
+
+from klibs import P
+
+from clock import get_clock
+from signalfile import SignalWriter, SignalFile
+
+# Background EMG acquisition for the experiment. Samples are read from a
+# stream source (a LabJack U3 or a virtual generator) on a background thread
+# into a preallocated ring buffer, which a second thread drains to a
+# memory-mapped signal file on disk (see signalfile.py). Nothing here ever
+# blocks the trial loop.
+
+
+U3_DIGITAL_STATE = 193 # Special U3 stream channel for FIO/EIO digital states
+
+
+def get_emg_recorder(trigger, path, virtual=False):
+    """Retrieves an EMGRecorder for the current trigger port hardware.
+
+    If the trigger port is a LabJack U3, EMG will be streamed from the analog
+    inputs listed in ``P.emg_channels``. Otherwise, a virtual stream of
+    simulated EMG will be used, but only if explicitly requested (either with
+    ``virtual`` or ``P.emg_virtual``).
+
+    Args:
+        trigger (:obj:`TriggerPort`): The trigger port for the experiment.
+        path (str): The path of the file to write the raw EMG data to.
+        virtual (bool, optional): If True, simulated EMG will be used when no
+            EMG hardware is available. Defaults to False.
+
+    Returns:
+        :obj:`EMGRecorder`: An EMG recorder for the available hardware.
+
+    Raises:
+        RuntimeError: If no EMG hardware is available and simulated EMG was
+            not requested.
+
+    """
+    from communication import U3Port
+    if isinstance(trigger, U3Port):
+        src = U3StreamSource(trigger, P.emg_channels, P.emg_sample_rate)
+    elif virtual or P.emg_virtual:
+        print("\nNOTE: No EMG hardware, using virtual EMG stream...\n")
+        src = VirtualStreamSource(len(P.emg_channels), P.emg_sample_rate)
+    else:
+        e = ("EMG recording requires a LabJack U3 trigger port (set "
+             "'emg_virtual = True' to use simulated EMG for testing).")
+        raise RuntimeError(e)
+    return EMGRecorder(src, path, buffer_secs=P.emg_buffer_secs)
+
+
+
+class RingBuffer(object):
+    """A preallocated single-producer, single-consumer sample ring buffer.
+
+    One thread may write to the buffer while another reads from it without
+    any locking: the writer only ever advances the write count and the reader
+    only ever advances the read count, so each side only modifies its own
+    counter. If the buffer is full, new samples are dropped rather than
+    blocking the writer, with the position and length of each drop recorded
+    in ``gaps`` so that the reader can keep later samples aligned.
+
+    Args:
+        size (int): The capacity of the buffer (in samples).
+        channels (int): The number of channels per sample.
+        dtype (optional): The data type of the buffer. Defaults to float32.
+
+    """
+    def __init__(self, size, channels, dtype=np.float32):
+        self._data = np.zeros((size, channels), dtype=dtype)
+        self.size = size
+        self.written = 0
+        self.read = 0
+        self.dropped = 0
+        self.gaps = deque()
+
+    @property
+    def available(self):
+        """int: The number of samples waiting to be read from the buffer.
+        """
+        return self.written - self.read
+
+    def write(self, samples):
+        """Writes a chunk of samples to the buffer.
+
+        Args:
+            samples (:obj:`numpy.ndarray`): A 2-D array of samples, with one
+                row per sample and one column per channel.
+
+        Returns:
+            int: The number of samples written (0 if the buffer was full).
+
+        """
+        n = samples.shape[0]
+        if n > self.size - self.available:
+            self.gaps.append((self.written, n))
+            self.dropped += n
+            return 0
+        start = self.written % self.size
+        first = min(n, self.size - start)
+        self._data[start:start + first] = samples[:first]
+        self._data[:n - first] = samples[first:]
+        self.written += n
+        return n
+
+    def peek(self, n=None):
+        """Gets the oldest unread samples in the buffer without consuming them.
+
+        To avoid copying, up to two array views are returned: if the unread
+        samples wrap around the end of the buffer, the second view contains
+        the wrapped portion.
+
+        Args:
+            n (int, optional): The maximum number of samples to get. Defaults
+                to all unread samples.
+
+        Returns:
+            list: A list of one or two array views of the unread samples.
+
+        """
+        avail = self.available
+        n = avail if n is None else min(n, avail)
+        start = self.read % self.size
+        first = min(n, self.size - start)
+        views = [self._data[start:start + first]]
+        if n > first:
+            views.append(self._data[:n - first])
+        return views
+
+    def consume(self, n):
+        """Marks a number of samples as read, freeing up space in the buffer.
+
+        Args:
+            n (int): The number of samples to mark as read.
+
+        """
+        self.read += min(n, self.available)
+
+
+
+class StreamSource(object):
+    """A base class for sources of streamed analog samples.
+
+    Args:
+        channels (int): The number of analog channels in the stream.
+        rate (int): The sampling rate (in Hz) of the stream.
+
+    """
+    def __init__(self, channels, rate):
+        self.channels = channels
+        self.rate = rate
+
+    @property
+    def records_triggers(self):
+        """bool: True if the source records trigger codes in hardware.
+        """
+        return False
+
+    def start(self):
+        """Starts streaming samples from the source.
+
+        """
+        pass
+
+    def read(self):
+        """Reads the next chunk of samples from the source.
+
+        Blocks until a chunk is available.
+
+        Returns:
+            tuple: A 2-D array of samples (one column per channel), and an
+            array of the trigger code present during each sample (or None if
+            the source does not record triggers).
+
+        """
+        e = "StreamSources must have a defined 'read' method"
+        raise NotImplementedError(e)
+
+    def stop(self):
+        """Stops streaming samples from the source.
+
+        """
+        pass
+
+
+class U3StreamSource(StreamSource):
+    """A StreamSource for the analog inputs of a LabJack U3.
+
+    The digital state of the trigger port is streamed alongside the analog
+    inputs, so that the onset of each trigger code is known to the exact
+    sample.
+
+    Args:
+        port (:obj:`U3Port`): The U3 trigger port to stream from.
+        ain (list): The analog input numbers (e.g. ``[8, 9]``) to stream. Must
+            not be on the port used for trigger outputs.
+        rate (int): The sampling rate (in Hz) for each channel.
+
+    Raises:
+        ValueError: If any of the inputs can't be used for EMG.
+
+    """
+    def __init__(self, port, ain, rate):
+        super(U3StreamSource, self).__init__(len(ain), rate)
+        port.configure_inputs(ain, analog=True)
+        self._device = port._device
+        self._lock = port._lock
+        self._ain = list(ain)
+        self._trigger_shift = 8 if P.labjack_port == 'EIO' else 0
+        self._stream = None
+
+    @property
+    def records_triggers(self):
+        # CIO states are not available in the digital stream channel
+        return P.labjack_port != 'CIO'
+
+    def start(self):
+        chans = self._ain
+        if self.records_triggers:
+            chans = chans + [U3_DIGITAL_STATE]
+        with self._lock:
+            self._device.streamConfig(
+                NumChannels=len(chans), PChannels=chans, NChannels=[31] * len(chans),
+                Resolution=3, ScanFrequency=self.rate,
+            )
+            self._device.streamStart()
+        self._stream = self._device.streamData()
+
+    def read(self):
+        # Stream reads don't hold the device lock, since each one blocks until
+        # a full request of packets has arrived and the U3 handles stream data
+        # and trigger writes (feedback/register commands) concurrently
+        while True:
+            packet = next(self._stream)
+            if packet is not None:
+                break
+        if packet['errors'] or packet['missed']:
+            print("Warning: LabJack stream missed {0} samples".format(packet['missed']))
+        data = [packet["AIN{0}".format(ain)] for ain in self._ain]
+        samples = np.asarray(data, dtype=np.float32).T
+        codes = None
+        if self.records_triggers:
+            states = packet["AIN{0}".format(U3_DIGITAL_STATE)]
+            if len(states) and isinstance(states[0], tuple):
+                # Depending on version, LabJackPython gives (FIO, EIO) tuples
+                states = [fio + (eio << 8) for fio, eio in states]
+            codes = (np.asarray(states, dtype=np.int32) >> self._trigger_shift) & 0xFF
+        return (samples, codes)
+
+    def stop(self):
+        with self._lock:
+            self._device.streamStop()
+        self._stream = None
+
+
+class VirtualStreamSource(StreamSource):
+    """A StreamSource that generates simulated EMG.
+
+    Generates Gaussian background noise paced by the experiment clock, so that
+    it keeps up with accelerated virtual clocks. Simulated responses (e.g.
+    MEPs) can be added to the stream with :meth:`inject`.
+
+    Args:
+        channels (int): The number of channels to simulate.
+        rate (int): The sampling rate (in Hz) of the stream.
+        noise (float, optional): The standard deviation of the background
+            noise (in volts). Defaults to 2 uV, typical of resting muscle.
+        chunk (float, optional): The duration (in seconds) of each chunk of
+            generated samples. Defaults to 10 ms.
+        seed (int, optional): The seed for the random noise generator.
+
+    """
+    def __init__(self, channels, rate, noise=2e-6, chunk=0.01, seed=None):
+        super(VirtualStreamSource, self).__init__(channels, rate)
+        self.noise = noise
+        self._chunk = max(1, int(round(chunk * rate)))
+        self._rng = np.random.default_rng(seed)
+        self._pending = deque()
+        self._clock = None
+        self._start = None
+        self._generated = 0
+
+    def start(self):
+        self._clock = get_clock()
+        self._start = self._clock.time()
+        self._generated = 0
+
+    def inject(self, waveform, delay=0):
+        """Adds a waveform to the stream a given number of samples from now.
+
+        Args:
+            waveform (:obj:`numpy.ndarray`): The waveform to add to the stream,
+                either 1-D (added to all channels) or 2-D (one column per
+                channel).
+            delay (int, optional): The number of samples to wait from the
+                current time before the waveform starts. Defaults to 0.
+
+        """
+        now = int((self._clock.time() - self._start) * self.rate)
+        self._pending.append((now + delay, np.asarray(waveform, dtype=np.float32)))
+
+    def read(self):
+        # Wait until enough time has passed for the next chunk of samples. If
+        # the clock has skipped ahead, catch up in chunks of up to 1 second.
+        due = int((self._clock.time() - self._start) * self.rate)
+        n = min(max(self._chunk, due - self._generated), self.rate)
+        wait = self._start + (self._generated + n) / float(self.rate) - self._clock.time()
+        if wait > 0:
+            self._clock.sleep(wait)
+        samples = self._rng.normal(0, self.noise, (n, self.channels))
+        samples = samples.astype(np.float32)
+        # Add any injected waveforms that overlap with this chunk
+        first, last = self._generated, self._generated + n
+        keep = deque()
+        while self._pending:
+            onset, wave = self._pending.popleft()
+            offset = onset - first
+            end = offset + wave.shape[0]
+            if offset < n and end > 0:
+                lo, hi = max(0, offset), min(n, end)
+                seg = wave[lo - offset:hi - offset]
+                samples[lo:hi] += seg if seg.ndim == 2 else seg[:, None]
+            if end > n:
+                keep.append((onset, wave))
+        self._pending = keep
+        self._generated = last
+        return (samples, None)
+
+
+
+class EMGRecorder(object):
+    """Records a stream of EMG samples to disk in the background.
+
+    Samples are acquired on one background thread into a ring buffer and
+    written to a memory-mapped signal file in chunks on another, so that
+    neither hardware reads nor disk writes can hold up the trial loop. The
+    onset of each trigger code and the start and end of each trial are
+    recorded as sample indices in the signal file's index.
+
+    Args:
+        source (:obj:`StreamSource`): The source of the EMG samples.
+        path (str): The path of the file to write the raw EMG data to.
+        buffer_secs (float, optional): The capacity of the ring buffer (in
+            seconds). Defaults to 10 seconds.
+        chunk_secs (float, optional): The minimum amount of data (in seconds)
+            to write to disk at a time. Defaults to 0.5 seconds.
+
+    """
+    def __init__(self, source, path, buffer_secs=10.0, chunk_secs=0.5):
+        self.source = source
+        self.path = path
+        self.rate = source.rate
+        self.markers = []
+        self._buffer = RingBuffer(int(buffer_secs * self.rate), source.channels)
+        self._chunk = max(1, int(chunk_secs * self.rate))
+        self._file = None
+        self._entries = deque()
+        self._last_code = 0
+        self._t0 = None
+        self._offset = 0
+        self._running = False
+        self._acquired = threading.Event()
+        self._data_ready = threading.Event()
+        self._synced = 0
+        self._synced_cond = threading.Condition()
+        self._acq_thread = None
+        self._write_thread = None
+
+    @property
+    def samples(self):
+        """int: The total number of samples acquired so far, including any
+        dropped samples.
+        """
+        return self._buffer.written + self._buffer.dropped
+
+    @property
+    def dropped(self):
+        """int: The number of samples dropped due to a full ring buffer. These
+        are written to disk as NaNs, so that later samples keep their indices.
+        """
+        return self._buffer.dropped
+
+    def start(self):
+        """Starts acquiring EMG in the background.
+
+        """
+        dirname = os.path.dirname(self.path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._file = SignalWriter(self.path, self.source.channels, self.rate)
+        # If resuming an existing recording, continue on from its last sample
+        self._offset = self._file.length
+        self._running = True
+        self._acquired.clear()
+        self.source.start()
+        self._t0 = get_clock().time()
+        self._acq_thread = threading.Thread(target=self._acquire, daemon=True)
+        self._write_thread = threading.Thread(target=self._write, daemon=True)
+        self._acq_thread.start()
+        self._write_thread.start()
+
+    def mark(self, code):
+        """Marks the onset of a trigger code in the EMG stream.
+
+        If the stream source records trigger codes in hardware, the onset is
+        already known to the sample and this does nothing. Otherwise, the
+        current sample index is estimated from the experiment clock.
+
+        Args:
+            code (int): The trigger code being sent.
+
+        """
+        if self.source.records_triggers or self._t0 is None:
+            return
+        self._add_marker(self._current_sample(), code)
+
+    def begin_trial(self, trial_id):
+        """Marks the start of a trial in the EMG stream.
+
+        Args:
+            trial_id (tuple): The (participant_id, session_num, block_num,
+                trial_num) identifying the trial.
+
+        """
+        self._entries.append(('trial', (trial_id, self._current_sample(), None)))
+
+    def end_trial(self, trial_id):
+        """Marks the end of a trial in the EMG stream.
+
+        Args:
+            trial_id (tuple): The (participant_id, session_num, block_num,
+                trial_num) identifying the trial.
+
+        """
+        self._entries.append(('trial', (trial_id, None, self._current_sample())))
+
+    def _current_sample(self):
+        # Estimates the index of the sample currently being acquired
+        return self._offset + int(round((get_clock().time() - self._t0) * self.rate))
+
+    def _add_marker(self, index, code):
+        self.markers.append((index, code))
+        self._entries.append(('event', (index, code)))
+
+    def stop(self):
+        """Stops acquiring EMG and writes any remaining samples to disk.
+
+        """
+        if not self._running:
+            return
+        self._running = False
+        self._acq_thread.join()
+        self.source.stop()
+        self._acquired.set()
+        self._data_ready.set()
+        self._write_thread.join()
+        self._file.close()
+
+    def read(self, start, end, timeout=2.0):
+        """Reads a range of samples once they have been written to disk.
+
+        Used for looking at the EMG for a pulse during recording (e.g. for
+        threshold estimation). Since samples are written in chunks, this may
+        need to wait up to ``chunk_secs`` after the last requested sample is
+        acquired.
+
+        Args:
+            start (int): The index of the first sample to read.
+            end (int): The index after the last sample to read.
+            timeout (float, optional): The maximum time (in seconds) to wait
+                for the samples to be written. Defaults to 2 seconds.
+
+        Returns:
+            :obj:`numpy.ndarray`: A copy of the requested samples, with one row
+            per sample and one column per channel.
+
+        Raises:
+            RuntimeError: If the samples were not written within the timeout.
+
+        """
+        with self._synced_cond:
+            written = self._synced_cond.wait_for(lambda: self._synced >= end, timeout)
+            length = self._synced
+        if not written:
+            raise RuntimeError("Timed out waiting for EMG samples to be written.")
+        shape = (length, self.source.channels)
+        data = np.memmap(self.path, self._file.dtype, 'r', shape=shape)
+        return np.array(data[max(0, start):end])
+
+    def load(self):
+        """Loads the recorded EMG from disk as a read-only memory-mapped array.
+
+        Should only be called after recording has been stopped.
+
+        Returns:
+            :obj:`numpy.ndarray`: The recorded samples, with one row per sample
+            and one column per channel.
+
+        """
+        return SignalFile(self.path).data
+
+    def _acquire(self):
+        while self._running:
+            samples, codes = self.source.read()
+            if codes is not None:
+                self._find_onsets(codes, self._offset + self.samples)
+            self._buffer.write(samples)
+            if self._buffer.available >= self._chunk:
+                self._data_ready.set()
+
+    def _find_onsets(self, codes, offset):
+        # Find the sample indices where the trigger code changes to non-zero
+        prev = np.concatenate(([self._last_code], codes[:-1]))
+        onsets = np.flatnonzero((codes != prev) & (codes != 0))
+        for i in onsets:
+            self._add_marker(offset + int(i), int(codes[i]))
+        self._last_code = codes[-1]
+
+    def _drain_buffer(self):
+        # Writes all buffered samples to disk, filling in any dropped samples
+        # with NaNs so that sample indices stay aligned with the stream
+        buf = self._buffer
+        while True:
+            while buf.gaps and buf.gaps[0][0] <= buf.read:
+                index, n = buf.gaps.popleft()
+                self._file.append(np.full((n, self.source.channels), np.nan, np.float32))
+            limit = buf.gaps[0][0] - buf.read if buf.gaps else None
+            views = buf.peek(limit)
+            if not views[0].shape[0]:
+                break
+            for view in views:
+                self._file.append(view)
+                buf.consume(view.shape[0])
+
+    def _write(self):
+        while True:
+            self._data_ready.wait(timeout=0.5)
+            self._data_ready.clear()
+            done = self._acquired.is_set()
+            self._drain_buffer()
+            while self._entries:
+                kind, args = self._entries.popleft()
+                if kind == 'event':
+                    self._file.add_event(*args)
+                else:
+                    self._file.add_trial(*args)
+            self._file.sync()
+            with self._synced_cond:
+                self._synced = self._file.length
+                self._synced_cond.notify_all()
+            if done:
+                break
+
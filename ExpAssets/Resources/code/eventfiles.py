@@ -0,0 +1,341 @@
+import os
+import re
+import sys
+import json
+import runpy
+import hashlib
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from signalfile import SignalFile, INDEX_EXT
+
+# Export of per-session events files for EMG/EEG analysis. Each session gets a
+# tab-separated file (in the style of BIDS events files) with one row per
+# trigger sent during the task, giving the trigger's code, its onset, and the
+# metadata of the trial it belongs to:
+#
+#   onset     duration  trial_type   value  sample  block_num  trial_num  hand ...
+#   12.3456   n/a       trial_start  2      61728   1          1          L    ...
+#   16.1234   n/a       fire_tms     17     80617   1          1          L    ...
+#
+# Onsets are taken from the session's EMG recording if there is one, in which
+# case they are in seconds from the start of the recording and the sample
+# column gives the exact sample of each marker. Otherwise, onsets are taken
+# from the session recording (see replay.py) if there is one, in seconds from
+# its first event. If neither exists, onsets are 'n/a'.
+#
+# Trial rows are streamed from the database straight to disk, so memory use
+# doesn't grow with the number of trials. Participants are exported in
+# parallel, and a small state file in the output folder keeps track of what
+# has been exported so that only sessions with new or changed trials (or EMG
+# recordings) get regenerated on later runs.
+
+
+COLUMNS = ['onset', 'duration', 'trial_type', 'value', 'sample']
+TRIAL_FIELDS = [
+    'block_num', 'trial_num', 'hand', 'sex', 'angle', 'rotation', 'tms_onset',
+    'judgement', 'rt', 'accuracy', 'tms_trial', 'tms_fired',
+]
+STATE_FILE = ".export_state.json"
+NA = "n/a"
+
+
+def _connect(db_path):
+    # Opens the database read-only, so exporting can never modify it
+    return sqlite3.connect("file:{0}?mode=ro".format(db_path), uri=True)
+
+
+def _emg_path(emg_dir, participant_id, session_num):
+    if not emg_dir:
+        return None
+    name = "p{0}_s{1}.emg".format(participant_id, session_num)
+    return os.path.join(emg_dir, name)
+
+
+def _recording_path(rec_dir, participant_id, session_num):
+    if not rec_dir:
+        return None
+    name = "p{0}_s{1}.jsonl".format(participant_id, session_num)
+    return os.path.join(rec_dir, name)
+
+
+def _stamp(path):
+    # Identifies the current version of a file, if it exists
+    if not path or not os.path.exists(path):
+        return None
+    info = os.stat(path)
+    return [info.st_mtime_ns, info.st_size]
+
+
+def _fmt(x):
+    return NA if x is None else str(x)
+
+
+class _EMGTiming(object):
+    # Looks up the sample onsets of trigger codes within each recorded trial
+
+    def __init__(self, path):
+        sig = SignalFile(path)
+        self.rate = sig.rate
+        self.trials = sig.trials
+        self.events = sig.events
+        sig.data = None
+
+    def onset(self, trial_id, code):
+        bounds = self.trials.get(trial_id, None)
+        if bounds is None or bounds[0] is None:
+            return None
+        start, end = bounds
+        samples = self.events[:, 0]
+        lo = np.searchsorted(samples, start, side='left')
+        hi = len(samples) if end is None else np.searchsorted(samples, end, side='right')
+        matches = np.flatnonzero(self.events[lo:hi, 1] == code)
+        if not len(matches):
+            return None
+        return int(samples[lo + matches[0]])
+
+
+class _RecordingTiming(object):
+    # Looks up the clock onsets of trigger codes within each recorded trial,
+    # reading the session recording one line at a time
+
+    def __init__(self, path):
+        self.trials = {}
+        pending = {}
+        t0 = None
+        with open(path, 'r') as f:
+            header = json.loads(f.readline())
+            if header.get('type') != 'header':
+                raise ValueError("'{0}' is not a session recording.".format(path))
+            for line in f:
+                if not line.strip():
+                    continue
+                e = json.loads(line)
+                if t0 is None:
+                    t0 = e['t']
+                if e['type'] == 'trigger':
+                    pending.setdefault(e['code'], e['t'] - t0)
+                elif e['type'] == 'trial':
+                    d = e['data']
+                    self.trials[(d['block_num'], d['trial_num'])] = pending
+                    pending = {}
+
+    def onset(self, trial_id, code):
+        return self.trials.get(trial_id[2:], {}).get(code, None)
+
+
+
+def session_fingerprints(db_path, emg_dir=None, rec_dir=None):
+    """Gets a fingerprint of the trial data for each session in a database.
+
+    A session's fingerprint changes whenever trials are added to, removed
+    from, or edited in it (using a checksum of the exported columns of its
+    trials), or when its EMG recording's index or session recording changes.
+
+    Args:
+        db_path (str): The path of the project database.
+        emg_dir (str, optional): The folder containing the EMG recordings.
+        rec_dir (str, optional): The folder containing the session recordings.
+
+    Returns:
+        dict: The fingerprint of each session, keyed by (participant_id,
+        session_num).
+
+    """
+    conn = _connect(db_path)
+    try:
+        # Stream the trials in a fixed order, updating the count, id range,
+        # and checksum of each session as its rows go by
+        rows = conn.execute(
+            "SELECT participant_id, session_num, id, {0} FROM trials "
+            "ORDER BY participant_id, session_num, id".format(", ".join(TRIAL_FIELDS))
+        )
+        sessions = {}
+        for row in rows:
+            info = sessions.get(row[:2], None)
+            if info is None:
+                info = sessions[row[:2]] = [0, row[2], row[2], hashlib.sha1()]
+            info[0] += 1
+            info[2] = row[2]
+            info[3].update(repr(row[2:]).encode('utf-8'))
+    finally:
+        conn.close()
+
+    prints = {}
+    for (pid, session), (count, first, last, checksum) in sessions.items():
+        emg = _emg_path(emg_dir, pid, session)
+        emg = _stamp(emg + INDEX_EXT) if emg else None
+        rec = _stamp(_recording_path(rec_dir, pid, session))
+        prints[(pid, session)] = [count, first, last, checksum.hexdigest(), emg, rec]
+    return prints
+
+
+def export_participant(db_path, out_dir, participant_id, sessions, codes,
+                       emg_dir=None, rec_dir=None):
+    """Writes the events files for the given sessions of a participant.
+
+    Args:
+        db_path (str): The path of the project database.
+        out_dir (str): The folder to write the events files to.
+        participant_id (int): The database ID of the participant.
+        sessions (list): The session numbers to export.
+        codes (dict): The trigger codes for 'trial_start' and 'fire_tms'.
+        emg_dir (str, optional): The folder containing the EMG recordings.
+        rec_dir (str, optional): The folder containing the session recordings.
+
+    Returns:
+        list: The (session_num, path) of each events file written.
+
+    """
+    conn = _connect(db_path)
+    written = []
+    try:
+        row = conn.execute(
+            "SELECT study_id FROM participants WHERE id = ?", (participant_id,)
+        ).fetchone()
+        sub = re.sub(r'[^A-Za-z0-9]', '', str(row[0])) if row else str(participant_id)
+        query = (
+            "SELECT {0} FROM trials WHERE participant_id = ? AND session_num = ? "
+            "ORDER BY block_num, trial_num"
+        ).format(", ".join(TRIAL_FIELDS))
+
+        for session in sessions:
+            timing = None
+            emg_path = _emg_path(emg_dir, participant_id, session)
+            rec_path = _recording_path(rec_dir, participant_id, session)
+            if emg_path and os.path.exists(emg_path + INDEX_EXT):
+                timing = _EMGTiming(emg_path)
+            elif rec_path and os.path.exists(rec_path):
+                timing = _RecordingTiming(rec_path)
+
+            name = "sub-{0}_ses-{1}_events.tsv".format(sub, session)
+            path = os.path.join(out_dir, name)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write("\t".join(COLUMNS + TRIAL_FIELDS) + "\n")
+                for trial in conn.execute(query, (participant_id, session)):
+                    trial_id = (participant_id, session, trial[0], trial[1])
+                    meta = "\t".join(_fmt(x) for x in trial)
+                    fired = trial[-1] in (1, '1', 'True', True)
+                    events = [('trial_start', codes['trial_start'])]
+                    if fired:
+                        events.append(('fire_tms', codes['fire_tms']))
+                    for trial_type, code in events:
+                        onset = timing.onset(trial_id, code) if timing else None
+                        sample = None
+                        if isinstance(timing, _EMGTiming) and onset is not None:
+                            sample = onset
+                            onset = sample / float(timing.rate)
+                        onset = NA if onset is None else "{0:.6f}".format(onset)
+                        cols = [onset, NA, trial_type, str(code), _fmt(sample)]
+                        f.write("\t".join(cols) + "\t" + meta + "\n")
+            os.replace(tmp_path, path)
+            written.append((session, path))
+    finally:
+        conn.close()
+    return written
+
+
+def export_events(db_path, out_dir, codes, emg_dir=None, rec_dir=None, jobs=None,
+                  force=False):
+    """Exports events files for all sessions with new or changed data.
+
+    Args:
+        db_path (str): The path of the project database.
+        out_dir (str): The folder to write the events files to.
+        codes (dict): The trigger codes for 'trial_start' and 'fire_tms'.
+        emg_dir (str, optional): The folder containing the EMG recordings.
+        rec_dir (str, optional): The folder containing the session recordings.
+        jobs (int, optional): The maximum number of participants to export
+            at once. Defaults to the number of CPUs.
+        force (bool, optional): If True, all sessions are exported regardless
+            of whether they've changed. Defaults to False.
+
+    Returns:
+        list: The paths of all events files written.
+
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    state_path = os.path.join(out_dir, STATE_FILE)
+    state = {}
+    if os.path.exists(state_path) and not force:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+
+    # Find all sessions that have changed since the last export
+    prints = session_fingerprints(db_path, emg_dir, rec_dir)
+    todo = {}
+    for (pid, session), fp in prints.items():
+        key = "{0}_{1}".format(pid, session)
+        if state.get(key, {}).get('fingerprint') != fp:
+            todo.setdefault(pid, []).append(session)
+        elif not os.path.exists(state[key]['path']):
+            todo.setdefault(pid, []).append(session)
+
+    # Export each participant's changed sessions in parallel
+    written = []
+    with ProcessPoolExecutor(jobs) as pool:
+        futures = {}
+        for pid, sessions in todo.items():
+            future = pool.submit(
+                export_participant, db_path, out_dir, pid, sorted(sessions), codes,
+                emg_dir, rec_dir
+            )
+            futures[future] = pid
+        for future in as_completed(futures):
+            pid = futures[future]
+            for session, path in future.result():
+                key = "{0}_{1}".format(pid, session)
+                state[key] = {'fingerprint': prints[(pid, session)], 'path': path}
+                written.append(path)
+
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, state_path)
+    return written
+
+
+
+def main(args):
+    usage = "Usage: python eventfiles.py [--force] [--jobs N] [<database> [<output_dir>]]"
+    force = '--force' in args
+    args = [a for a in args if a != '--force']
+    jobs = None
+    if '--jobs' in args:
+        i = args.index('--jobs')
+        try:
+            jobs = int(args[i + 1])
+        except (IndexError, ValueError):
+            print(usage)
+            return 1
+        args = args[:i] + args[i + 2:]
+    if len(args) > 2:
+        print(usage)
+        return 1
+
+    # Default to the project's database, data folders, and trigger codes
+    assets = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+    assets = os.path.normpath(assets)
+    params = runpy.run_path(os.path.join(assets, "Config", "HLJT_params.py"))
+    db_path = args[0] if args else os.path.join(assets, "HLJT.db")
+    out_dir = args[1] if len(args) > 1 else os.path.join(assets, "Data", "events")
+    emg_dir = os.path.join(assets, "Data", "emg")
+    rec_dir = os.path.join(assets, "Data", "recordings")
+
+    written = export_events(
+        db_path, out_dir, params['trigger_codes'], emg_dir, rec_dir, jobs=jobs,
+        force=force
+    )
+    for path in sorted(written):
+        print("Wrote {0}".format(path))
+    if not written:
+        print("All events files are up to date.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
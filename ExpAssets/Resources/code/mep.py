@@ -0,0 +1,137 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Vectorized extraction of motor evoked potential (MEP) features from raw EMG.
+# All pulse windows for a session are taken from a single sliding-window view
+# of the EMG stream, so features for every pulse are computed in one pass.
+
+
+def align_pulses(markers, trials, pulse_code):
+    """Matches each TMS pulse in an EMG stream to the trial it occurred in.
+
+    Each pulse is assigned to the trial whose recorded start and end samples
+    contain it, so a missing or extra marker can only affect the trial it
+    belongs to. If a trial contains more than one pulse, only the first is
+    used.
+
+    Args:
+        markers (list): A list of ``(sample, code)`` tuples for each trigger
+            onset in the stream.
+        trials (dict): The ``[start, end]`` sample indices of each trial,
+            keyed by trial ID (e.g. :attr:`SignalFile.trials`). Trials with no
+            recorded end are treated as lasting until the next trial starts.
+        pulse_code (int): The trigger code marking each TMS pulse.
+
+    Returns:
+        tuple: A list of the trial IDs for each pulse, and an array of the
+        sample indices of each pulse. Pulses outside of any trial are dropped.
+
+    """
+    markers = np.asarray(markers, dtype=np.int64).reshape(-1, 2)
+    pulses = np.sort(markers[markers[:, 1] == pulse_code, 0])
+    bounds = sorted(
+        (start, end, trial_id) for trial_id, (start, end) in trials.items()
+        if start is not None
+    )
+    if not bounds or not len(pulses):
+        return ([], np.zeros(0, dtype=np.int64))
+    starts = np.asarray([b[0] for b in bounds], dtype=np.int64)
+    ends = np.asarray([
+        b[1] if b[1] is not None else np.iinfo(np.int64).max for b in bounds
+    ], dtype=np.int64)
+    ends[:-1] = np.minimum(ends[:-1], starts[1:])
+
+    # Find the trial that started most recently before each pulse, and keep
+    # the first pulse within each trial's bounds
+    idx = np.searchsorted(starts, pulses, side='right') - 1
+    inside = idx >= 0
+    inside[inside] = pulses[inside] < ends[idx[inside]]
+    idx, pulses = idx[inside], pulses[inside]
+    first = np.concatenate(([True], idx[1:] != idx[:-1]))
+    return ([bounds[i][2] for i in idx[first]], pulses[first])
+
+
+def extract_meps(samples, onsets, rate, window=(0.015, 0.06),
+                 baseline=(-0.1, -0.005), threshold=5.0, max_rms=None):
+    """Computes MEP features for a set of TMS pulses.
+
+    For each pulse, the peak-to-peak amplitude of the EMG is measured within
+    the response window, and the root-mean-square (RMS) of the EMG is measured
+    within the pre-stimulus baseline window. MEP latency is the time of the
+    first sample in the response window that deviates from the baseline mean
+    by more than ``threshold`` times the baseline RMS.
+
+    Args:
+        samples (:obj:`numpy.ndarray`): The raw EMG, either 1-D or 2-D with one
+            column per channel. Can be a memory-mapped array.
+        onsets (:obj:`numpy.ndarray`): The sample indices of each pulse.
+        rate (int): The sampling rate (in Hz) of the EMG.
+        window (tuple, optional): The start and end (in seconds, relative to
+            the pulse) of the MEP response window. Defaults to 15-60 ms.
+        baseline (tuple, optional): The start and end (in seconds, relative to
+            the pulse) of the pre-stimulus window. Defaults to -100 to -5 ms.
+        threshold (float, optional): The number of baseline RMS deviations
+            required for MEP onset. Defaults to 5.
+        max_rms (float, optional): The maximum pre-stimulus RMS for a pulse to
+            be accepted. Pulses with more background muscle activity than this
+            are marked as rejected. Defaults to no rejection.
+
+    Returns:
+        dict: A dict of arrays with one row per pulse and one column per
+        channel: 'amplitude' (peak-to-peak), 'latency' (in ms, NaN if no MEP
+        onset), 'pre_rms', and 'rejected'. Pulses whose windows fall outside
+        the recording have NaN for all features and are marked as rejected,
+        as are pulses with any dropped (NaN) samples in their windows.
+
+    """
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    onsets = np.asarray(onsets, dtype=np.int64)
+    n_pulses, n_chans = len(onsets), samples.shape[1]
+
+    # Convert the windows into sample offsets relative to each pulse
+    w_start, w_end = [int(round(t * rate)) for t in window]
+    b_start, b_end = [int(round(t * rate)) for t in baseline]
+    first, last = min(w_start, b_start), max(w_end, b_end)
+    span = last - first
+
+    # Only pulses with a complete window can be measured
+    starts = onsets + first
+    valid = (starts >= 0) & (starts + span <= samples.shape[0])
+
+    out = {
+        'amplitude': np.full((n_pulses, n_chans), np.nan),
+        'latency': np.full((n_pulses, n_chans), np.nan),
+        'pre_rms': np.full((n_pulses, n_chans), np.nan),
+        'rejected': np.ones((n_pulses, n_chans), dtype=bool),
+    }
+    if not valid.any() or span <= 0:
+        return out
+
+    # Take a windowed view of the stream (shape: samples, channels, span) and
+    # gather the window for each pulse from it
+    view = sliding_window_view(samples, span, axis=0)
+    epochs = view[starts[valid]].astype(np.float64)
+    pre = epochs[:, :, (b_start - first):(b_end - first)]
+    resp = epochs[:, :, (w_start - first):(w_end - first)]
+
+    # Compute the baseline and MEP features for all pulses at once
+    pre_mean = pre.mean(axis=2)
+    pre_rms = np.sqrt(np.mean((pre - pre_mean[:, :, None]) ** 2, axis=2))
+    amplitude = resp.max(axis=2) - resp.min(axis=2)
+    deviation = np.abs(resp - pre_mean[:, :, None])
+    crossed = deviation > (threshold * pre_rms)[:, :, None]
+    has_onset = crossed.any(axis=2)
+    onset_idx = np.argmax(crossed, axis=2)
+    latency = np.where(has_onset, (onset_idx + w_start) * 1000.0 / rate, np.nan)
+
+    # Reject pulses with dropped (NaN) samples in their windows
+    rejected = np.isnan(amplitude) | np.isnan(pre_rms)
+    if max_rms is not None:
+        rejected |= pre_rms > max_rms
+
+    out['amplitude'][valid] = amplitude
+    out['latency'][valid] = latency
+    out['pre_rms'][valid] = pre_rms
+    out['rejected'][valid] = rejected
+    return out
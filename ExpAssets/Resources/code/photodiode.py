@@ -0,0 +1,260 @@
+import os
+import json
+import socket
+
+import numpy as np
+
+from klibs import P
+
+from clock import get_clock
+
+# Display latency calibration using a photodiode. Test patches are flashed on
+# the screen and the time from each flip() returning to the photodiode seeing
+# the change is measured, giving the delay between when the task thinks a
+# stimulus is shown and when it actually appears. The median of these delays
+# is stored per station and used to correct response times and pulse onsets.
+
+
+def get_photodiode(trigger):
+    """Retrieves a Photodiode for the current trigger port hardware.
+
+    If the trigger port is a LabJack U3, the photodiode will be read from the
+    input given by ``P.photodiode_channel``. Otherwise, a simulated photodiode
+    will be used.
+
+    Args:
+        trigger (:obj:`TriggerPort`): The trigger port for the experiment.
+
+    Returns:
+        :obj:`Photodiode`: A photodiode for the available hardware.
+
+    """
+    from communication import U3Port
+    if isinstance(trigger, U3Port):
+        return U3Photodiode(
+            trigger, P.photodiode_channel, P.photodiode_digital, P.photodiode_threshold
+        )
+    print("\nNOTE: No photodiode hardware, using simulated photodiode...\n")
+    return VirtualPhotodiode()
+
+
+
+class Photodiode(object):
+    """A base class for photodiodes pointed at the screen.
+
+    """
+    def screen_changed(self, lit):
+        """Notifies the photodiode that the screen under it has just changed.
+
+        Only used by simulated photodiodes, which have no way of seeing the
+        screen.
+
+        Args:
+            lit (bool): Whether the screen under the photodiode is now lit.
+
+        """
+        pass
+
+    def lit(self):
+        """Checks whether the photodiode currently sees a lit screen.
+
+        Returns:
+            bool: True if the screen under the photodiode is lit.
+
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """Releases any hardware used by the photodiode.
+
+        """
+        pass
+
+
+class U3Photodiode(Photodiode):
+    """A photodiode connected to an input of a LabJack U3.
+
+    Analog photodiodes are read from an analog input and compared against a
+    voltage threshold, while digital ones (i.e. with a built-in comparator)
+    are read from a FIO/EIO/CIO pin. Each read takes one USB round trip
+    (~1 ms), which limits the resolution of latency measurements.
+
+    Note that analog inputs can't be read while the U3 is streaming EMG, so
+    calibration must happen before recording starts.
+
+    Args:
+        port (:obj:`U3Port`): The U3 trigger port the photodiode is wired to.
+        channel (int): The analog input (e.g. 9 for AIN9) or digital pin
+            (e.g. 9 for EIO1) of the photodiode. Can't be one of the trigger
+            output pins.
+        digital (bool, optional): Whether the photodiode is digital. Defaults
+            to False.
+        threshold (float, optional): The voltage above which an analog
+            photodiode counts as lit. Defaults to 0.5 V.
+
+    Raises:
+        ValueError: If the channel can't be used as an input (see
+            :meth:`U3Port.configure_inputs`).
+
+    """
+    def __init__(self, port, channel, digital=False, threshold=0.5):
+        port.configure_inputs([channel], analog=not digital)
+        self._device = port._device
+        self._lock = port._lock
+        self._channel = channel
+        self._digital = digital
+        self._threshold = threshold
+
+    def lit(self):
+        with self._lock:
+            if self._digital:
+                return bool(self._device.getDIState(self._channel))
+            return self._device.getAIN(self._channel) > self._threshold
+
+
+class VirtualPhotodiode(Photodiode):
+    """A simulated photodiode for testing.
+
+    Each change of the screen is 'seen' after a random delay drawn from a
+    normal distribution, paced by the experiment clock.
+
+    Args:
+        latency (float, optional): The mean simulated display latency (in
+            seconds). Defaults to 25 ms.
+        jitter (float, optional): The standard deviation of the simulated
+            latency (in seconds). Defaults to 2 ms.
+        seed (int, optional): The seed for the random latency generator.
+
+    """
+    def __init__(self, latency=0.025, jitter=0.002, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self._rng = np.random.default_rng(seed)
+        self._clock = get_clock()
+        self._state = False
+        self._target = False
+        self._change_at = 0.0
+
+    def screen_changed(self, lit):
+        self._state = self.lit()
+        self._target = lit
+        delay = max(0.0, self._rng.normal(self.latency, self.jitter))
+        self._change_at = self._clock.time() + delay
+
+    def lit(self):
+        if self._clock.time() >= self._change_at:
+            self._state = self._target
+        return self._state
+
+
+
+def measure_latency(photodiode, show, flashes=50, timeout=0.5, interval=0.1):
+    """Measures the delay between flipping the screen and it changing.
+
+    For each flash, the screen under the photodiode is cleared, and once the
+    photodiode sees it go dark a test patch is shown and the photodiode is
+    polled until it sees the patch.
+
+    Args:
+        photodiode (:obj:`Photodiode`): The photodiode pointed at the patch.
+        show (callable): A function that takes a single bool argument, draws
+            the screen with (True) or without (False) the test patch, and
+            flips it.
+        flashes (int, optional): The number of flashes to measure. Defaults
+            to 50.
+        timeout (float, optional): The maximum time (in seconds) to wait for
+            the photodiode to see each change. Defaults to 0.5.
+        interval (float, optional): The time (in seconds) to wait between
+            the screen going dark and the next flash. Defaults to 0.1.
+
+    Returns:
+        dict: The median, mean, standard deviation, and 5th/95th percentiles
+        of the measured latencies (in milliseconds), along with the number of
+        flashes measured ('n') and missed ('missed').
+
+    """
+    clock = get_clock()
+    latencies = []
+    missed = 0
+    for i in range(flashes):
+        # Clear the patch and wait for the photodiode to see it go dark
+        show(False)
+        photodiode.screen_changed(False)
+        cleared = clock.countdown(timeout)
+        while photodiode.lit() and cleared.counting():
+            pass
+        clock.sleep(interval)
+
+        # Show the patch and time how long until the photodiode sees it
+        show(True)
+        shown = clock.time()
+        photodiode.screen_changed(True)
+        while True:
+            now = clock.time()
+            if photodiode.lit():
+                latencies.append(now - shown)
+                break
+            elif now - shown > timeout:
+                missed += 1
+                break
+    show(False)
+
+    ms = np.asarray(latencies) * 1000
+    stats = {'n': len(latencies), 'missed': missed}
+    if len(ms):
+        stats.update({
+            'median': float(np.median(ms)), 'mean': float(ms.mean()),
+            'sd': float(ms.std()), 'p5': float(np.percentile(ms, 5)),
+            'p95': float(np.percentile(ms, 95)),
+        })
+    return stats
+
+
+def load_display_latency(path, station=None):
+    """Loads the display latency correction for a station.
+
+    Args:
+        path (str): The path of the display latency file.
+        station (str, optional): The name of the station. Defaults to the
+            hostname of the current computer.
+
+    Returns:
+        float: The display latency (in seconds) for the station, or None if
+        the station hasn't been calibrated.
+
+    """
+    station = station if station else socket.gethostname()
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        stations = json.load(f)
+    if station not in stations:
+        return None
+    return stations[station]['median'] / 1000.0
+
+
+def save_display_latency(path, stats, station=None):
+    """Saves the display latency measurements for a station.
+
+    Any existing measurements for other stations in the file are kept.
+
+    Args:
+        path (str): The path of the display latency file.
+        stats (dict): The latency measurements from :func:`measure_latency`.
+        station (str, optional): The name of the station. Defaults to the
+            hostname of the current computer.
+
+    """
+    station = station if station else socket.gethostname()
+    stations = {}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            stations = json.load(f)
+    stations[station] = stats
+    out_dir = os.path.dirname(path)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(stations, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
@@ -0,0 +1,141 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from klibs.KLTime import precise_time
+
+# A simple prefetch stage for preparing trials in the background, so that work
+# that would otherwise happen in trial_prep (e.g. building stimulus surfaces or
+# querying hardware) can overlap with the fixation and response periods of the
+# current trial.
+
+
+class Prefetcher(object):
+    """Runs trial preparation tasks on a background thread.
+
+    Each task is submitted with a key, and its result is later retrieved with
+    :meth:`take`. Tasks run one at a time in the order they are submitted, so
+    tasks that use the same hardware will never run concurrently with each
+    other (though callers must still avoid using that hardware on the main
+    thread until the task's result has been taken).
+
+    Hit/miss counts and timing are recorded for all retrievals: a 'hit' is a
+    task that was already finished when taken (saving its full run time), and
+    a 'miss' is one that was still pending (requiring a wait) or was never
+    submitted (requiring the work to be done in place).
+
+    """
+    def __init__(self):
+        self._pool = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._tasks = {}
+        self.hits = 0
+        self.misses = 0
+        self.saved = 0.0
+        self.waited = 0.0
+
+    def _timed(self, func, args):
+        start = precise_time()
+        result = func(*args)
+        return (result, precise_time() - start)
+
+    def submit(self, key, func, *args):
+        """Submits a task to run in the background.
+
+        If a task with the same key is already pending, it is replaced.
+
+        Args:
+            key: A hashable key for retrieving the result of the task.
+            func (callable): The function to run.
+            *args: Arguments to pass to the function.
+
+        """
+        future = self._pool.submit(self._timed, func, args)
+        with self._lock:
+            self._tasks[key] = future
+
+    def pending(self, key):
+        """Checks whether a task has been submitted but not yet taken.
+
+        Args:
+            key: The key of the task.
+
+        Returns:
+            bool: True if the task has been submitted and not taken.
+
+        """
+        with self._lock:
+            return key in self._tasks
+
+    def discard(self, key):
+        """Discards a submitted task, waiting for it to finish if running.
+
+        Used when the result of a task is no longer valid (e.g. a hardware
+        status that has since changed).
+
+        Args:
+            key: The key of the task.
+
+        """
+        with self._lock:
+            future = self._tasks.pop(key, None)
+        if future and not future.cancel():
+            future.result()
+
+    def take(self, key, fallback=None, keep=False):
+        """Retrieves the result of a submitted task.
+
+        If the task is still running, this will wait for it to finish. If no
+        task with the given key was submitted, the fallback function is called
+        in its place.
+
+        Args:
+            key: The key of the task.
+            fallback (callable, optional): A function that performs the task
+                synchronously, to use if the task was never submitted.
+            keep (bool, optional): If True, the result is kept so it can be
+                taken again (e.g. for cached stimuli). Defaults to False.
+
+        Returns:
+            The result of the task or fallback function.
+
+        """
+        with self._lock:
+            if keep:
+                future = self._tasks.get(key, None)
+            else:
+                future = self._tasks.pop(key, None)
+        if future is None:
+            self.misses += 1
+            return fallback() if fallback else None
+
+        if future.done():
+            result, duration = future.result()
+            self.hits += 1
+            self.saved += duration
+        else:
+            wait_start = precise_time()
+            result, duration = future.result()
+            wait = precise_time() - wait_start
+            self.misses += 1
+            self.waited += wait
+            self.saved += max(0.0, duration - wait)
+        return result
+
+    def summary(self):
+        """Gets a summary of the prefetch hit rate and time saved.
+
+        Returns:
+            str: A human-readable summary of the prefetch statistics.
+
+        """
+        total = self.hits + self.misses
+        txt = "Prefetch: {0}/{1} hits, {2:.1f} ms saved, {3:.1f} ms waited on misses"
+        return txt.format(self.hits, total, self.saved * 1000, self.waited * 1000)
+
+    def close(self):
+        """Waits for all pending tasks to finish and shuts down the worker.
+
+        """
+        self._pool.shutdown(wait=True)
+        with self._lock:
+            self._tasks = {}
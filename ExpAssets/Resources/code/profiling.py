@@ -0,0 +1,169 @@
+import json
+import threading
+import functools
+
+from klibs.KLTime import precise_time
+
+# Lightweight span-based profiling for the task. When tracing is enabled, each
+# traced function call or code block is recorded as a span with its thread and
+# start/end times, and the spans can be written out as a Chrome trace file for
+# viewing in chrome://tracing or https://ui.perfetto.dev.
+#
+# When tracing is disabled, traced calls only cost a couple of timer reads.
+
+
+class Tracer(object):
+    """Records timed spans and writes them in the Chrome trace event format.
+
+    All span times in the trace are relative to when the tracer was created.
+
+    """
+    def __init__(self):
+        self.enabled = False
+        self._spans = []
+        self._threads = {}
+        self._origin = precise_time()
+
+    def start(self):
+        """Starts recording spans, discarding any previously recorded.
+
+        """
+        self._spans = []
+        self.enabled = True
+
+    def stop(self):
+        """Stops recording spans.
+
+        """
+        self.enabled = False
+
+    def add(self, name, cat, start, end, args=None):
+        """Records a completed span.
+
+        Args:
+            name (str): The name of the span.
+            cat (str): The category of the span (e.g. 'phase' or 'serial').
+            start (float): The start time of the span (from ``precise_time``).
+            end (float): The end time of the span (from ``precise_time``).
+            args (dict, optional): Extra info to attach to the span.
+
+        """
+        thread = threading.current_thread()
+        tid = thread.ident
+        if tid not in self._threads:
+            self._threads[tid] = thread.name
+        self._spans.append((name, cat, start, end, tid, args))
+
+    def span(self, name, cat='block', **args):
+        """Creates a context manager that records its body as a span.
+
+        Args:
+            name (str): The name of the span.
+            cat (str, optional): The category of the span. Defaults to 'block'.
+            **args: Extra info to attach to the span.
+
+        """
+        return _Span(self, name, cat, args)
+
+    def events(self):
+        """Gets all recorded spans as Chrome trace events.
+
+        Returns:
+            list: A list of trace event dicts.
+
+        """
+        events = []
+        for tid, name in self._threads.items():
+            events.append({
+                'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                'args': {'name': name},
+            })
+        for name, cat, start, end, tid, args in self._spans:
+            e = {
+                'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+                'ts': (start - self._origin) * 1e6, 'dur': (end - start) * 1e6,
+            }
+            if args:
+                e['args'] = args
+            events.append(e)
+        return events
+
+    def write(self, path):
+        """Writes all recorded spans to a Chrome trace JSON file.
+
+        Args:
+            path (str): The path of the file to write.
+
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms'}, f)
+
+
+class _Span(object):
+
+    def __init__(self, tracer, name, cat, args):
+        self._tracer = tracer
+        self._name = name
+        self._cat = cat
+        self._args = args
+        self._start = None
+
+    def __enter__(self):
+        self._start = precise_time()
+        return self
+
+    def __exit__(self, *exc):
+        if self._tracer.enabled:
+            self._tracer.add(self._name, self._cat, self._start, precise_time(), self._args)
+        return False
+
+
+_tracer = Tracer()
+
+
+def get_tracer():
+    """Retrieves the global tracer for the task.
+
+    Returns:
+        :obj:`Tracer`: The global tracer.
+
+    """
+    return _tracer
+
+
+def span(name, cat='block', **args):
+    """Creates a context manager that records its body as a span.
+
+    Uses the global tracer. See :meth:`Tracer.span` for more info.
+
+    """
+    return _tracer.span(name, cat, **args)
+
+
+def traced(cat='function', name=None):
+    """A decorator that records each call of a function as a span.
+
+    Uses the global tracer. Calls are only recorded if tracing is enabled by
+    the time the call finishes, so a call that enables tracing (e.g. the
+    experiment's setup) is still recorded.
+
+    Args:
+        cat (str, optional): The category of the span. Defaults to 'function'.
+        name (str, optional): The name of the span. Defaults to the qualified
+            name of the function (e.g. 'HLJT.trial').
+
+    """
+    def decorator(func):
+        span_name = name if name else func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = precise_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if _tracer.enabled:
+                    _tracer.add(span_name, cat, start, precise_time())
+
+        return wrapper
+    return decorator
@@ -0,0 +1,265 @@
+import sys
+import time
+
+import numpy as np
+
+# Constrained generation of TMS pulse schedules. A schedule for a block gives
+# the order of its trials, which trials have a pulse, and the index of the
+# pulse onset delay used on each trial. Schedules are generated to satisfy
+# the following constraints:
+#
+# * Exactly ``round(proportion * n_trials)`` trials have a pulse.
+# * No more than ``max_gap`` trials in a row go without a pulse, so the
+#   stimulator doesn't disarm itself from inactivity.
+# * Within each cell (e.g. each combination of hand, angle, and rotation),
+#   the number of pulse trials is as close to ``proportion`` of the cell's
+#   trials as possible.
+# * Each onset delay is used equally often (to within one trial) for pulse
+#   trials, and likewise for non-pulse trials.
+#
+# Since the trial order is part of the schedule, the gap and balance
+# constraints don't interact: pulse positions are drawn first by splitting
+# the non-pulse trials into runs of at most ``max_gap`` (a multivariate
+# hypergeometric draw), and then each cell's quota of pulse trials is dealt
+# into them. Every step is a shuffle, a cumulative sum, or a radix sort on
+# small integer keys, so schedules are generated and validated in linear time
+# and in batches, without any rejection sampling.
+
+
+def pulse_count(n_trials, proportion):
+    """Gets the number of pulse trials in a schedule.
+
+    Args:
+        n_trials (int): The number of trials in the schedule.
+        proportion (float): The proportion of trials with a pulse.
+
+    Returns:
+        int: The number of pulse trials.
+
+    """
+    return int(round(proportion * n_trials))
+
+
+def _cell_indices(cells, n_trials):
+    # Converts a list of cell labels (one per trial) to integer indices
+    if cells is None:
+        return np.zeros(n_trials, dtype=np.intp)
+    labels = {}
+    idx = np.asarray([labels.setdefault(c, len(labels)) for c in cells], dtype=np.intp)
+    if len(idx) != n_trials:
+        raise ValueError("The number of cell labels must match the number of trials.")
+    return idx
+
+
+def _sort_keys(x, n_keys):
+    # NumPy uses a linear-time radix sort for stable sorts of small integers
+    return x.astype(np.uint8 if n_keys <= 256 else np.uint16)
+
+
+def generate_schedules(cells, proportion=0.5, max_gap=8, n_onsets=1, size=1, seed=None):
+    """Generates a batch of random pulse schedules for a block of trials.
+
+    Args:
+        cells (list): The balancing cell of each trial in the block (e.g. a
+            tuple of the trial's hand, angle, and rotation). If None, all
+            trials are treated as being in the same cell.
+        proportion (float, optional): The proportion of trials with a pulse.
+            Defaults to 0.5.
+        max_gap (int, optional): The maximum number of trials in a row without
+            a pulse. If None, gaps are not constrained. Defaults to 8.
+        n_onsets (int, optional): The number of pulse onset delays to
+            interleave within the block. Defaults to 1.
+        size (int, optional): The number of schedules to generate. Defaults
+            to 1.
+        seed (int or :obj:`numpy.random.Generator`, optional): The random seed
+            or generator to use.
+
+    Returns:
+        tuple: Arrays of the trial order (i.e. the index in ``cells`` of the
+        trial at each position), whether each position has a pulse, and the
+        onset index of each position, each with the shape (size, n_trials).
+
+    Raises:
+        ValueError: If no schedule can satisfy the given constraints.
+
+    """
+    rng = np.random.default_rng(seed)
+    n = len(cells)
+    cell_idx = _cell_indices(cells, n)
+    k = pulse_count(n, proportion)
+    gap = n if max_gap is None else max_gap
+    if n - k > (k + 1) * gap:
+        e = "{0} pulses in {1} trials can't have gaps of {2} trials or fewer."
+        raise ValueError(e.format(k, n, gap))
+    if n_onsets < 1:
+        raise ValueError("There must be at least one pulse onset.")
+    rows = np.arange(size)[:, np.newaxis]
+
+    # Split the non-pulse trials into the runs before, between, and after the
+    # pulses, and get the positions of the pulse and non-pulse trials
+    runs = rng.multivariate_hypergeometric([gap] * (k + 1), n - k, size=size)
+    pulse_pos = np.cumsum(runs[:, :k], axis=1) + np.arange(k)
+    pulses = np.zeros((size, n), dtype=bool)
+    pulses[rows, pulse_pos] = True
+    positions = np.argsort(_sort_keys(~pulses, 2), axis=1, kind='stable')
+
+    # Get the number of pulse trials for each cell, randomly rounding up for
+    # cells with a fractional quota so that the total is exact
+    n_cells = cell_idx.max() + 1 if n else 0
+    cell_sizes = np.bincount(cell_idx, minlength=n_cells)
+    ideal = proportion * cell_sizes
+    base = np.floor(ideal + 1e-9).astype(np.intp)
+    quota = np.tile(base, (size, 1))
+    extras = k - base.sum()
+    if extras > 0:
+        eligible = np.flatnonzero(ideal - base > 1e-9)
+        chosen = rng.permuted(np.tile(eligible, (size, 1)), axis=1)[:, :extras]
+        quota[rows, chosen] += 1
+
+    # Shuffle the trials and group them by cell, so that the first trials of
+    # each cell up to its quota get pulses
+    trials = rng.permuted(np.tile(np.arange(n), (size, 1)), axis=1)
+    grouped = np.argsort(_sort_keys(cell_idx[trials], n_cells), axis=1, kind='stable')
+    trials = np.take_along_axis(trials, grouped, axis=1)
+    grouped_cells = np.sort(cell_idx)
+    starts = np.cumsum(cell_sizes) - cell_sizes
+    rank = np.arange(n) - starts[grouped_cells]
+    has_pulse = rank < quota[:, grouped_cells]
+    split = np.argsort(_sort_keys(~has_pulse, 2), axis=1, kind='stable')
+    trials = np.take_along_axis(trials, split, axis=1)
+
+    # Deal onsets to the pulse and non-pulse trials in turn, so that each
+    # onset is used equally often and is spread across cells
+    onset_order = rng.permuted(np.tile(np.arange(n_onsets), (size, 1)), axis=1)
+    cycle = np.concatenate([np.arange(k), np.arange(n - k)]) % n_onsets
+    onset_idx = np.take_along_axis(onset_order, np.tile(cycle, (size, 1)), axis=1)
+
+    # Deal the pulse trials into random pulse positions, and the non-pulse
+    # trials into random non-pulse positions
+    positions = np.concatenate([
+        rng.permuted(positions[:, :k], axis=1), rng.permuted(positions[:, k:], axis=1)
+    ], axis=1)
+    order = np.empty((size, n), dtype=np.intp)
+    onsets = np.empty((size, n), dtype=np.intp)
+    np.put_along_axis(order, positions, trials, axis=1)
+    np.put_along_axis(onsets, positions, onset_idx, axis=1)
+    return (order, pulses, onsets)
+
+
+def generate_schedule(cells, proportion=0.5, max_gap=8, n_onsets=1, seed=None):
+    """Generates a random pulse schedule for a block of trials.
+
+    See :func:`generate_schedules` for details.
+
+    Returns:
+        tuple: Lists of the trial order, whether each trial has a pulse, and
+        the onset index of each trial.
+
+    """
+    order, pulses, onsets = generate_schedules(
+        cells, proportion, max_gap, n_onsets, size=1, seed=seed
+    )
+    return (order[0].tolist(), pulses[0].tolist(), onsets[0].tolist())
+
+
+def validate_schedules(order, pulses, onsets, cells, proportion=0.5, max_gap=8,
+                       n_onsets=1):
+    """Checks a batch of pulse schedules against a set of constraints.
+
+    Args:
+        order (:obj:`numpy.ndarray`): The trial order of each schedule.
+        pulses (:obj:`numpy.ndarray`): Whether each position has a pulse.
+        onsets (:obj:`numpy.ndarray`): The onset index of each position.
+        cells (list): The balancing cell of each trial, or None.
+        proportion (float, optional): The proportion of trials with a pulse.
+            Defaults to 0.5.
+        max_gap (int, optional): The maximum number of trials in a row without
+            a pulse, or None. Defaults to 8.
+        n_onsets (int, optional): The number of interleaved pulse onsets.
+            Defaults to 1.
+
+    Returns:
+        :obj:`numpy.ndarray`: Whether each schedule in the batch is valid.
+
+    """
+    order = np.atleast_2d(order)
+    pulses = np.atleast_2d(pulses).astype(bool)
+    onsets = np.atleast_2d(onsets)
+    size, n = order.shape
+    cell_idx = _cell_indices(cells, n)
+    n_cells = cell_idx.max() + 1 if n else 0
+    rows = np.arange(size)[:, np.newaxis]
+
+    # Each schedule must contain each trial exactly once
+    in_range = (order >= 0) & (order < n)
+    valid = in_range.all(axis=1)
+    seen = np.zeros((size, n), dtype=bool)
+    seen[rows, np.where(in_range, order, 0)] = True
+    valid &= seen.all(axis=1)
+
+    # Check the number of pulses and the longest run without one
+    valid &= pulses.sum(axis=1) == pulse_count(n, proportion)
+    if max_gap is not None:
+        idx = np.arange(n)
+        last = np.maximum.accumulate(np.where(pulses, idx, -1), axis=1)
+        valid &= ((idx - last) <= max_gap).all(axis=1)
+
+    # Check the number of pulses in each cell
+    pos_cells = cell_idx[np.where(in_range, order, 0)]
+    flat = (rows * n_cells + pos_cells)[pulses]
+    counts = np.bincount(flat, minlength=size * n_cells).reshape(size, n_cells)
+    ideal = proportion * np.bincount(cell_idx, minlength=n_cells)
+    lo = np.floor(ideal + 1e-9)
+    hi = np.ceil(ideal - 1e-9)
+    valid &= ((counts >= lo) & (counts <= hi)).all(axis=1)
+
+    # Check that onsets are balanced within pulse and non-pulse trials
+    valid &= ((onsets >= 0) & (onsets < n_onsets)).all(axis=1)
+    flat = rows * n_onsets + np.clip(onsets, 0, n_onsets - 1)
+    for mask in (pulses, ~pulses):
+        counts = np.bincount(flat[mask], minlength=size * n_onsets)
+        counts = counts.reshape(size, n_onsets)
+        valid &= (counts.max(axis=1) - counts.min(axis=1)) <= 1
+    return valid
+
+
+
+def main(args):
+    # Benchmarks generating and validating schedules for a standard block of
+    # 72 trials (2 hands x 2 sexes x 6 angles x 3 rotations), balancing
+    # pulses across hand, angle, and rotation with 3 interleaved onsets
+    usage = "Usage: python pulses.py [<n_schedules>]"
+    try:
+        total = int(args[0]) if args else 1000000
+    except ValueError:
+        print(usage)
+        return 1
+    cells = [
+        (hand, angle, rotation)
+        for hand in ['L', 'R'] for sex in ['F', 'M']
+        for angle in [60, 90, 120, 240, 270, 300] for rotation in [0, 60, 300]
+    ]
+    batch = 100000
+    rng = np.random.default_rng()
+    done = invalid = 0
+    gen_time = check_time = 0.0
+    while done < total:
+        size = min(batch, total - done)
+        t0 = time.perf_counter()
+        schedule = generate_schedules(cells, 0.5, 8, 3, size=size, seed=rng)
+        t1 = time.perf_counter()
+        invalid += size - validate_schedules(*schedule, cells, 0.5, 8, 3).sum()
+        check_time += time.perf_counter() - t1
+        gen_time += t1 - t0
+        done += size
+    print("Generated {0} schedules in {1:.2f} s ({2:.0f}/s)".format(
+        done, gen_time, done / gen_time
+    ))
+    print("Validated {0} schedules in {1:.2f} s ({2:.0f}/s), {3} invalid".format(
+        done, check_time, done / check_time, invalid
+    ))
+    return 0 if invalid == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+import os
+import gc
+import sys
+
+import numpy as np
+
+from klibs.KLTime import precise_time
+
+# Helpers for running the task in a "real-time" mode, reducing the chances of
+# the response loop being preempted by other processes or paused by Python's
+# garbage collector, along with a timer for measuring loop jitter.
+
+
+def enable_realtime(cores=None):
+    """Raises the scheduling priority of the task and pins it to given cores.
+
+    Each step is only performed if permitted by the operating system (e.g.
+    lowering the nice value on Linux usually requires root or CAP_SYS_NICE),
+    and steps that aren't permitted are skipped.
+
+    Note that CPU affinity only applies to the calling thread and any threads
+    it creates later, so this should be called from the main (render) thread
+    after starting any background threads that should remain unpinned.
+
+    Args:
+        cores (list, optional): The CPU cores to pin the calling thread to.
+            Defaults to no pinning.
+
+    Returns:
+        dict: The success (True/False) of each step, keyed by name.
+
+    """
+    status = {
+        'priority': _raise_priority(),
+        'affinity': _set_affinity(cores) if cores else False,
+    }
+    # Move everything allocated so far (images, stimuli, etc.) out of the
+    # garbage collector's view so that later collections are faster
+    if hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+    return status
+
+
+def _raise_priority():
+    if sys.platform == 'win32':
+        import ctypes
+        HIGH_PRIORITY_CLASS = 0x00000080
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        return bool(ctypes.windll.kernel32.SetPriorityClass(handle, HIGH_PRIORITY_CLASS))
+
+    # Real-time scheduling (e.g. SCHED_RR) isn't used on Linux, since the task's
+    # response loops busy-wait and would starve the EMG, prefetch, and
+    # heartbeat threads of CPU time. A lower nice value is enough to keep
+    # other processes from preempting the task.
+    try:
+        os.setpriority(os.PRIO_PROCESS, 0, -10)
+        return True
+    except OSError:
+        return False
+
+
+def _set_affinity(cores):
+    if not hasattr(os, 'sched_setaffinity'):
+        # Not supported on Windows or macOS without extra dependencies
+        return False
+    try:
+        os.sched_setaffinity(0, set(cores))
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def pause_gc():
+    """Disables automatic garbage collection.
+
+    Should be followed by a call to :func:`resume_gc` once the time-critical
+    part of a trial is over.
+
+    """
+    gc.disable()
+
+
+def resume_gc():
+    """Re-enables automatic garbage collection and runs a full collection.
+
+    """
+    gc.enable()
+    gc.collect()
+
+
+
+class LoopTimer(object):
+    """Measures the timing jitter of a polling loop.
+
+    The time of each iteration is recorded into a preallocated array, so
+    timing the loop doesn't allocate any memory. When the loop is finished,
+    the periods between iterations are added to a session-wide histogram
+    and summary statistics are computed.
+
+    Args:
+        capacity (int, optional): The maximum number of iterations to record
+            per loop. Iterations beyond this are ignored. Defaults to 2^20.
+
+    """
+    # Log-spaced histogram bins from 1 us to 1 s
+    BINS = np.logspace(-6, 0, 241)
+
+    def __init__(self, capacity=2**20):
+        self._times = np.zeros(capacity)
+        self._n = 0
+        self.loops = 0
+        self.histogram = np.zeros(len(self.BINS) - 1, dtype=np.int64)
+        self.max_period = 0.0
+
+    def start(self):
+        """Starts timing a new loop.
+
+        """
+        self._n = 0
+        self.tick()
+
+    def tick(self):
+        """Records the time of a loop iteration.
+
+        """
+        if self._n < len(self._times):
+            self._times[self._n] = precise_time()
+            self._n += 1
+
+    def stop(self):
+        """Finishes timing the current loop.
+
+        Returns:
+            :obj:`numpy.ndarray`: The periods (in seconds) between iterations.
+
+        """
+        periods = np.diff(self._times[:self._n])
+        if len(periods):
+            self.loops += 1
+            self.histogram += np.histogram(periods, self.BINS)[0]
+            self.max_period = max(self.max_period, periods.max())
+        return periods
+
+    def percentile(self, q):
+        """Estimates a percentile of all recorded loop periods.
+
+        Args:
+            q (float): The percentile to estimate (from 0 to 100).
+
+        Returns:
+            float: The estimated period (in seconds) at the given percentile.
+
+        """
+        total = self.histogram.sum()
+        if not total:
+            return float('nan')
+        # Use the upper edge of the bin containing the percentile
+        idx = np.searchsorted(np.cumsum(self.histogram), total * q / 100.0)
+        edge = self.BINS[min(idx + 1, len(self.BINS) - 1)]
+        return float(min(edge, self.max_period))
+
+    def summary(self):
+        """Gets a summary of the loop period distribution.
+
+        Returns:
+            str: A human-readable summary of the loop timing.
+
+        """
+        txt = (
+            "Loop period over {0} loops: median {1:.3f} ms, 99% {2:.3f} ms, "
+            "99.9% {3:.3f} ms, max {4:.3f} ms"
+        )
+        return txt.format(
+            self.loops, self.percentile(50) * 1000, self.percentile(99) * 1000,
+            self.percentile(99.9) * 1000, self.max_period * 1000
+        )
@@ -0,0 +1,389 @@
+import sys
+import json
+import threading
+from collections import deque, defaultdict
+
+import sdl2
+
+from clock import get_clock
+from communication import VirtualTMSController
+from responselistener import KeyPressListener
+
+# Record-and-replay of sessions for timing regression tests.
+#
+# A SessionRecorder captures the keypress events seen by the response
+# listener, every trigger code sent, the stimulator status responses, and the
+# output of each trial, all timestamped with the experiment clock. A recording
+# can then be replayed through the same task code using virtual devices, with
+# the new recording compared against the original to catch any changes in the
+# task's outputs or pulse timing.
+#
+# Recordings are JSON-lines files with one event per line. The first line is
+# a header with the session info needed to reproduce the original run.
+
+
+FORMAT_VERSION = 1
+
+# Trial fields that must match exactly between a recording and its replay
+EXACT_FIELDS = [
+    "block_num", "trial_num", "hand", "sex", "angle", "rotation", "tms_onset",
+    "judgement", "accuracy", "tms_trial", "tms_fired", "rmt",
+]
+
+
+class SessionRecorder(object):
+    """Records the input and device events of a session to a file.
+
+    Events are stored in memory as they happen and only written to disk when
+    :meth:`flush` is called, so recording never blocks on file I/O.
+
+    Args:
+        path (str): The path of the recording file to write.
+        header (dict): The session info to write at the top of the recording
+            (e.g. the random seed and session number).
+
+    """
+    def __init__(self, path, header):
+        self.path = path
+        self._events = []
+        self._lock = threading.Lock()
+        self._file = open(path, 'w')
+        header = dict(header, type='header', version=FORMAT_VERSION)
+        self._file.write(json.dumps(header) + "\n")
+        self._clock = get_clock()
+
+    def log(self, kind, **data):
+        """Records an event with the current clock time.
+
+        Args:
+            kind (str): The type of event (e.g. 'trigger' or 'key').
+            **data: The data to record with the event. If a time ``t`` is
+                given, it is used in place of the current clock time.
+
+        """
+        data['type'] = kind
+        if 't' not in data:
+            data['t'] = self._clock.time()
+        with self._lock:
+            self._events.append(data)
+
+    def flush(self):
+        """Writes all events recorded so far to disk.
+
+        """
+        with self._lock:
+            events, self._events = self._events, []
+        for e in events:
+            self._file.write(json.dumps(e) + "\n")
+        self._file.flush()
+
+    def close(self):
+        """Writes any remaining events to disk and closes the recording.
+
+        """
+        self.flush()
+        self._file.close()
+
+
+class RecordingPort(object):
+    """Wraps a TriggerPort to record every trigger code sent.
+
+    All other attributes and methods are passed through to the wrapped port.
+
+    Args:
+        port (:obj:`TriggerPort`): The trigger port to wrap.
+        recorder (:obj:`SessionRecorder`): The recorder to log triggers to.
+
+    """
+    def __init__(self, port, recorder):
+        self._port = port
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._port, name)
+
+    def send(self, name, duration=4):
+        self._recorder.log('trigger', name=name, code=self._port.codes[name])
+        self._port.send(name, duration)
+
+
+class RecordingTMSController(object):
+    """Wraps a TMSController to record the stimulator's status responses.
+
+    All other attributes and methods are passed through to the wrapped
+    controller.
+
+    Args:
+        controller (:obj:`TMSController`): The TMS controller to wrap.
+        recorder (:obj:`SessionRecorder`): The recorder to log responses to.
+
+    """
+    def __init__(self, controller, recorder):
+        self._controller = controller
+        self._recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self._controller, name)
+
+    def get_power(self):
+        value = self._controller.get_power()
+        self._recorder.log('tms', attr='power', value=value)
+        return value
+
+    @property
+    def armed(self):
+        value = bool(self._controller.armed)
+        self._recorder.log('tms', attr='armed', value=value)
+        return value
+
+    @property
+    def ready(self):
+        value = bool(self._controller.ready)
+        self._recorder.log('tms', attr='ready', value=value)
+        return value
+
+
+class RecordingKeyPressListener(KeyPressListener):
+    """A KeyPressListener that records all keypress events it sees.
+
+    Each keypress is recorded with its time (in milliseconds) relative to the
+    start of the collection loop.
+
+    Args:
+        keymap (dict): The key/label mapping for the listener.
+        recorder (:obj:`SessionRecorder`): The recorder to log keypresses to.
+
+    """
+    def __init__(self, keymap, recorder, timeout=None):
+        super(RecordingKeyPressListener, self).__init__(keymap, timeout)
+        self._recorder = recorder
+
+    def listen(self, q):
+        for event in q:
+            if event.type == sdl2.SDL_KEYDOWN:
+                t = get_clock().event_ticks(event.key.timestamp) - self._loop_start
+                self._recorder.log('key', sym=event.key.keysym.sym, rt=t)
+        return super(RecordingKeyPressListener, self).listen(q)
+
+
+
+class SessionReplay(object):
+    """A recorded session, loaded for replay.
+
+    Args:
+        path (str): The path of the recording file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.header, self.events = load_recording(path)
+
+    @property
+    def rmt(self):
+        """int: The RMT confirmed in the recorded session, or None if the
+        recording doesn't include it.
+        """
+        for e in self.events:
+            if e['type'] == 'rmt':
+                return e['value']
+        return None
+
+    def tms_controller(self):
+        """Creates a virtual TMS controller that replays recorded responses.
+
+        Returns:
+            :obj:`ReplayTMSController`: The replay TMS controller.
+
+        """
+        return ReplayTMSController(self.events)
+
+    def key_listener(self, keymap):
+        """Creates a key listener that replays recorded keypresses.
+
+        Returns:
+            :obj:`ReplayKeyPressListener`: The replay key listener.
+
+        """
+        return ReplayKeyPressListener(keymap, self.events)
+
+
+class ReplayTMSController(VirtualTMSController):
+    """A virtual TMSController that returns recorded status responses.
+
+    Each status query returns the next recorded response of the same kind,
+    falling back to the usual virtual stimulator behaviour once all recorded
+    responses have been used.
+
+    Args:
+        events (list): The events of a session recording.
+
+    """
+    def __init__(self, events):
+        self._responses = defaultdict(deque)
+        for e in events:
+            if e['type'] == 'tms':
+                self._responses[e['attr']].append(e['value'])
+        super(ReplayTMSController, self).__init__(None)
+
+    def _hardware_init(self):
+        super(ReplayTMSController, self)._hardware_init()
+        if self._responses['power']:
+            self._info['pwr_a'] = self._responses['power'][0]
+
+    def _next(self, attr, default):
+        if self._responses[attr]:
+            return self._responses[attr].popleft()
+        return default
+
+    def get_power(self):
+        return self._next('power', self._info['pwr_a'])
+
+    @property
+    def armed(self):
+        return self._next('armed', self._info['armed'])
+
+    @property
+    def ready(self):
+        return self._next('ready', self._info['armed'])
+
+
+class ReplayKeyPressListener(KeyPressListener):
+    """A KeyPressListener that replays recorded keypresses.
+
+    Each collection loop replays the keypresses recorded for the same loop of
+    the original session, delivering each one as a synthetic SDL event once
+    its recorded time has passed. Real input events are ignored.
+
+    Args:
+        keymap (dict): The key/label mapping for the listener.
+        events (list): The events of a session recording.
+
+    """
+    def __init__(self, keymap, events, timeout=None):
+        super(ReplayKeyPressListener, self).__init__(keymap, timeout)
+        # Group recorded keypresses by the collection loop they occurred in,
+        # using the recorded trial outputs to mark the end of each loop
+        self._loops = deque()
+        keys = []
+        for e in events:
+            if e['type'] == 'key':
+                keys.append((e['rt'], e['sym']))
+            elif e['type'] == 'trial':
+                self._loops.append(deque(keys))
+                keys = []
+        self._pending = deque()
+
+    def init(self):
+        super(ReplayKeyPressListener, self).init()
+        self._pending = self._loops.popleft() if self._loops else deque()
+
+    def listen(self, q):
+        events = []
+        elapsed = get_clock().ticks() - self._loop_start
+        while self._pending and self._pending[0][0] <= elapsed:
+            rt, sym = self._pending.popleft()
+            e = sdl2.SDL_Event()
+            e.type = sdl2.SDL_KEYDOWN
+            e.key.keysym.sym = sym
+            e.key.timestamp = sdl2.SDL_GetTicks()
+            events.append(e)
+        return super(ReplayKeyPressListener, self).listen(events)
+
+
+
+def load_recording(path):
+    """Loads a session recording from a file.
+
+    Args:
+        path (str): The path of the recording file.
+
+    Returns:
+        tuple: The header dict and a list of event dicts.
+
+    """
+    with open(path, 'r') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    header = json.loads(lines[0])
+    if header.get('type') != 'header':
+        raise ValueError("'{0}' is not a session recording.".format(path))
+    return (header, [json.loads(line) for line in lines[1:]])
+
+
+def _trial_timing(events):
+    # Gets the trial outputs and pulse onsets (in ms, relative to stimulus
+    # onset) for each trial in a recording
+    trials = []
+    stim_on = None
+    pulse = None
+    for e in events:
+        if e['type'] == 'stim_on':
+            stim_on = e['t']
+            pulse = None
+        elif e['type'] == 'trigger' and e['name'] == 'fire_tms':
+            pulse = e['t']
+        elif e['type'] == 'trial':
+            onset = None
+            if pulse is not None and stim_on is not None:
+                onset = (pulse - stim_on) * 1000
+            trials.append((e['data'], onset))
+            stim_on = None
+            pulse = None
+    return trials
+
+
+def compare_recordings(original, replayed, rt_tolerance=5.0, onset_tolerance=5.0):
+    """Compares the trial outputs and pulse timing of two session recordings.
+
+    Args:
+        original (str): The path of the original recording.
+        replayed (str): The path of the replayed recording.
+        rt_tolerance (float, optional): The maximum allowed difference in
+            response time (in ms). Defaults to 5 ms.
+        onset_tolerance (float, optional): The maximum allowed difference in
+            pulse onset relative to the stimulus (in ms). Defaults to 5 ms.
+
+    Returns:
+        list: A list of the differences found (empty if none).
+
+    """
+    a = _trial_timing(load_recording(original)[1])
+    b = _trial_timing(load_recording(replayed)[1])
+    problems = []
+    if len(a) != len(b):
+        problems.append("Trial count differs: {0} vs {1}".format(len(a), len(b)))
+
+    for i, ((t1, onset1), (t2, onset2)) in enumerate(zip(a, b)):
+        label = "Trial {0} (block {1}, trial {2})".format(
+            i + 1, t1.get('block_num'), t1.get('trial_num')
+        )
+        for field in EXACT_FIELDS:
+            if t1.get(field) != t2.get(field):
+                txt = "{0}: {1} differs ({2} vs {3})"
+                problems.append(txt.format(label, field, t1.get(field), t2.get(field)))
+        rt_diff = abs(float(t1['rt']) - float(t2['rt']))
+        if rt_diff > rt_tolerance:
+            txt = "{0}: rt differs by {1:.2f} ms"
+            problems.append(txt.format(label, rt_diff))
+        if (onset1 is None) != (onset2 is None):
+            problems.append("{0}: pulse fired in only one session".format(label))
+        elif onset1 is not None and abs(onset1 - onset2) > onset_tolerance:
+            txt = "{0}: pulse onset differs by {1:.2f} ms ({2:.2f} vs {3:.2f})"
+            problems.append(txt.format(label, abs(onset1 - onset2), onset1, onset2))
+
+    return problems
+
+
+def main(args):
+    if len(args) != 2:
+        print("Usage: python replay.py <original.jsonl> <replayed.jsonl>")
+        return 1
+    problems = compare_recordings(args[0], args[1])
+    for problem in problems:
+        print(problem)
+    if not problems:
+        print("Recordings match.")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -1,10 +1,11 @@
 import sdl2
 
-from klibs.KLTime import precise_time
 from klibs.KLEventQueue import pump, flush
 from klibs.KLUserInterface import ui_request
 from klibs.KLResponseCollectors import Response
 
+from clock import get_clock
+
 # This is a draft of a new simple/flexible response collection module for KLibs.
 
 
@@ -33,7 +34,7 @@ class BaseResponseListener(object):
 
     def _timestamp(self):
         # The timestamp (in milliseconds) to use as the start time for the loop.
-        return precise_time() * 1000
+        return get_clock().time() * 1000
 
     def collect(self):
         """Collects a single response from the participant.
@@ -117,9 +118,9 @@ class KeyPressListener(BaseResponseListener):
         self._keymap = self._parse_keymap(keymap)
 
     def _timestamp(self):
-        # Since keypress events have SDL timestamps, use SDL_GetTicks to mark the
-        # start of the collection loop.
-        return sdl2.SDL_GetTicks()
+        # Since keypress events have SDL timestamps, use the clock's tick counter
+        # (SDL_GetTicks in real time) to mark the start of the collection loop.
+        return get_clock().ticks()
 
     def _parse_keymap(self, keymap):
         # Perform basic validation of the keymap
@@ -147,6 +148,7 @@ class KeyPressListener(BaseResponseListener):
                 key = event.key.keysym # keyboard button event object
                 if key.sym in self._keymap.keys():
                     value = self._keymap[key.sym]
-                    rt = (event.key.timestamp - self._loop_start)
+                    t = get_clock().event_ticks(event.key.timestamp)
+                    rt = (t - self._loop_start)
                     return Response(value, rt)
         return None
@@ -0,0 +1,280 @@
+import numpy as np
+
+from clock import get_clock
+from mep import extract_meps
+
+# Adaptive estimation of the resting motor threshold (RMT), the lowest power
+# level that evokes an MEP on half of all pulses. Instead of stepping through
+# power levels with a fixed rule (e.g. 5-of-10), a Bayesian posterior over the
+# threshold of the participant's MEP response curve is kept, and each pulse is
+# given at the power level expected to shrink that posterior the most (the psi
+# method of Kontsevich & Tyler, 1999). This usually needs a fraction of the
+# pulses of the usual methods for the same precision.
+
+
+MEP_CRITERION = 50e-6 # Minimum peak-to-peak MEP amplitude (in volts)
+
+
+def _entropy(p):
+    # The entropy of each row of a set of probability distributions
+    plogp = np.where(p > 0, p * np.log(np.where(p > 0, p, 1.0)), 0.0)
+    return -plogp.sum(axis=1)
+
+
+class RMTEstimator(object):
+    """A Bayesian adaptive estimator of resting motor threshold.
+
+    The probability of an MEP at a given power level is modelled as a logistic
+    function of power with an unknown threshold (the RMT) and spread, plus
+    small fixed rates of spontaneous MEPs (guesses) and missed MEPs (lapses).
+    The posterior over threshold and spread is kept on a grid, starting from
+    a uniform prior, and the spread is treated as a nuisance parameter when
+    choosing the next power level.
+
+    Args:
+        levels (list, optional): The power levels that can be tested.
+            Defaults to 20-100% in steps of 1%.
+        thresholds (list, optional): The possible threshold values. Defaults
+            to 20-100% in steps of 0.5%.
+        spreads (list, optional): The possible spreads (in % power) of the
+            response curve. Defaults to 1-8%.
+        guess (float, optional): The probability of an MEP well below the
+            threshold. Defaults to 0.01.
+        lapse (float, optional): The probability of no MEP well above the
+            threshold. Defaults to 0.02.
+
+    """
+    def __init__(self, levels=None, thresholds=None, spreads=None, guess=0.01,
+                 lapse=0.02):
+        self.levels = np.arange(20, 101) if levels is None else np.asarray(levels)
+        if thresholds is None:
+            thresholds = np.arange(20, 100.5, 0.5)
+        if spreads is None:
+            spreads = [1.0, 1.5, 2.0, 3.0, 4.0, 6.0, 8.0]
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.spreads = np.asarray(spreads, dtype=np.float64)
+        self.history = []
+
+        # Precompute the MEP probability for every level/threshold/spread
+        x = self.levels[:, None, None]
+        t = self.thresholds[None, :, None]
+        s = self.spreads[None, None, :]
+        self._p_mep = guess + (1 - guess - lapse) / (1 + np.exp(-(x - t) / s))
+        shape = (len(self.thresholds), len(self.spreads))
+        self.posterior = np.full(shape, 1.0 / np.prod(shape))
+
+    @property
+    def pulses(self):
+        """int: The number of pulses given so far.
+        """
+        return len(self.history)
+
+    @property
+    def estimate(self):
+        """float: The posterior mean of the threshold.
+        """
+        return float(np.sum(self.thresholds * self.posterior.sum(axis=1)))
+
+    @property
+    def sd(self):
+        """float: The posterior standard deviation of the threshold.
+        """
+        marginal = self.posterior.sum(axis=1)
+        var = np.sum((self.thresholds - self.estimate) ** 2 * marginal)
+        return float(np.sqrt(var))
+
+    def next_level(self):
+        """Picks the most informative power level for the next pulse.
+
+        Returns:
+            int: The level expected to minimize the entropy of the threshold
+            posterior after the next pulse.
+
+        """
+        joint_mep = self._p_mep * self.posterior
+        joint_none = self.posterior - joint_mep
+        p_mep = joint_mep.sum(axis=(1, 2))
+        p_none = 1.0 - p_mep
+        # Entropy of the threshold posterior after each possible outcome
+        h_mep = _entropy(joint_mep.sum(axis=2) / p_mep[:, None])
+        h_none = _entropy(joint_none.sum(axis=2) / p_none[:, None])
+        expected = p_mep * h_mep + p_none * h_none
+        return int(self.levels[np.argmin(expected)])
+
+    def update(self, level, mep):
+        """Updates the posterior with the outcome of a pulse.
+
+        Args:
+            level (int): The power level of the pulse.
+            mep (bool): Whether the pulse evoked an MEP.
+
+        """
+        idx = np.flatnonzero(self.levels == level)
+        if not len(idx):
+            raise ValueError("Power level {0} is not a testable level".format(level))
+        p = self._p_mep[idx[0]]
+        posterior = self.posterior * (p if mep else 1.0 - p)
+        self.posterior = posterior / posterior.sum()
+        self.history.append((int(level), bool(mep)))
+
+
+
+class SimulatedResponder(object):
+    """Simulates MEPs in a virtual EMG stream, for testing RMT estimation.
+
+    After each pulse, an MEP is evoked with a probability given by a logistic
+    function of the power level centered on the simulated RMT. Each MEP is a
+    single-cycle sine wave with a log-normally distributed amplitude, added to
+    the EMG stream after a fixed latency.
+
+    Args:
+        source (:obj:`VirtualStreamSource`): The virtual EMG stream to add
+            simulated MEPs to.
+        rmt (float, optional): The simulated RMT (in % power). Defaults to 45.
+        spread (float, optional): The spread (in % power) of the simulated
+            response curve. Defaults to 2.
+        amplitude (float, optional): The median peak-to-peak amplitude (in
+            volts) of each MEP. Defaults to 0.2 mV.
+        latency (float, optional): The latency (in seconds) of each MEP.
+            Defaults to 22 ms.
+        seed (int, optional): The seed for the random number generator.
+
+    """
+    def __init__(self, source, rmt=45.0, spread=2.0, amplitude=2e-4,
+                 latency=0.022, seed=None):
+        self.source = source
+        self.rmt = rmt
+        self.spread = spread
+        self.amplitude = amplitude
+        self.latency = latency
+        self._rng = np.random.default_rng(seed)
+        duration = int(round(0.01 * source.rate))
+        self._shape = np.sin(np.linspace(0, 2 * np.pi, duration)) / 2.0
+
+    def pulse(self, level):
+        """Simulates the response to a pulse at a given power level.
+
+        Args:
+            level (int): The power level of the pulse.
+
+        Returns:
+            bool: True if an MEP was evoked.
+
+        """
+        p = 1.0 / (1.0 + np.exp(-(level - self.rmt) / self.spread))
+        if self._rng.random() >= p:
+            return False
+        amp = self.amplitude * np.exp(self._rng.normal(0.0, 0.3))
+        delay = int(round(self.latency * self.source.rate))
+        self.source.inject(self._shape * amp, delay)
+        return True
+
+
+
+def estimate_rmt(tms, trigger, emg, window=(0.015, 0.06), max_pulses=30,
+                 min_pulses=5, max_sd=1.5, interval=5.0, max_power=100,
+                 responder=None, callback=None):
+    """Estimates the resting motor threshold of a participant.
+
+    Each pulse is given at the level chosen by an :obj:`RMTEstimator` and
+    fired with the trigger port, so that its onset is known to the sample in
+    the EMG stream. The peak-to-peak EMG amplitude in the MEP window (on the
+    first EMG channel) is then compared against the 50 uV MEP criterion.
+
+    Estimation stops once the posterior standard deviation of the threshold
+    falls below ``max_sd`` or the maximum number of pulses is reached.
+
+    Args:
+        tms (:obj:`TMSController`): The TMS controller for the stimulator.
+        trigger (:obj:`TriggerPort`): The trigger port for firing the
+            stimulator, with a 'fire_tms' code.
+        emg (:obj:`EMGRecorder`): The running EMG recorder.
+        window (tuple, optional): The start and end (in seconds, relative to
+            the pulse) of the MEP response window. Defaults to 15-60 ms.
+        max_pulses (int, optional): The maximum number of pulses to give.
+            Defaults to 30.
+        min_pulses (int, optional): The minimum number of pulses to give.
+            Defaults to 5.
+        max_sd (float, optional): The posterior standard deviation (in %
+            power) at which to stop. Defaults to 1.5.
+        interval (float, optional): The minimum time (in seconds) between
+            pulses. Defaults to 5 seconds.
+        max_power (int, optional): The highest power level (in %) to give
+            pulses at. The threshold can still be estimated above this level,
+            but no pulses are given there. Defaults to 100.
+        responder (:obj:`SimulatedResponder`, optional): A simulated
+            responder to notify of each pulse, for testing with virtual
+            devices.
+        callback (callable, optional): A function called after each pulse
+            with the estimator, the level of the pulse, and the measured MEP
+            amplitude (e.g. for showing progress).
+
+    Returns:
+        :obj:`RMTEstimator`: The estimator, with the full pulse history.
+
+    """
+    if not 20 <= max_power <= 100:
+        raise ValueError("Maximum power must be between 20 and 100 (got {0})".format(max_power))
+    clock = get_clock()
+    est = RMTEstimator(levels=np.arange(20, int(max_power) + 1))
+    code = trigger.codes['fire_tms']
+    last_pulse = None
+    tms.arm(wait=True)
+    while est.pulses < max_pulses:
+        level = est.next_level()
+        tms.set_power(level)
+
+        # Wait out the inter-pulse interval (also giving the stimulator time
+        # to charge to the new level), then make sure it's ready to fire
+        if last_pulse is not None:
+            remaining = interval - (clock.time() - last_pulse)
+            if remaining > 0:
+                clock.sleep(remaining)
+        ready_timeout = clock.countdown(3.0)
+        while not tms.ready:
+            if not ready_timeout.counting():
+                raise RuntimeError("Stimulator not ready to fire (3 seconds)")
+            clock.sleep(0.05)
+
+        amplitude = _measure_pulse(emg, trigger, code, window, responder, level)
+        last_pulse = clock.time()
+        est.update(level, amplitude >= MEP_CRITERION)
+        if callback:
+            callback(est, level, amplitude)
+        if est.pulses >= min_pulses and est.sd <= max_sd:
+            break
+    return est
+
+
+def _measure_pulse(emg, trigger, code, window, responder, level, timeout=2.0):
+    # Fires a pulse and measures the MEP amplitude following it
+    n_markers = len(emg.markers)
+    emg.mark(code)
+    trigger.send('fire_tms')
+    if responder:
+        responder.pulse(level)
+
+    # Wait for the pulse to show up in the EMG markers (immediate if marked
+    # from software, may take a moment if detected in the hardware stream)
+    clock = get_clock()
+    marker_timeout = clock.countdown(timeout)
+    onset = None
+    while onset is None:
+        for sample, marker in emg.markers[n_markers:]:
+            if marker == code:
+                onset = sample
+                break
+        else:
+            if not marker_timeout.counting():
+                raise RuntimeError("TMS pulse not found in the EMG stream.")
+            clock.sleep(0.01)
+
+    # Get the EMG around the pulse and measure its peak-to-peak amplitude
+    baseline = (-0.1, -0.005)
+    pre = int(round(-baseline[0] * emg.rate))
+    post = int(round(window[1] * emg.rate))
+    start = max(0, onset - pre)
+    samples = emg.read(start, onset + post)
+    meps = extract_meps(samples, [onset - start], emg.rate, window, baseline)
+    amplitude = meps['amplitude'][0, 0]
+    return 0.0 if np.isnan(amplitude) else float(amplitude)
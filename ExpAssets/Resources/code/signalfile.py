@@ -0,0 +1,407 @@
+import os
+import sys
+import json
+
+import numpy as np
+
+# A simple storage format for raw signal streams (EMG, photodiode, trigger
+# echoes) recorded during the task.
+#
+# Each recording consists of two files: a raw sample file containing a flat,
+# fixed-dtype array of interleaved samples (one frame per sample, one value
+# per channel), and an index sidecar (the sample file name plus '.idx')
+# containing one JSON object per line. The first line of the index is a header
+# describing the sample file, and each following line is an entry mapping a
+# trial or trigger event to sample offsets in the stream:
+#
+#   {"format": "hljt-signal", "version": 1, "dtype": "<f4", "channels": 2, ...}
+#   {"trial": [participant_id, session_num, block_num, trial_num], "start": 1200}
+#   {"event": 17, "sample": 2450}
+#   {"trial": [participant_id, session_num, block_num, trial_num], "end": 5600}
+#   {"length": 8000}
+#
+# Both files are append-only during recording, so nothing ever needs to be
+# rewritten. If a trial is recorded more than once (e.g. after a crash and
+# resume), the last entry for it wins.
+#
+# Opening a writer on an existing recording resumes it: any samples after the
+# last length noted in the index (i.e. not known to be safely on disk) are
+# discarded, and new samples and entries are appended after the rest.
+
+
+FORMAT_NAME = "hljt-signal"
+FORMAT_VERSION = 1
+INDEX_EXT = ".idx"
+
+
+class SignalWriter(object):
+    """An append-only writer for signal files.
+
+    Samples are written through a memory map that is grown in large steps as
+    needed, and the file is trimmed to the exact number of samples written
+    when closed. The number of samples safely on disk is periodically noted
+    in the index, so that recordings can be recovered if the writer is never
+    closed (see :func:`compact`).
+
+    If the sample file and its index already exist, the recording is resumed
+    rather than overwritten (see above).
+
+    Args:
+        path (str): The path of the sample file.
+        channels (int): The number of channels per sample.
+        rate (int): The sampling rate (in Hz) of the signal.
+        dtype (optional): The data type of the samples. Defaults to float32.
+        labels (list, optional): The names of each channel.
+        grow (int, optional): The number of samples to grow the file by
+            whenever it runs out of space. Defaults to 2^20.
+
+    Raises:
+        ValueError: If resuming a recording with a different number of
+            channels, sampling rate, or data type.
+
+    """
+    def __init__(self, path, channels, rate, dtype=np.float32, labels=None,
+                 grow=2**20):
+        self.path = path
+        self.channels = channels
+        self.dtype = np.dtype(dtype)
+        self.length = 0
+        self._grow = grow
+        self._capacity = 0
+        self._map = None
+        if os.path.exists(path) and os.path.exists(path + INDEX_EXT):
+            self._resume(rate)
+            return
+        open(path, 'wb').close()
+        self._index = open(path + INDEX_EXT, 'w')
+        self._write_entry({
+            'format': FORMAT_NAME, 'version': FORMAT_VERSION,
+            'dtype': self.dtype.str, 'channels': channels, 'rate': rate,
+            'labels': labels if labels else [],
+        })
+
+    def _resume(self, rate):
+        # Continues an existing recording after its last known-good sample
+        header, entries = _read_index(self.path)
+        fmt = (header['channels'], header['rate'], np.dtype(header['dtype']))
+        if fmt != (self.channels, rate, self.dtype):
+            e = "Can't resume '{0}': the existing recording has a different format."
+            raise ValueError(e.format(self.path))
+        lengths = [e['length'] for e in entries if 'length' in e]
+        frame = self.channels * self.dtype.itemsize
+        on_disk = os.path.getsize(self.path) // frame
+        self._resize(min(lengths[-1], on_disk) if lengths else 0)
+        self.length = self._capacity
+        # Make sure any new entries start on a new line, dropping a partially
+        # written last line from the index
+        with open(self.path + INDEX_EXT, 'r+b') as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                last = data.rfind(b"\n") + 1
+                try:
+                    json.loads(data[last:].decode('utf-8'))
+                    f.write(b"\n")
+                except ValueError:
+                    f.truncate(last)
+        self._index = open(self.path + INDEX_EXT, 'a')
+        self._write_entry({'resume': self.length})
+
+    def _write_entry(self, entry):
+        self._index.write(json.dumps(entry) + "\n")
+
+    def _resize(self, capacity):
+        if self._map is not None:
+            self._map.flush()
+            self._map = None
+        with open(self.path, 'r+b') as f:
+            f.truncate(capacity * self.channels * self.dtype.itemsize)
+        self._capacity = capacity
+        if capacity:
+            shape = (capacity, self.channels)
+            self._map = np.memmap(self.path, self.dtype, 'r+', shape=shape)
+
+    def append(self, samples):
+        """Appends a chunk of samples to the end of the file.
+
+        Args:
+            samples (:obj:`numpy.ndarray`): A 2-D array of samples, with one
+                row per sample and one column per channel.
+
+        """
+        n = samples.shape[0]
+        if self.length + n > self._capacity:
+            self._resize(self._capacity + max(n, self._grow))
+        self._map[self.length:self.length + n] = samples
+        self.length += n
+
+    def add_event(self, sample, code):
+        """Adds a trigger event to the index.
+
+        Args:
+            sample (int): The sample index of the event onset.
+            code (int): The trigger code of the event.
+
+        """
+        self._write_entry({'event': int(code), 'sample': int(sample)})
+
+    def add_trial(self, trial_id, start=None, end=None):
+        """Adds the start and/or end of a trial to the index.
+
+        Args:
+            trial_id (tuple): The (participant_id, session_num, block_num,
+                trial_num) identifying the trial.
+            start (int, optional): The sample index of the start of the trial.
+            end (int, optional): The sample index of the end of the trial.
+
+        """
+        entry = {'trial': [int(x) for x in trial_id]}
+        if start is not None:
+            entry['start'] = int(start)
+        if end is not None:
+            entry['end'] = int(end)
+        self._write_entry(entry)
+
+    def sync(self):
+        """Flushes all samples and index entries to disk.
+
+        """
+        if self._map is not None:
+            self._map.flush()
+        self._write_entry({'length': self.length})
+        self._index.flush()
+
+    def close(self):
+        """Flushes all data to disk and trims any unused space in the file.
+
+        """
+        self._resize(self.length)
+        self._map = None
+        self._write_entry({'length': self.length})
+        self._index.close()
+
+
+
+def _read_index(path):
+    # Parses the index sidecar for a signal file, returning the header and a
+    # list of entries
+    with open(path + INDEX_EXT, 'r') as f:
+        lines = [line for line in f.read().splitlines() if line.strip()]
+    if not lines:
+        raise ValueError("Index for '{0}' is empty.".format(path))
+    header = json.loads(lines[0])
+    if header.get('format') != FORMAT_NAME:
+        raise ValueError("'{0}' is not a signal file index.".format(path + INDEX_EXT))
+    entries = []
+    for i, line in enumerate(lines[1:]):
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            # A partially-written last line is expected after a crash
+            if i != len(lines) - 2:
+                raise
+    return (header, entries)
+
+
+class SignalFile(object):
+    """A read-only, memory-mapped signal file with a trial and event index.
+
+    All sample access is through zero-copy views of the memory map, so only
+    the parts of a recording that are actually used get loaded into memory.
+
+    Args:
+        path (str): The path of the sample file.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        header, entries = _read_index(path)
+        self.rate = header['rate']
+        self.channels = header['channels']
+        self.labels = header.get('labels', [])
+        self.dtype = np.dtype(header['dtype'])
+
+        self.trials = {}
+        events = []
+        length = None
+        for e in entries:
+            if 'trial' in e:
+                trial = self.trials.setdefault(tuple(e['trial']), [None, None])
+                if 'start' in e:
+                    trial[0] = e['start']
+                    trial[1] = None
+                if 'end' in e:
+                    trial[1] = e['end']
+            elif 'event' in e:
+                events.append((e['sample'], e['event']))
+            elif 'length' in e:
+                length = e['length']
+        self.events = np.asarray(sorted(events), dtype=np.int64).reshape(-1, 2)
+
+        # Use the number of samples known to be written, if available
+        frame = self.channels * self.dtype.itemsize
+        on_disk = os.path.getsize(path) // frame
+        self.length = on_disk if length is None else min(length, on_disk)
+        if self.length:
+            shape = (self.length, self.channels)
+            self.data = np.memmap(path, self.dtype, 'r', shape=shape)
+        else:
+            self.data = np.zeros((0, self.channels), dtype=self.dtype)
+
+    def __len__(self):
+        return self.length
+
+    def trial(self, participant_id, session_num, block_num, trial_num):
+        """Gets the samples recorded during a given trial.
+
+        Args:
+            participant_id (int): The database ID of the participant.
+            session_num (int): The session number of the trial.
+            block_num (int): The block number of the trial.
+            trial_num (int): The trial number within the block.
+
+        Returns:
+            :obj:`numpy.ndarray`: A view of the samples for the trial.
+
+        Raises:
+            KeyError: If the trial is not in the index.
+
+        """
+        key = (participant_id, session_num, block_num, trial_num)
+        start, end = self.trials[key]
+        if end is None:
+            end = self.length
+        return self.data[start:end]
+
+    def window(self, sample, pre, post):
+        """Gets the samples in a window around a given sample index.
+
+        Args:
+            sample (int): The sample index to center the window on.
+            pre (int): The number of samples to include before the index.
+            post (int): The number of samples to include after the index.
+
+        Returns:
+            :obj:`numpy.ndarray`: A view of the samples in the window, clipped
+            to the bounds of the recording.
+
+        """
+        start = max(0, sample - pre)
+        return self.data[start:sample + post]
+
+    def events_for(self, code):
+        """Gets the sample indices of all events with a given trigger code.
+
+        Args:
+            code (int): The trigger code to look up.
+
+        Returns:
+            :obj:`numpy.ndarray`: The sample indices of the events.
+
+        """
+        return self.events[self.events[:, 1] == code, 0]
+
+
+
+def verify(path):
+    """Checks a signal file and its index for problems.
+
+    Args:
+        path (str): The path of the sample file.
+
+    Returns:
+        list: A list of problems found with the file (empty if none).
+
+    """
+    problems = []
+    try:
+        header, entries = _read_index(path)
+    except (IOError, OSError, ValueError) as e:
+        return ["Unable to read index: {0}".format(e)]
+
+    frame = header['channels'] * np.dtype(header['dtype']).itemsize
+    size = os.path.getsize(path)
+    on_disk = size // frame
+    if size % frame:
+        problems.append("File size is not a whole number of samples.")
+
+    lengths = [e['length'] for e in entries if 'length' in e]
+    length = lengths[-1] if lengths else on_disk
+    if length > on_disk:
+        problems.append(
+            "Index reports {0} samples, but only {1} are on disk.".format(length, on_disk)
+        )
+    elif length < on_disk:
+        problems.append("File has {0} unused samples at the end.".format(on_disk - length))
+
+    for e in entries:
+        for key in ('start', 'end', 'sample'):
+            if key in e and not (0 <= e[key] <= length):
+                problems.append("Entry out of bounds: {0}".format(json.dumps(e)))
+        if 'trial' in e and len(e['trial']) != 4:
+            problems.append("Invalid trial ID: {0}".format(json.dumps(e)))
+
+    return problems
+
+
+def compact(path):
+    """Trims unused space from a signal file and rewrites its index.
+
+    Any samples beyond the last length noted in the index are removed (e.g.
+    space preallocated before a crash), and the index is rewritten with a
+    single sorted entry per trial and event.
+
+    Args:
+        path (str): The path of the sample file.
+
+    Returns:
+        int: The number of samples in the compacted file.
+
+    """
+    sig = SignalFile(path)
+    length = sig.length
+    sig.data = None
+    frame = sig.channels * sig.dtype.itemsize
+    with open(path, 'r+b') as f:
+        f.truncate(length * frame)
+
+    header, _ = _read_index(path)
+    tmp_path = path + INDEX_EXT + ".tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(json.dumps(header) + "\n")
+        by_start = sorted(sig.trials.items(), key=lambda t: (t[1][0] is None, t[1][0]))
+        for trial_id, (start, end) in by_start:
+            entry = {'trial': list(trial_id)}
+            if start is not None:
+                entry['start'] = start
+            if end is not None:
+                entry['end'] = end
+            f.write(json.dumps(entry) + "\n")
+        for sample, code in sig.events.tolist():
+            if sample <= length:
+                f.write(json.dumps({'event': code, 'sample': sample}) + "\n")
+        f.write(json.dumps({'length': length}) + "\n")
+    os.replace(tmp_path, path + INDEX_EXT)
+    return length
+
+
+def main(args):
+    usage = "Usage: python signalfile.py [verify|compact] <file> [<file> ...]"
+    if len(args) < 2 or args[0] not in ('verify', 'compact'):
+        print(usage)
+        return 1
+    failed = False
+    for path in args[1:]:
+        if args[0] == 'compact':
+            n = compact(path)
+            print("{0}: compacted to {1} samples".format(path, n))
+        problems = verify(path)
+        for problem in problems:
+            print("{0}: {1}".format(path, problem))
+        if not problems:
+            print("{0}: OK".format(path))
+        failed = failed or bool(problems)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
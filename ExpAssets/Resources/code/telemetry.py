@@ -0,0 +1,328 @@
+import sys
+import json
+import asyncio
+import threading
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+from clock import get_clock
+
+# Live session telemetry for an operator dashboard. The task publishes records
+# (e.g. the output and timing of each trial) into a bounded queue, and a
+# background thread running an asyncio event loop serves them over HTTP on
+# localhost: as a dashboard page, as a stream of server-sent events, and as
+# JSON for polling clients.
+#
+# Publishing only appends to a deque, so it takes about a microsecond and
+# never blocks. If the server falls behind and the queue fills up, new records
+# are dropped (and counted) rather than slowing down the task. Serializing
+# records to JSON happens on the server thread.
+
+
+DASHBOARD_HTML = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>HLJT Session</title>
+<style>
+  body { font-family: sans-serif; margin: 1em; background: #111; color: #ddd; }
+  table { border-collapse: collapse; }
+  td, th { padding: 2px 10px; text-align: right; border-bottom: 1px solid #333; }
+  .bad { color: #f66; }
+</style>
+</head>
+<body>
+<h2>HLJT Session</h2>
+<div id="status">Waiting for data...</div>
+<table>
+  <thead><tr>
+    <th>Block</th><th>Trial</th><th>Hand</th><th>Judgement</th><th>RT (ms)</th>
+    <th>TMS</th><th>Pulse lag (ms)</th><th>Max loop (ms)</th><th>Armed</th>
+  </tr></thead>
+  <tbody id="trials"></tbody>
+</table>
+<script>
+var rows = document.getElementById("trials");
+var statusEl = document.getElementById("status");
+var n = 0, correct = 0;
+function fmt(x) { return (x === null || x === undefined) ? "-" : Number(x).toFixed(1); }
+var events = new EventSource("/events");
+events.onmessage = function(e) {
+  var rec = JSON.parse(e.data);
+  if (rec.type === "session") {
+    statusEl.textContent = "Participant " + rec.data.participant_id +
+      ", session " + rec.data.session_number + " (" + rec.data.session_type + ")";
+  }
+  if (rec.type !== "trial") { return; }
+  var d = rec.data, t = d.trial;
+  n += 1; correct += t.accuracy ? 1 : 0;
+  var row = rows.insertRow(0);
+  var cells = [t.block_num, t.trial_num, t.hand, t.judgement, fmt(t.rt),
+    t.tms_fired ? "fired" : (t.tms_trial ? "MISSED" : ""), fmt(d.timing.pulse_lag_ms),
+    fmt(d.timing.loop_max_ms), d.tms.armed];
+  cells.forEach(function(c) { row.insertCell().textContent = c; });
+  if (!t.accuracy) { row.cells[3].className = "bad"; }
+  if (t.tms_trial && !t.tms_fired) { row.cells[5].className = "bad"; }
+  document.title = "HLJT: " + n + " trials, " + Math.round(100 * correct / n) + "% correct";
+};
+</script>
+</body>
+</html>
+"""
+
+
+def _to_json(x):
+    # Converts numpy scalars and other unknown types for JSON serialization
+    if hasattr(x, 'item'):
+        return x.item()
+    return str(x)
+
+
+class TelemetryServer(object):
+    """Publishes session records to a local HTTP dashboard.
+
+    The server runs on a background thread and provides the following routes:
+
+    * ``/``: A live dashboard page showing the results of each trial.
+    * ``/events``: A stream of server-sent events, one per record (starting
+      with all records still in the history).
+    * ``/records?since=N``: A JSON list of all records in the history with a
+      sequence number greater than N.
+    * ``/status``: A JSON summary of the server's publish and drop counts.
+
+    Each record is sent as a JSON object with a sequence number ('seq'), a
+    type (e.g. 'trial'), the experiment clock time it was published ('t'),
+    and its data.
+
+    Args:
+        host (str, optional): The address to serve on. Defaults to localhost.
+        port (int, optional): The port to serve on. If 0, a free port is
+            picked automatically. Defaults to 8765.
+        capacity (int, optional): The maximum number of records waiting to be
+            sent before new ones are dropped. Defaults to 1024.
+        history (int, optional): The number of past records to keep for new
+            clients. Defaults to 1000.
+        interval (float, optional): How often (in seconds) the server checks
+            for new records. Defaults to 50 ms.
+
+    """
+    def __init__(self, host='127.0.0.1', port=8765, capacity=1024, history=1000,
+                 interval=0.05):
+        self.host = host
+        self.port = port
+        self.capacity = capacity
+        self.interval = interval
+        self.published = 0
+        self.dropped = 0
+        self._clock = get_clock()
+        self._queue = deque()
+        self._history = deque(maxlen=history)
+        self._seq = 0
+        self._clients = set()
+        self._client_drops = 0
+        self._thread = None
+        self._ready = threading.Event()
+        self._stop = threading.Event()
+        self._error = None
+
+    @property
+    def url(self):
+        """str: The URL of the dashboard.
+        """
+        return "http://{0}:{1}/".format(self.host, self.port)
+
+    def start(self):
+        """Starts serving on a background thread.
+
+        Raises:
+            OSError: If the server could not be started (e.g. if the port is
+                already in use).
+
+        """
+        self._stop.clear()
+        self._ready.clear()
+        self._thread = threading.Thread(target=self._run, name="Telemetry")
+        self._thread.daemon = True
+        self._thread.start()
+        self._ready.wait()
+        if self._error:
+            self._thread.join()
+            self._thread = None
+            raise self._error
+
+    def publish(self, kind, data):
+        """Publishes a record to the dashboard without blocking.
+
+        The data must not be modified after being published, since it is
+        serialized later on the server thread.
+
+        Args:
+            kind (str): The type of record (e.g. 'trial').
+            data (dict): The data for the record.
+
+        Returns:
+            bool: True if the record was queued, or False if it was dropped
+            because the queue is full.
+
+        """
+        if len(self._queue) >= self.capacity:
+            self.dropped += 1
+            return False
+        self._queue.append((kind, self._clock.time(), data))
+        self.published += 1
+        return True
+
+    def close(self):
+        """Sends any queued records, disconnects all clients, and stops the
+        server.
+
+        """
+        if self._thread:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            server = loop.run_until_complete(
+                asyncio.start_server(self._handle, self.host, self.port)
+            )
+        except OSError as e:
+            self._error = e
+            self._ready.set()
+            loop.close()
+            return
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        try:
+            loop.run_until_complete(self._serve(server))
+        finally:
+            loop.close()
+
+    async def _serve(self, server):
+        while not self._stop.is_set():
+            self._drain()
+            await asyncio.sleep(self.interval)
+        self._drain()
+        for client in list(self._clients):
+            if client.full():
+                client.get_nowait()
+            client.put_nowait(None)
+        # Stop the server, giving client handlers a chance to send their last
+        # records before their connections are closed
+        server.close()
+        try:
+            await asyncio.wait_for(server.wait_closed(), 1.0)
+        except asyncio.TimeoutError:
+            pass
+
+    def _drain(self):
+        # Serializes all queued records and passes them on to each client
+        while self._queue:
+            kind, t, data = self._queue.popleft()
+            self._seq += 1
+            rec = {'seq': self._seq, 'type': kind, 't': t, 'data': data}
+            msg = (self._seq, json.dumps(rec, default=_to_json))
+            self._history.append(msg)
+            for client in self._clients:
+                if client.full():
+                    # Drop records for clients that can't keep up
+                    self._client_drops += 1
+                else:
+                    client.put_nowait(msg)
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 5.0)
+            while (await asyncio.wait_for(reader.readline(), 5.0)).strip():
+                pass  # Skip headers
+            parts = request.decode('latin-1').split()
+            url = urlsplit(parts[1] if len(parts) > 1 else '/')
+            if url.path == '/':
+                self._respond(writer, 'text/html; charset=utf-8', DASHBOARD_HTML)
+            elif url.path == '/events':
+                await self._stream(writer)
+            elif url.path == '/records':
+                since = int(parse_qs(url.query).get('since', ['0'])[0])
+                msgs = [msg for seq, msg in self._history if seq > since]
+                self._respond(writer, 'application/json', "[" + ",".join(msgs) + "]")
+            elif url.path == '/status':
+                self._respond(writer, 'application/json', json.dumps(self.status()))
+            else:
+                self._respond(writer, 'text/plain', "Not found", "404 Not Found")
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    def _respond(self, writer, content_type, body, status="200 OK"):
+        body = body.encode('utf-8')
+        header = (
+            "HTTP/1.1 {0}\r\nContent-Type: {1}\r\nContent-Length: {2}\r\n"
+            "Connection: close\r\n\r\n"
+        ).format(status, content_type, len(body))
+        writer.write(header.encode('latin-1') + body)
+
+    async def _stream(self, writer):
+        # Sends records to a client as server-sent events until the server
+        # is stopped or the client disconnects
+        client = asyncio.Queue(maxsize=256)
+        for msg in list(self._history):
+            if not client.full():
+                client.put_nowait(msg)
+        self._clients.add(client)
+        writer.write((
+            "HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+            "Cache-Control: no-cache\r\nConnection: close\r\n\r\n"
+        ).encode('latin-1'))
+        try:
+            while True:
+                msg = await client.get()
+                if msg is None:
+                    break
+                seq, data = msg
+                writer.write("id: {0}\ndata: {1}\n\n".format(seq, data).encode('utf-8'))
+                await writer.drain()
+        finally:
+            self._clients.discard(client)
+
+    def status(self):
+        """Gets the publish and drop counts for the server.
+
+        Returns:
+            dict: The numbers of records published, dropped from the queue,
+            waiting in the queue, and dropped for slow clients, along with
+            the number of connected clients.
+
+        """
+        return {
+            'published': self.published, 'dropped': self.dropped,
+            'queued': len(self._queue), 'client_drops': self._client_drops,
+            'clients': len(self._clients),
+        }
+
+
+
+def main(args):
+    # A simple command-line client that prints each record from a server
+    from urllib.request import urlopen
+    if len(args) > 1:
+        print("Usage: python telemetry.py [http://127.0.0.1:8765]")
+        return 1
+    base = args[0].rstrip('/') if args else "http://127.0.0.1:8765"
+    try:
+        with urlopen(base + "/events") as resp:
+            for line in resp:
+                line = line.decode('utf-8').strip()
+                if line.startswith("data: "):
+                    print(line[6:])
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
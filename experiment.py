@@ -3,8 +3,9 @@
 __author__ = "Austin Hurst"
 
 import os
-import time
+import atexit
 import random
+import itertools
 
 import klibs
 from klibs import P
@@ -14,12 +15,26 @@ from klibs.KLEventQueue import pump, flush
 from klibs.KLUserInterface import any_key, key_pressed, ui_request
 from klibs.KLUtilities import deg_to_px
 from klibs.KLCommunication import message
-from klibs.KLTime import CountDown, precise_time
-
-from PIL import Image, ImageOps, ImageEnhance
+from klibs.KLTime import precise_time
 
+from clock import init_clock, get_clock
 from responselistener import KeyPressListener
-from communication import get_trigger_port, get_tms_controller
+from emg import get_emg_recorder, VirtualStreamSource
+from photodiode import (get_photodiode, measure_latency, load_display_latency,
+	save_display_latency, VirtualPhotodiode)
+from mep import align_pulses, extract_meps
+from signalfile import SignalFile
+from pulses import generate_schedule
+from rmt import estimate_rmt, SimulatedResponder, MEP_CRITERION
+from prefetch import Prefetcher
+from realtime import enable_realtime, pause_gc, resume_gc, LoopTimer
+from profiling import get_tracer, traced, span
+from replay import (SessionRecorder, SessionReplay, RecordingPort,
+	RecordingTMSController, RecordingKeyPressListener, compare_recordings)
+from telemetry import TelemetryServer
+from backup import DatabaseReplicator
+from communication import DeviceDiscovery, VirtualTMSController
+from deviceworker import DeviceWorker
 
 
 WHITE = (255, 255, 255)
@@ -28,12 +43,52 @@ WHITE = (255, 255, 255)
 
 class HLJT(klibs.Experiment):
 
+	@traced('phase')
 	def setup(self):
 
-		# Initialize communication with with the TMS and trigger port
-		self.trigger = get_trigger_port()
-		self.trigger.add_codes(P.trigger_codes)
-		self.magstim = get_tms_controller()
+		# If enabled, start recording a timing trace for the session
+		if P.profile_session:
+			get_tracer().start()
+			atexit.register(self._write_trace)
+
+		# Initialize the experiment clock (real time unless accelerated for testing)
+		self.clock = init_clock(P.clock_rate)
+
+		# If replaying a recorded session, use the same random seed and session
+		# info as the original, and keep the files the replay writes (EMG,
+		# traces, recordings, and database backups) in a replay-only folder and
+		# scratch database, since replay participant IDs can match real ones
+		self.replay = None
+		if P.replay_file:
+			self.replay = SessionReplay(P.replay_file)
+			P.random_seed = self.replay.header['random_seed']
+			P.session_number = self.replay.header['session_number']
+			P.condition = self.replay.header['condition']
+			P.data_dir = os.path.join(P.data_dir, "replay")
+			db_dir = os.path.dirname(P.database_path)
+			P.database_path = os.path.join(db_dir, "HLJT_replay.db")
+
+		# Reseed before any randomization in setup, so that the pulse schedules
+		# and practice trials depend only on the seed (and not on how many
+		# random numbers klibs has used so far), letting replays reproduce them
+		random.seed(P.random_seed)
+
+		# Start probing for the TMS and trigger port in the background (in a
+		# separate worker process if enabled, unless replaying a session or using
+		# an accelerated clock, which both need in-process virtual devices, or
+		# using EMG or the photodiode, which need the LabJack in this process)
+		phase_start = precise_time()
+		use_worker = P.device_worker and not self.replay and P.clock_rate == 1.0
+		if use_worker and (P.emg_enabled or P.display_calibration):
+			print("\nNOTE: EMG and photodiode input need the LabJack in-process, "
+				"not using the device worker.")
+			use_worker = False
+		if use_worker:
+			devices = DeviceWorker(timeout=P.device_discovery_timeout)
+		else:
+			devices = DeviceDiscovery(
+				timeout=P.device_discovery_timeout, virtual=bool(self.replay)
+			)
 
 		# Stimulus sizes
 		fix_size = deg_to_px(0.5)
@@ -42,56 +97,133 @@ class HLJT(klibs.Experiment):
 
 		self.fixation = kld.FixationCross(fix_size, fix_thickness, fill=WHITE)
 
-		tmp = "{0}_{1}_{2}"
-		hands = ['L', 'R']
-		sexes = ['F', 'M']
-		angles = [60, 90, 120, 240, 270, 300]
-
-		self.images = {}
-		for hand in hands:
-			for sex in sexes:
-				for angle in angles:
-					# Load in image file and crop out the transparent regions
-					basename = tmp.format(sex, hand, angle)
-					img = Image.open(os.path.join(P.image_dir, basename + ".png"))
-					img = img.crop(img.getbbox())
-					# If requested, convert hand images to greyscale
-					if P.greyscale_hands:
-						img = ImageOps.grayscale(img)
-						enhancer = ImageEnhance.Brightness(img)
-						img = enhancer.enhance(0.8)
-					# Resize the image while preserving its aspect ratio
-					img = img_scale(img, height=img_height)
-					# Save resized image to dict
-					self.images[basename] = img
+		# Load and preprocess the hand images while devices are being found
+		with span("load_hand_images"):
+			self.images = load_hand_images(img_height)
+		images_done = precise_time()
+
+		# Initialize communication with with the TMS and trigger port
+		with span("wait_for_devices"):
+			self.trigger, self.magstim = devices.wait()
+		self.trigger.add_codes(P.trigger_codes)
+		if self.replay:
+			self.magstim = self.replay.tms_controller()
+		self.tms_virtual = isinstance(self.magstim, VirtualTMSController)
+		devices_done = precise_time()
+
+		# Print a summary of how long each part of startup took
+		phase_times = [
+			("stimulus preprocessing", images_done - phase_start),
+			("trigger port discovery", devices.timings['trigger']),
+			("TMS discovery", devices.timings['tms']),
+			("total (concurrent)", devices_done - phase_start),
+		]
+		print("\nStartup timing:")
+		for phase, secs in phase_times:
+			print("  {0}: {1:.1f} ms".format(phase, secs * 1000))
+
+		# If enabled, measure the display latency for this station with a
+		# photodiode (needs to happen before EMG recording starts)
+		latency_path = os.path.join(P.local_dir, "display_latency.json")
+		if P.display_calibration and not self.replay:
+			self.calibrate_display(latency_path)
+		self.display_latency = load_display_latency(latency_path)
+		if self.display_latency is None:
+			print("\nNOTE: Display latency not calibrated, RTs will not be corrected.")
+			self.display_latency = 0.0
+		else:
+			print("\nDisplay latency correction: {0:.1f} ms".format(self.display_latency * 1000))
+
+		# If enabled, start recording EMG in the background
+		self.emg = None
+		if P.emg_enabled:
+			emg_name = "p{0}_s{1}.emg".format(P.participant_id, P.session_number)
+			emg_path = os.path.join(P.data_dir, "emg", emg_name)
+			self.emg = get_emg_recorder(self.trigger, emg_path, virtual=bool(self.replay))
+			self.emg.start()
+
+		# Start preparing all rotated hand stimuli in the background
+		self.prefetch = Prefetcher()
+		for img_name in self.images.keys():
+			for rotation in self.trial_factory.exp_factors['rotation']:
+				key = ('hand', img_name, rotation)
+				self.prefetch.submit(key, self._build_hand, img_name, rotation)
+
+		# If recording or replaying, record all input and device events
+		self.recorder = None
+		if P.record_session or self.replay:
+			rec_dir = os.path.join(P.data_dir, "recordings")
+			if not os.path.isdir(rec_dir):
+				os.makedirs(rec_dir)
+			rec_name = "p{0}_s{1}{2}.jsonl".format(
+				P.participant_id, P.session_number, "_replay" if self.replay else ""
+			)
+			self.recorder = SessionRecorder(os.path.join(rec_dir, rec_name), {
+				'random_seed': P.random_seed,
+				'session_number': P.session_number,
+				'condition': P.condition,
+				'clock_rate': P.clock_rate,
+			})
+			self.trigger = RecordingPort(self.trigger, self.recorder)
+			self.magstim = RecordingTMSController(self.magstim, self.recorder)
+
+		# If enabled, start mirroring the database to a backup folder
+		self.backup = None
+		if P.backup_dir:
+			self.backup = DatabaseReplicator(P.database_path, P.backup_dir)
+			self.backup.start()
+			self.backup.request()
 
 		# Initialize the response collector
-		self.key_listener = KeyPressListener({
+		keymap = {
 			'p': "R", # Right hand
 			'q': "L", # Left hand
-		})
+		}
+		if self.replay:
+			self.key_listener = self.replay.key_listener(keymap)
+		elif self.recorder:
+			self.key_listener = RecordingKeyPressListener(keymap, self.recorder)
+		else:
+			self.key_listener = KeyPressListener(keymap)
 
 		# Initialize runtime variables
 		self.trials_since_break = 0
 
-		# Gather possible TMS onset delays
-		self.task_blocks = P.tms_pulse_delays.copy()
-		random.shuffle(self.task_blocks)
-		self.tms_pulse_onset = -1  # Default value, gets set later in block()
-
-		# Pre-generate pulse sequence for each block
-		self.pulse_sequences = []
-		for delay in self.task_blocks:
-			seq = generate_pulses(P.trials_per_block)
-			self.pulse_sequences.append(seq)
-
-		# Insert familiarization block
+		# Gather possible TMS onset delays, either one per block or all of them
+		# interleaved within each block
+		delays = P.tms_pulse_delays.copy()
+		random.shuffle(delays)
+		if P.interleave_pulse_delays:
+			self.task_blocks = [delays] * P.blocks_per_experiment
+		else:
+			self.task_blocks = [[delay] for delay in delays]
+		self.tms_pulse_onset = -1  # Default value, gets set later in trial_prep()
+
+		# Pre-generate the trial order, pulse sequence, and pulse onsets for each
+		# block, with pulses balanced across the factors in P.pulse_balance
+		factors = self.trial_factory.exp_factors
+		names = list(factors.keys())
+		cells = list(itertools.product(*[factors[name] for name in names]))
+		self.schedules = []
+		for block_delays in self.task_blocks:
+			trials = [dict(zip(names, c)) for c in random_choices(cells, P.trials_per_block)]
+			balance = [tuple(t[name] for name in P.pulse_balance) for t in trials]
+			order, pulses, onsets = generate_schedule(
+				balance, P.pulse_proportion, P.pulse_max_gap, len(block_delays),
+				seed=random.getrandbits(32)
+			)
+			schedule = []
+			for i, pulse, onset in zip(order, pulses, onsets):
+				trial = dict(trials[i], tms_trial=pulse, tms_pulse_onset=block_delays[onset])
+				schedule.append(trial)
+			self.schedules.append(schedule)
+
+		# Insert familiarization block (without pulses, using the trial factors
+		# generated by klibs)
 		self.first_block = False
 		if P.run_practice_blocks:
 			self.insert_practice_block(1, trial_counts=12)
-			self.task_blocks = [-1] + self.task_blocks
-			practice_pulses = [False] * 12
-			self.pulse_sequences = [practice_pulses] + self.pulse_sequences
+			self.schedules = [None] + self.schedules
 
 		# Determine session type (sham or stim) based on condition
 		session_seq = ["stim", "sham"] if P.condition == "A" else ["sham", "stim"]
@@ -99,19 +231,112 @@ class HLJT(klibs.Experiment):
 
 		# Set power level to a percentage of the participant's RMT
 		self.rmt = self.get_rmt_power()
+		if self.recorder:
+			self.recorder.log('rmt', value=self.rmt)
 		self.stim_power = int(round(self.rmt * 1.2))
 		if self.session_type == "sham":
 			self.stim_power = 15
 		self.magstim.set_power(self.stim_power)
 
+		# If enabled, keep the stimulator armed between pulses (and across breaks)
+		# in the background. When replaying, the trials still skip disarming and
+		# status checks like the original, but the heartbeat itself doesn't run,
+		# since its status checks would use up recorded responses out of order.
+		self.keep_armed = P.tms_heartbeat
+		self.heartbeat_armed = False
+		if P.tms_heartbeat and not self.replay:
+			self.magstim.start_heartbeat(P.tms_heartbeat_interval)
+
+		# If enabled, start serving live session info to the operator dashboard
+		# (the dashboard is optional, so the session continues without it if
+		# the server can't start)
+		self.telemetry = None
+		if P.telemetry_enabled:
+			try:
+				self.telemetry = TelemetryServer(port=P.telemetry_port)
+				self.telemetry.start()
+			except OSError as e:
+				print("\nWarning: unable to start session dashboard ({0}).".format(e))
+				self.telemetry = None
+		if self.telemetry:
+			print("\nSession dashboard: {0}".format(self.telemetry.url))
+			self.telemetry.publish('session', {
+				'participant_id': P.participant_id,
+				'session_number': P.session_number,
+				'session_type': self.session_type,
+				'rmt': self.rmt,
+				'stim_power': self.stim_power,
+			})
+
 		# Run through task instructions
-		if not P.resumed_session:
+		if not (P.resumed_session or self.replay):
 			self.instructions()
 		random.seed(P.random_seed) # Ensures instructions don't affect random seed
 
+		# Preallocate per-trial timers and, if enabled, switch to real-time mode
+		self.fixation_period = self.clock.countdown(P.fixation_duration)
+		self.loop_timer = LoopTimer()
+		if P.realtime_mode:
+			status = enable_realtime(P.realtime_cores)
+			print("\nReal-time mode: priority raised = {0}, cores pinned = {1}".format(
+				status['priority'], status['affinity']
+			))
+
+
+	@traced('phase')
+	def calibrate_display(self, path):
+		# Flash a test patch in the top-left corner of the screen and measure
+		# how long it takes to appear, saving the results for this station
+		photodiode = get_photodiode(self.trigger)
+		patch_size = deg_to_px(P.photodiode_patch_size)
+		patch = kld.Rectangle(patch_size, fill=WHITE)
+
+		def show_patch(lit):
+			fill()
+			if lit:
+				blit(patch, 7, (0, 0))
+			flip()
 
+		msg1 = message(
+			"Attach the photodiode to the top-left corner of the screen.",
+			blit_txt=False
+		)
+		msg2 = message("Press any key to start display calibration.", blit_txt=False)
+		wait_msg(msg1, msg2)
+		stats = measure_latency(photodiode, show_patch, flashes=P.calibration_flashes)
+		photodiode.close()
+		if not stats['n']:
+			print("\nWarning: photodiode did not detect any flashes, calibration not saved.")
+			return
+
+		txt = (
+			"\nDisplay latency ({0} flashes, {1} missed): median {2:.1f} ms, "
+			"sd {3:.1f} ms, 5-95% {4:.1f}-{5:.1f} ms"
+		)
+		print(txt.format(
+			stats['n'], stats['missed'], stats['median'], stats['sd'],
+			stats['p5'], stats['p95']
+		))
+		if isinstance(photodiode, VirtualPhotodiode):
+			print("NOTE: Latency measured with a simulated photodiode, calibration not saved.")
+			return
+		save_display_latency(path, stats)
+
+
+	@traced('phase')
 	def get_rmt_power(self):
 		rmt = self.magstim.get_power()
+		# When replaying, use the RMT confirmed in the original session (which
+		# may have been adjusted or estimated after the first power query)
+		if self.replay:
+			recorded = self.replay.rmt
+			return rmt if recorded is None else recorded
+		# If enabled, estimate the RMT automatically before confirming it
+		if P.rmt_auto:
+			estimate = self.estimate_rmt()
+			if estimate is not None:
+				rmt = estimate
+				self.magstim.set_power(rmt)
 		txt = "Is {0}% the correct RMT for the participant? (Yes / No)"
 		msg1 = message(txt.format(rmt), blit_txt = False)
 		msg2 = message(
@@ -149,13 +374,69 @@ class HLJT(klibs.Experiment):
 				rmt_temp -= 1
 			elif key_pressed('return', queue=q):
 				self.magstim.set_power(rmt_temp)
-				time.sleep(0.1)  # Give the TMS a break between commands
+				self.clock.sleep(0.1)  # Give the TMS a break between commands
 				rmt = self.magstim.get_power()
 				rmt_confirmed = True
 
 		return rmt
 
 
+	@traced('phase')
+	def estimate_rmt(self):
+		# Estimates the participant's RMT adaptively using MEPs, logging each
+		# pulse to the database
+		if not self.emg:
+			print("\nWarning: automatic RMT estimation requires EMG recording.")
+			return None
+		# MEPs are only simulated for a virtual stimulator, so that real pulses
+		# are never paired with simulated responses
+		responder = None
+		if isinstance(self.emg.source, VirtualStreamSource):
+			if not self.tms_virtual:
+				print("\nWarning: automatic RMT estimation requires real EMG with a real stimulator.")
+				return None
+			responder = SimulatedResponder(self.emg.source, rmt=P.rmt_simulated)
+
+		def show_progress(est, level, amplitude):
+			self.db.insert({
+				"participant_id": P.participant_id,
+				"session_num": P.session_number,
+				"pulse_num": est.pulses,
+				"power": level,
+				"amplitude": amplitude,
+				"mep": amplitude >= MEP_CRITERION,
+				"estimate": est.estimate,
+				"posterior_sd": est.sd,
+			}, table="rmt_pulses")
+			txt = "Pulse {0}: {1}% power, {2:.0f} uV\nRMT estimate: {3:.1f}% (sd {4:.1f}%)"
+			progress = message(
+				txt.format(est.pulses, level, amplitude * 1e6, est.estimate, est.sd),
+				blit_txt=False, align='center'
+			)
+			fill()
+			blit(progress, 5, P.screen_c)
+			flip()
+			ui_request()
+
+		msg1 = message("Automatic RMT estimation", blit_txt=False)
+		msg2 = message("Press any key to start.", blit_txt=False)
+		wait_msg(msg1, msg2)
+		start = self.clock.time()
+		est = estimate_rmt(
+			self.magstim, self.trigger, self.emg, window=P.mep_window,
+			max_pulses=P.rmt_max_pulses, max_sd=P.rmt_max_sd,
+			interval=P.rmt_pulse_interval, max_power=P.rmt_max_power,
+			responder=responder, callback=show_progress
+		)
+		txt = "\nRMT estimate: {0:.1f}% (sd {1:.2f}%) after {2} pulses in {3:.1f} s"
+		print(txt.format(est.estimate, est.sd, est.pulses, self.clock.time() - start))
+		if est.estimate > P.rmt_max_power:
+			txt = "Warning: RMT estimate is above the maximum power ({0}%), capping it."
+			print(txt.format(P.rmt_max_power))
+		return min(int(round(est.estimate)), P.rmt_max_power)
+
+
+	@traced('phase')
 	def instructions(self):
 
 		header_loc = (P.screen_c[0], int(P.screen_y * 0.2))
@@ -191,7 +472,7 @@ class HLJT(klibs.Experiment):
 		demo_hand_r = NumpySurface(self.images["F_R_90"], width=hand_width)
 
 		flush()
-		min_wait = CountDown(1.5)
+		min_wait = self.clock.countdown(1.5)
 		done = False
 		while not done:
 			q = pump(True)
@@ -209,7 +490,7 @@ class HLJT(klibs.Experiment):
 					done = True
 			flip()
 
-		min_wait = CountDown(1.5)
+		min_wait = self.clock.countdown(1.5)
 		done = False
 		while not done:
 			q = pump(True)
@@ -225,10 +506,14 @@ class HLJT(klibs.Experiment):
 			flip()
 
 
+	@traced('phase')
 	def block(self):
-		# Get the TMS pulse onset and randomized pulse sequence for the current block
-		self.tms_pulse_onset = self.task_blocks[P.block_number - 1]
-		self.pulse_sequence = self.pulse_sequences[P.block_number - 1]
+		# Back up the database between blocks
+		if self.backup:
+			self.backup.request()
+
+		# Get the pre-generated trial schedule for the current block
+		self.schedule = self.schedules[P.block_number - 1]
 
 		if P.resumed_session:
 			self.trials_since_break = P.trial_number % P.break_interval
@@ -255,35 +540,85 @@ class HLJT(klibs.Experiment):
 			self.first_block = True
 
 
+	@traced('phase')
 	def trial_prep(self):
 		# Check if it's time for a break
+		stim_armed = None
 		if self.trials_since_break >= P.break_interval:
-			self.magstim.disarm()
+			# Unless the heartbeat is keeping it armed, disarm the stimulator
+			# during the break (making the status from the last trial out of date)
+			if not self.keep_armed:
+				self.prefetch.discard('armed')
+				self.magstim.disarm()
+				stim_armed = False
 			self.task_break()
 			self.trials_since_break = 0
 
-		# Prepare (and rotate) the hand image for the trial
+		# Hold off heartbeat re-arms until the response loop is over, so that a
+		# background re-arm can't leave the stimulator not ready for the pulse
+		self.magstim.pause_heartbeat()
+
+		# Keep database backups from running until the trial's data is written
+		if self.backup:
+			self.backup.pause()
+
+		# Get the factors, pulse, and pulse onset for the trial from the block's
+		# schedule, replacing the factors chosen by klibs
+		self.tms_trial = False
+		self.tms_pulse_onset = -1
+		if self.schedule:
+			for name, value in self.schedule[P.trial_number - 1].items():
+				setattr(self, name, value)
+
+		# Get the (rotated) hand image for the trial, prepared in the background
 		img_name = "{0}_{1}_{2}".format(self.sex, self.hand, self.angle)
-		img = self.images[img_name].rotate(self.rotation, expand=True)
-		self.hand_image = NumpySurface(img)
+		self.hand_image = self.prefetch.take(
+			('hand', img_name, self.rotation), keep=True,
+			fallback=lambda: self._build_hand(img_name, self.rotation)
+		)
+
+		# Ensure stimulator is armed before starting trial, using the status
+		# check started at the end of the previous trial if available. If the
+		# heartbeat is keeping it armed, it only needs to be armed once.
+		if not P.practicing and self.keep_armed:
+			if not self.heartbeat_armed:
+				self.magstim.arm()
+				self.heartbeat_armed = True
+			stim_armed = True
+		elif not P.practicing:
+			if stim_armed is None:
+				stim_armed = self.prefetch.take('armed', fallback=self._check_armed)
+			if not stim_armed:
+				self.magstim.arm()
+		self.stim_armed = stim_armed
 
-		# Determine whether the current trial is a TMS pulse trial
-		self.tms_trial = self.pulse_sequence[P.trial_number - 1]
 
-		# Ensure stimulator is armed before starting trial
-		if not P.practicing and not self.magstim.armed:
-			self.magstim.arm()
+	def _build_hand(self, img_name, rotation):
+		img = self.images[img_name].rotate(rotation, expand=True)
+		return NumpySurface(img)
 
 
+	def _check_armed(self):
+		return self.magstim.armed
+
+
+	@traced('phase')
 	def trial(self):
 
+		# In real-time mode, prevent garbage collection pauses during the trial
+		if P.realtime_mode:
+			pause_gc()
+
 		# Draw fixation and wait fixation period
 		fill()
 		blit(self.fixation, 5, P.screen_c)
 		flip()
+		if self.emg:
+			self.emg.begin_trial(self.trial_id)
+			self.emg.mark(P.trigger_codes['trial_start'])
 		self.trigger.send('trial_start')
-		fixation_period = CountDown(P.fixation_duration)
-		while fixation_period.counting():
+		self.fixation_period.reset()
+		while self.fixation_period.counting():
 			ui_request()
 
 		# Show the hand stimulus on the screen
@@ -293,28 +628,38 @@ class HLJT(klibs.Experiment):
 
 		# Initialize timers and variables for the response collection loop
 		self.key_listener.init()
-		hand_shown = precise_time()
+		# Correct the onset for the delay between the flip and the stimulus
+		# actually appearing, so pulse delays are relative to the true onset
+		hand_shown = self.clock.time() + self.display_latency
+		if self.recorder:
+			self.recorder.log('stim_on', t=hand_shown)
 		pulse_delay = self.tms_pulse_onset / 1000
 		allow_status_check = self.tms_trial == True
 		allow_fire = self.tms_trial == True
 		tms_fired = False
+		pulse_lag = None
 
 		# Enter the response collection loop
 		response = None
+		self.loop_timer.start()
 		while not response:
+			self.loop_timer.tick()
 			# Check for keypress responses
 			q = pump(True)
 			ui_request(queue=q)
 			response = self.key_listener.listen(q)
 			# 100 ms before pulse, make sure TMS is ready/able to fire
-			elapsed = precise_time() - hand_shown
+			elapsed = self.clock.time() - hand_shown
 			if allow_status_check and elapsed > (pulse_delay - 0.1):
 				if not self.magstim.ready:
 					allow_fire = False
 				allow_status_check = False
 			# After pulse delay has elapsed, fire TMS
 			elif allow_fire and elapsed > pulse_delay:
+				if self.emg:
+					self.emg.mark(P.trigger_codes['fire_tms'])
 				self.trigger.send('fire_tms')
+				pulse_lag = elapsed - pulse_delay
 				tms_fired = True
 				allow_fire = False
 				if P.development_mode:
@@ -327,9 +672,18 @@ class HLJT(klibs.Experiment):
 					blit(self.hand_image, 5, P.screen_c)
 					flip()
 
+		loop_periods = self.loop_timer.stop()
+		self.magstim.resume_heartbeat()
 		self.key_listener.cleanup()
+		if self.emg:
+			self.emg.end_trial(self.trial_id)
 
-		return {
+		# Start checking the stimulator status for the next trial in the background
+		# (not needed if the heartbeat is keeping it armed)
+		if not self.keep_armed:
+			self.prefetch.submit('armed', self._check_armed)
+
+		trial_data = {
 			"session_num": P.session_number,
 			"block_num": P.block_number,
 			"trial_num": P.trial_number,
@@ -340,19 +694,43 @@ class HLJT(klibs.Experiment):
 			"tms_onset": self.tms_pulse_onset,
 			"sham": self.session_type == "sham",
 			"judgement": response.value,
-			"rt": response.rt,
+			"rt": response.rt - self.display_latency * 1000,
 			"accuracy": response.value == self.hand,
 			"tms_trial": self.tms_trial,
 			"tms_fired": tms_fired,
 			"rmt": self.rmt,
 		}
-
-
+		if self.recorder:
+			self.recorder.log('trial', data=trial_data)
+		if self.telemetry:
+			self.telemetry.publish('trial', {
+				'trial': dict(trial_data),
+				'timing': {
+					'pulse_lag_ms': None if pulse_lag is None else pulse_lag * 1000,
+					'loop_max_ms': loop_periods.max() * 1000 if len(loop_periods) else None,
+					'loop_iterations': len(loop_periods),
+				},
+				'tms': {
+					'armed': self.stim_armed,
+					'heartbeat_rearms': self.magstim.heartbeat_rearms,
+					'heartbeat_failures': self.magstim.heartbeat_failures,
+				},
+			})
+
+		return trial_data
+
+
+	@traced('phase')
 	def task_break(self):
+		if self.backup:
+			self.backup.request()
+			self.backup.resume()
+		if self.replay:
+			return
 		msg1 = message("Take a break!", blit_txt=False)
 		msg2 = message("Press space to continue.", blit_txt=False)
 		flush()
-		break_minimum = CountDown(1.5)
+		break_minimum = self.clock.countdown(1.5)
 		done = False
 		while not done:
 			fill()
@@ -364,15 +742,132 @@ class HLJT(klibs.Experiment):
 				done = True
 
 
+	@property
+	def trial_id(self):
+		# The unique identifiers for the current trial in the database
+		return (P.participant_id, P.session_number, P.block_number, P.trial_number)
+
+
+	@traced('phase')
 	def trial_clean_up(self):
 		self.trials_since_break += 1
+		if self.backup:
+			self.backup.resume()
+		if self.recorder:
+			self.recorder.flush()
+		if P.realtime_mode:
+			resume_gc()
 
 
 	def clean_up(self):
+		# Write the timing trace only once clean-up (and its span) has finished
+		try:
+			self._clean_up()
+		finally:
+			self._write_trace()
+
+
+	@traced('phase', name='HLJT.clean_up')
+	def _clean_up(self):
 		msg1 = message("You're all done, thanks for participating!", blit_txt=False)
 		msg2 = message("Press any key to exit.", blit_txt=False)
 		wait_msg(msg1, msg2, delay=1.5)
 
+		# If replaying a session, check the replay against the original
+		if self.recorder:
+			self.recorder.close()
+		if self.replay:
+			problems = compare_recordings(
+				P.replay_file, self.recorder.path,
+				P.replay_rt_tolerance, P.replay_onset_tolerance
+			)
+			print("\nReplay differences from original session:")
+			for problem in problems:
+				print("  " + problem)
+			if not problems:
+				print("  None")
+
+		# Wait for any background prep to finish and report how well it worked
+		self.prefetch.close()
+		print("\n" + self.prefetch.summary())
+		mode = "on" if P.realtime_mode else "off"
+		print("Response loop timing (real-time mode {0}):".format(mode))
+		print(self.loop_timer.summary())
+
+		# Report any problems keeping the stimulator armed
+		if P.tms_heartbeat and not self.replay:
+			txt = "TMS heartbeat: {0} re-arms, {1} failures"
+			print(txt.format(self.magstim.heartbeat_rearms, self.magstim.heartbeat_failures))
+
+		# Stop the session dashboard, reporting any dropped records
+		if self.telemetry:
+			self.telemetry.close()
+			status = self.telemetry.status()
+			txt = "Telemetry: {0} records published, {1} dropped"
+			print(txt.format(status['published'], status['dropped'] + status['client_drops']))
+
+		# Stop recording EMG and close the connections to the TMS and trigger port
+		# (MEPs from a replay's simulated EMG are never saved to the database)
+		if self.emg:
+			self.emg.stop()
+			if not self.replay:
+				self.save_meps()
+		self.magstim.close()
+		self.trigger.close()
+
+		# Make sure the database backup is up to date before exiting
+		if self.backup:
+			if not self.backup.sync(timeout=30.0):
+				print("Warning: final database backup did not finish.")
+			self.backup.close()
+			txt = "Database backup: {0} passes, {1} pages written to {2}"
+			print(txt.format(self.backup.passes, self.backup.pages_written, self.backup.mirror))
+
+
+	def _write_trace(self):
+		# Write out the timing trace for the session, if recording (also called
+		# at exit, so sessions that end early still get their trace)
+		tracer = get_tracer()
+		if not tracer.enabled:
+			return
+		tracer.stop()
+		trace_dir = os.path.join(P.data_dir, "trace")
+		if not os.path.isdir(trace_dir):
+			os.makedirs(trace_dir)
+		trace_name = "p{0}_s{1}_trace.json".format(P.participant_id, P.session_number)
+		tracer.write(os.path.join(trace_dir, trace_name))
+
+
+	def save_meps(self):
+		# Extract MEP features for all pulse trials in the session and write them
+		# to the database, using the trial bounds from the signal file's index
+		sig = SignalFile(self.emg.path)
+		trials, onsets = align_pulses(sig.events, sig.trials, P.trigger_codes['fire_tms'])
+		samples = sig.data
+		meps = extract_meps(
+			samples, onsets, self.emg.rate,
+			window=P.mep_window, max_rms=P.mep_max_rms
+		)
+		for i, trial_id in enumerate(trials):
+			block_num, trial_num = trial_id[2:]
+			for chan in range(samples.shape[1]):
+				self.db.insert({
+					"participant_id": P.participant_id,
+					"session_num": P.session_number,
+					"block_num": block_num,
+					"trial_num": trial_num,
+					"channel": P.emg_channels[chan],
+					"amplitude": nan_to_none(meps['amplitude'][i, chan]),
+					"latency": nan_to_none(meps['latency'][i, chan]),
+					"pre_rms": nan_to_none(meps['pre_rms'][i, chan]),
+					"rejected": bool(meps['rejected'][i, chan]),
+				}, table="meps")
+
+
+
+def nan_to_none(x):
+	# Converts NaN values to None so they get written to the database as NULL
+	return None if x != x else float(x)
 
 
 def random_choices(x, n=1):
@@ -387,20 +882,40 @@ def random_choices(x, n=1):
 	return out[:n]
 
 
-def generate_pulses(n_trials):
-	# Maximum allowable gap between pulses is 8 trials, otherwise we risk the
-	# TMS disarming from inactivity. The following code ensures that the maximum
-	# possible interval between pulses is 8 trials.
-	pulses = []
-	stim_sub_block = [True] * 4 + [False] * 4
-	while len(pulses) < n_trials:
-		random.shuffle(stim_sub_block)
-		pulses += stim_sub_block
-	return pulses
+def load_hand_images(height):
+	# Load, crop, and resize all hand images, returning them in a dict. PIL is
+	# imported here so it doesn't slow down importing the experiment.
+	from PIL import Image, ImageOps, ImageEnhance
+
+	tmp = "{0}_{1}_{2}"
+	hands = ['L', 'R']
+	sexes = ['F', 'M']
+	angles = [60, 90, 120, 240, 270, 300]
+
+	images = {}
+	for hand in hands:
+		for sex in sexes:
+			for angle in angles:
+				# Load in image file and crop out the transparent regions
+				basename = tmp.format(sex, hand, angle)
+				img = Image.open(os.path.join(P.image_dir, basename + ".png"))
+				img = img.crop(img.getbbox())
+				# If requested, convert hand images to greyscale
+				if P.greyscale_hands:
+					img = ImageOps.grayscale(img)
+					enhancer = ImageEnhance.Brightness(img)
+					img = enhancer.enhance(0.8)
+				# Resize the image while preserving its aspect ratio
+				img = img_scale(img, height=height)
+				# Save resized image to dict
+				images[basename] = img
+
+	return images
 
 
 def img_scale(img, width=None, height=None):
 	# Resize an image while perserving its aspect ratio
+	from PIL import Image
 	aspect = img.size[0] / float(img.size[1])
 	if height:
 		if width:
@@ -416,12 +931,16 @@ def img_scale(img, width=None, height=None):
 
 
 def wait_msg(msg1, msg2, delay=1.5):
+	# Skip prompts when replaying a recorded session
+	if P.replay_file:
+		return
+
 	# Try sizing/positioning relative to first message
 	y1_loc = P.screen_y * 0.45 + (msg1.height / 2)
 	y2_loc = y1_loc + msg2.height
 
 	# Show first part of message and wait for the delay
-	message_interval = CountDown(delay)
+	message_interval = get_clock().countdown(delay)
 	while message_interval.counting():
 		ui_request() # Allow quitting during loop
 		fill()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The task's helper modules live in ExpAssets/Resources/code, which klibs
+# adds to the import path when running the experiment
+CODE_DIR = os.path.join(os.path.dirname(__file__), "..", "ExpAssets", "Resources", "code")
+sys.path.insert(0, os.path.abspath(CODE_DIR))
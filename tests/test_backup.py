@@ -0,0 +1,53 @@
+import os
+import sqlite3
+
+from backup import DatabaseReplicator, _copy_changed_pages
+
+
+def _rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT x FROM t ORDER BY x").fetchall()
+    finally:
+        conn.close()
+
+
+def test_mirror_is_swapped_in_whole(tmp_path):
+    db = str(tmp_path / "study.db")
+    conn = sqlite3.connect(db)
+    conn.execute("CREATE TABLE t (x INTEGER)")
+    conn.executemany("INSERT INTO t VALUES (?)", [(i,) for i in range(1000)])
+    conn.commit()
+
+    rep = DatabaseReplicator(db, str(tmp_path / "mirror"))
+    rep.start()
+    try:
+        assert rep.sync(timeout=10)
+        conn.execute("INSERT INTO t VALUES (1000)")
+        conn.commit()
+        assert rep.sync(timeout=10)
+        assert rep.sync(timeout=10)
+    finally:
+        rep.close()
+        conn.close()
+    assert rep.error is None
+    assert _rows(rep.mirror) == [(i,) for i in range(1001)]
+    # The older generation is kept for the next pass, and nothing is left
+    # mid-swap
+    assert os.path.exists(rep.mirror + ".next")
+    assert not os.path.exists(rep.mirror + ".old")
+
+
+def test_page_copy_waits_while_paused(tmp_path):
+    src = tmp_path / "src.db"
+    conn = sqlite3.connect(str(src))
+    conn.execute("CREATE TABLE t (x TEXT)")
+    conn.executemany("INSERT INTO t VALUES (?)", [("x" * 500,) for i in range(100)])
+    conn.commit()
+    conn.close()
+
+    waits = []
+    written = _copy_changed_pages(str(src), str(tmp_path / "dst.db"), 4, lambda: waits.append(1))
+    assert written > 4
+    # One wait per step of 4 pages, plus one before syncing
+    assert len(waits) >= written // 4 + 1
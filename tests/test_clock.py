@@ -0,0 +1,57 @@
+import threading
+
+import pytest
+
+from clock import VirtualClock, CountDown
+
+
+def test_virtual_sleep_skips_ahead():
+    clock = VirtualClock(rate=1.0)
+    start = clock.time()
+    clock.sleep(60.0)
+    assert clock.time() - start == pytest.approx(60.0, abs=0.05)
+
+
+def test_countdown_on_virtual_clock():
+    clock = VirtualClock(rate=1.0)
+    timer = CountDown(3.5, clock=clock)
+    assert timer.counting()
+    clock.sleep(3.5)
+    assert not timer.counting()
+    assert timer.remaining() == 0.0
+
+
+def test_background_sleep_does_not_move_clock():
+    clock = VirtualClock(rate=1000.0)
+    done = threading.Event()
+
+    def background():
+        for i in range(10):
+            clock.sleep(10.0)
+        done.set()
+
+    start = clock.time()
+    t = threading.Thread(target=background, daemon=True)
+    t.start()
+    # 10 x 10 s on a 1000x clock takes ~0.1 s of real time
+    assert done.wait(5.0)
+    elapsed = clock.time() - start
+    assert elapsed >= 100.0
+    assert elapsed < 5000.0  # i.e. not skipped ahead at CPU speed
+    t.join()
+
+
+def test_background_sleep_wakes_when_driver_skips_ahead():
+    clock = VirtualClock(rate=1.0)
+    woke = threading.Event()
+
+    def background():
+        clock.sleep(30.0)
+        woke.set()
+
+    t = threading.Thread(target=background, daemon=True)
+    t.start()
+    assert not woke.wait(0.1)
+    clock.sleep(30.0)
+    assert woke.wait(1.0)
+    t.join()
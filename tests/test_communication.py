@@ -0,0 +1,152 @@
+import os
+import pty
+import time
+import fcntl
+import struct
+
+import pytest
+
+from communication import VirtualTMSController
+
+
+def test_heartbeat_rearms_before_timeout():
+    tms = VirtualTMSController(None)
+    tms.arm()
+    tms.start_heartbeat(interval=0.01, rearm_after=0.05)
+    time.sleep(0.2)
+    tms.stop_heartbeat()
+    # Re-armed on schedule while the stimulator never reported being disarmed
+    assert tms.armed
+    assert 2 <= tms.heartbeat_rearms <= 20
+    assert tms.heartbeat_failures == 0
+
+
+def test_heartbeat_leaves_disarmed_stimulator_alone():
+    tms = VirtualTMSController(None)
+    tms.arm()
+    tms.disarm()
+    tms.start_heartbeat(interval=0.01, rearm_after=0.0)
+    time.sleep(0.1)
+    tms.stop_heartbeat()
+    assert not tms.armed
+    assert tms.heartbeat_rearms == 0
+
+
+def test_heartbeat_holds_rearm_until_pause_ends():
+    tms = VirtualTMSController(None)
+    tms.arm()
+    tms.pause_heartbeat()
+    tms.start_heartbeat(interval=0.01, rearm_after=0.0)
+    time.sleep(0.1)
+    # No re-arms (or skipped checks) while paused, then one once resumed
+    assert tms.heartbeat_rearms == 0
+    tms.resume_heartbeat()
+    time.sleep(0.1)
+    tms.stop_heartbeat()
+    assert tms.heartbeat_rearms >= 1
+
+
+def _configure(monkeypatch, **params):
+    from klibs import P
+    defaults = {
+        'trigger_backend': None, 'parallel_port': None, 'serial_trigger_port': None,
+        'trigger_codes': {'trial_start': 2, 'fire_tms': 17},
+        'emg_enabled': False, 'display_calibration': False,
+    }
+    defaults.update(params)
+    for name, value in defaults.items():
+        monkeypatch.setattr(P, name, value, raising=False)
+
+
+def test_serial_port_only_fires_tms(monkeypatch):
+    pytest.importorskip('serial')
+    import serial.serialposix as posix
+    from communication import SerialTTLPort
+    _configure(monkeypatch)
+
+    # Pseudo-terminals have no modem control lines, so record the line
+    # changes that pyserial makes instead
+    lines = []
+    def ioctl(fd, request, arg=0, *args):
+        if request in (posix.TIOCMBIS, posix.TIOCMBIC):
+            state = request == posix.TIOCMBIS
+            lines.append((struct.unpack('I', arg)[0], state))
+            return arg
+        return fcntl.ioctl(fd, request, arg, *args)
+    monkeypatch.setattr(posix.fcntl, 'ioctl', ioctl)
+
+    master, slave = pty.openpty()
+    try:
+        port = SerialTTLPort(os.ttyname(slave))
+        port.add_codes({'trial_start': 2, 'fire_tms': 17})
+        del lines[:]
+        port._write_trigger(port.codes['trial_start'])
+        assert all(not state for _, state in lines)
+        del lines[:]
+        port._write_trigger(port.codes['fire_tms'])
+        assert (posix.TIOCM_RTS, True) in lines
+        assert (posix.TIOCM_DTR, True) in lines
+        port.close()
+    finally:
+        os.close(master)
+        os.close(slave)
+
+
+def test_parallel_port_writes_data_pins(monkeypatch, tmp_path):
+    from communication import ParallelPort, PPCLAIM, PPRELEASE, PPWDATA
+    calls = []
+    def ioctl(fd, request, arg=0):
+        calls.append((request, arg))
+    monkeypatch.setattr(fcntl, 'ioctl', ioctl)
+
+    # A plain file stands in for the ppdev device
+    device = tmp_path / "parport0"
+    device.write_bytes(b"")
+    port = ParallelPort(str(device))
+    port._write_trigger(17)
+    port.close()
+
+    assert calls[0][0] == PPCLAIM
+    data = [arg for request, arg in calls if request == PPWDATA]
+    assert data == [b'\x00', b'\x11', b'\x00']
+    assert calls[-1][0] == PPRELEASE
+
+
+def test_auto_selection_skips_unconfigured_backends(monkeypatch, tmp_path):
+    import communication
+    opened = []
+    def open_port(backend):
+        opened.append(backend)
+        return communication.VirtualPort(None) if backend == 'virtual' else None
+    monkeypatch.setattr(communication, '_open_trigger_port', open_port)
+    _configure(monkeypatch, serial_trigger_port=str(tmp_path / "ttyUSB1"))
+
+    port = communication.get_trigger_port()
+    assert isinstance(port, communication.VirtualPort)
+    assert 'serial' not in opened
+
+
+def test_parallel_port_requires_configuration(monkeypatch):
+    import communication
+    _configure(monkeypatch)
+    assert communication._open_trigger_port('parallel') is None
+
+
+def test_parallel_writes_are_traced(monkeypatch, tmp_path):
+    from communication import ParallelPort
+    from profiling import get_tracer
+    monkeypatch.setattr(fcntl, 'ioctl', lambda fd, request, arg=0: None)
+    device = tmp_path / "parport0"
+    device.write_bytes(b"")
+    port = ParallelPort(str(device))
+    tracer = get_tracer()
+    tracer.start()
+    try:
+        port._write_trigger(17)
+    finally:
+        tracer.stop()
+    port.close()
+    spans = [e for e in tracer.events() if e['ph'] == 'X']
+    assert [(e['name'], e['cat']) for e in spans] == [
+        ('ParallelPort._write_trigger', 'parallel')
+    ]
@@ -0,0 +1,43 @@
+import time
+
+import numpy as np
+
+from communication import TriggerPort, VirtualTMSController
+from deviceworker import (_PulseResets, _run_command, STATUS_FIELDS, TRIGGER,
+    QUERY_ARMED)
+
+
+class LogPort(TriggerPort):
+    # Records every value written to the port
+
+    def _hardware_init(self):
+        self.written = []
+
+    def _write_trigger(self, value):
+        self.written.append(value)
+
+
+def test_trigger_reset_is_scheduled_not_slept():
+    port = LogPort(None)
+    pulses = _PulseResets(port)
+    tms = VirtualTMSController(None)
+    status = np.zeros(len(STATUS_FIELDS))
+
+    start = time.perf_counter()
+    _run_command(TRIGGER, 17, 0.05, start, pulses, tms, status)
+    _run_command(QUERY_ARMED, 0, 0, start, pulses, tms, status)
+    assert time.perf_counter() - start < 0.04
+    assert port.written == [17]
+
+    time.sleep(pulses.timeout(1.0))
+    pulses.poll()
+    assert port.written == [17, 0]
+
+
+def test_back_to_back_triggers_stay_separate():
+    port = LogPort(None)
+    pulses = _PulseResets(port)
+    pulses.write(17, 0.01)
+    pulses.write(2, 0.01)
+    pulses.finish()
+    assert port.written == [17, 0, 2, 0]
@@ -0,0 +1,101 @@
+import time
+import threading
+
+import numpy as np
+
+from communication import U3Port
+from emg import EMGRecorder, VirtualStreamSource, U3StreamSource, U3_DIGITAL_STATE
+from signalfile import SignalWriter
+
+
+def test_dropped_samples_keep_later_samples_aligned(tmp_path):
+    path = str(tmp_path / "test.emg")
+    rec = EMGRecorder(VirtualStreamSource(1, 1000), path, buffer_secs=0.01)
+    rec._file = SignalWriter(path, 1, 1000)
+    buf = rec._buffer
+    buf.write(np.arange(6, dtype=np.float32)[:, None])
+    buf.write(np.ones((6, 1), dtype=np.float32))  # Too big, gets dropped
+    rec._drain_buffer()
+    buf.write(np.full((3, 1), 7, dtype=np.float32))
+    rec._drain_buffer()
+    rec._file.close()
+
+    data = np.fromfile(path, dtype=np.float32)
+    assert rec.samples == len(data) == 15
+    assert rec.dropped == 6
+    assert np.isnan(data[6:12]).all()
+    assert (data[12:] == 7).all()
+
+
+def test_signal_writer_resumes_existing_recording(tmp_path):
+    from signalfile import SignalFile
+    path = str(tmp_path / "resume.emg")
+    writer = SignalWriter(path, 1, 1000, grow=100)
+    writer.append(np.ones((10, 1), dtype=np.float32))
+    writer.add_trial((1, 1, 1, 1), start=0, end=10)
+    writer.sync()
+    writer.append(np.ones((5, 1), dtype=np.float32))  # Never synced
+    writer._index.write('{"event": 2, "sam')  # Crash mid-entry
+    writer._index.flush()
+
+    writer = SignalWriter(path, 1, 1000)
+    assert writer.length == 10
+    writer.append(np.full((10, 1), 2, dtype=np.float32))
+    writer.add_trial((1, 1, 1, 2), start=10, end=20)
+    writer.close()
+
+    sig = SignalFile(path)
+    assert len(sig) == 20
+    assert (sig.data[:10] == 1).all() and (sig.data[10:] == 2).all()
+    assert sig.trials[(1, 1, 1, 1)] == [0, 10]
+    assert sig.trials[(1, 1, 1, 2)] == [10, 20]
+
+
+class SlowStreamU3(object):
+    # A LabJack U3 whose stream reads take 200 ms, like a full streamData
+    # request of packets
+
+    def getCalibrationData(self):
+        pass
+
+    def configU3(self, **kwargs):
+        pass
+
+    def configIO(self, **kwargs):
+        pass
+
+    def streamConfig(self, **kwargs):
+        pass
+
+    def streamStart(self):
+        pass
+
+    def streamStop(self):
+        pass
+
+    def streamData(self):
+        while True:
+            time.sleep(0.2)
+            yield {
+                'errors': 0, 'missed': 0, 'AIN8': [0.0] * 10,
+                'AIN{0}'.format(U3_DIGITAL_STATE): [0] * 10,
+            }
+
+    def writeRegister(self, addr, value):
+        pass
+
+
+def test_stream_reads_dont_block_trigger_writes(monkeypatch):
+    from klibs import P
+    monkeypatch.setattr(P, 'labjack_port', 'FIO', raising=False)
+    port = U3Port(SlowStreamU3())
+    source = U3StreamSource(port, [8], 1000)
+    source.start()
+    reader = threading.Thread(target=source.read)
+    reader.start()
+    time.sleep(0.05)  # Let the read get underway
+
+    start = time.perf_counter()
+    port._write_trigger(17)
+    assert time.perf_counter() - start < 0.05
+    reader.join()
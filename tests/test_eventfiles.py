@@ -0,0 +1,29 @@
+import sqlite3
+
+from eventfiles import session_fingerprints, TRIAL_FIELDS
+
+
+def test_fingerprint_changes_when_trial_is_edited(tmp_path):
+    db = str(tmp_path / "study.db")
+    conn = sqlite3.connect(db)
+    cols = ", ".join(TRIAL_FIELDS)
+    conn.execute(
+        "CREATE TABLE trials (id INTEGER PRIMARY KEY, participant_id, session_num, {0})".format(cols)
+    )
+    for trial in range(1, 4):
+        values = [1, trial, 'L', 'F', 90, 0, 250, 'L', 812.5, 1, 1, 1]
+        conn.execute(
+            "INSERT INTO trials (participant_id, session_num, {0}) VALUES (1, 1, {1})".format(
+                cols, ", ".join("?" * len(TRIAL_FIELDS))
+            ), values
+        )
+    conn.commit()
+
+    before = session_fingerprints(db)
+    assert before[(1, 1)][:3] == [3, 1, 3]
+    conn.execute("UPDATE trials SET accuracy = 0 WHERE id = 2")
+    conn.commit()
+    after = session_fingerprints(db)
+    conn.close()
+    assert after[(1, 1)][:3] == before[(1, 1)][:3]
+    assert after != before
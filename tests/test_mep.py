@@ -0,0 +1,26 @@
+import numpy as np
+
+from mep import align_pulses, extract_meps
+
+
+def test_align_pulses_uses_trial_bounds():
+    trials = {
+        (1, 1, 1, 1): [0, 1000],
+        (1, 1, 1, 2): [1000, 2000],
+        (1, 1, 1, 3): [2000, 3000],
+        (1, 1, 1, 4): [3000, None],  # Incomplete trial
+    }
+    # No trial_start marker for trial 2, an extra pulse in trial 3, and a
+    # pulse between trials
+    markers = [(10, 2), (500, 17), (1500, 17), (2010, 2), (2500, 17),
+               (2600, 17), (3010, 2), (3500, 17)]
+    ids, onsets = align_pulses(markers, trials, 17)
+    assert ids == [(1, 1, 1, 1), (1, 1, 1, 2), (1, 1, 1, 3), (1, 1, 1, 4)]
+    assert onsets.tolist() == [500, 1500, 2500, 3500]
+
+
+def test_extract_meps_rejects_dropped_samples():
+    samples = np.zeros((2000, 1), dtype=np.float32)
+    samples[520:530] = np.nan  # Inside the first response window
+    meps = extract_meps(samples, [500, 1500], 1000)
+    assert meps['rejected'][:, 0].tolist() == [True, False]
@@ -0,0 +1,36 @@
+import pytest
+
+from communication import U3Port
+from photodiode import U3Photodiode
+
+
+class FakeU3(object):
+    # Records the configuration calls made to a LabJack U3
+
+    def __init__(self):
+        self.analog = None
+
+    def getCalibrationData(self):
+        pass
+
+    def configU3(self, **kwargs):
+        pass
+
+    def configIO(self, FIOAnalog=0, EIOAnalog=0):
+        self.analog = (FIOAnalog, EIOAnalog)
+
+    def getAIN(self, channel):
+        return 1.0
+
+
+def test_photodiode_configures_analog_input(monkeypatch):
+    from klibs import P
+    monkeypatch.setattr(P, 'labjack_port', 'FIO', raising=False)
+    device = FakeU3()
+    port = U3Port(device)
+
+    with pytest.raises(ValueError):
+        U3Photodiode(port, 0)  # FIO0 is a trigger output
+    photodiode = U3Photodiode(port, 9)
+    assert device.analog == (0, 0b10)
+    assert photodiode.lit()
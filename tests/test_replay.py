@@ -0,0 +1,33 @@
+import json
+
+from replay import SessionReplay, compare_recordings
+
+
+def _write(path, rmt, trial_rmt):
+    trial = {
+        'block_num': 1, 'trial_num': 1, 'hand': 'L', 'sex': 'F', 'angle': 90,
+        'rotation': 0, 'tms_onset': 250, 'judgement': 'L', 'accuracy': True,
+        'tms_trial': True, 'tms_fired': True, 'rt': 800.0, 'rmt': trial_rmt,
+    }
+    events = [
+        {'type': 'header', 'version': 1, 'random_seed': 1},
+        {'type': 'tms', 'attr': 'power', 'value': 30, 't': 0.0},
+        {'type': 'rmt', 'value': rmt, 't': 0.1},
+        {'type': 'trial', 'data': trial, 't': 1.0},
+    ]
+    with open(str(path), 'w') as f:
+        for e in events:
+            f.write(json.dumps(e) + "\n")
+    return str(path)
+
+
+def test_replay_uses_confirmed_rmt(tmp_path):
+    path = _write(tmp_path / "orig.jsonl", 47, 47)
+    assert SessionReplay(path).rmt == 47
+
+
+def test_rmt_difference_is_reported(tmp_path):
+    orig = _write(tmp_path / "orig.jsonl", 47, 47)
+    replayed = _write(tmp_path / "replay.jsonl", 30, 30)
+    problems = compare_recordings(orig, replayed)
+    assert len(problems) == 1 and "rmt differs" in problems[0]
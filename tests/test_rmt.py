@@ -0,0 +1,13 @@
+import numpy as np
+
+from rmt import RMTEstimator
+
+
+def test_capped_estimator_never_picks_levels_above_cap():
+    est = RMTEstimator(levels=np.arange(20, 61))
+    # A participant who never responds pushes the estimate up to the cap
+    for i in range(20):
+        level = est.next_level()
+        assert level <= 60
+        est.update(level, False)
+    assert est.estimate > 55